@@ -0,0 +1,36 @@
+""" Fills in the extracted tweet columns for tweets saved before they were added to create.sql,
+    then seeds the tables that are derived from them with seed.sql
+"""
+import logging
+import os
+
+from dotenv import load_dotenv
+
+# Settings are read as modules are imported, so .env has to be loaded first
+load_dotenv('.env')
+
+import db  # noqa: E402
+
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 10000))
+
+SEED_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed.sql')
+
+
+def seed_derived_tables():
+    """ Runs seed.sql, which reads the extracted columns, so only once they're filled in """
+    conn = db.db_conn()
+    crs = conn.cursor()
+    with open(SEED_SQL) as infile:
+        crs.execute(infile.read())
+    conn.commit()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(levelname)s:%(asctime)s.%(msecs)03d [%(threadName)s] - %(message)s',
+        datefmt='%Y-%m-%d,%H:%M:%S',
+        level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')))
+    updated = db.backfill_extracted_columns(BACKFILL_BATCH_SIZE)
+    logging.info(f"Backfilled {updated} tweets.")
+    seed_derived_tables()
+    logging.info("Seeded pending parents, account stats and high-water marks.")
@@ -0,0 +1,116 @@
+""" Benchmarks full collection runs of main.py against the local API stand-in in fake_api.py and a
+    scratch Postgres database, which is created from create.sql and emptied before every run.
+
+    $ PYTHONPATH=$(pwd):$(pwd)/bench python3.6 bench/bench_collection.py [screen name counts...]
+"""
+import logging
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import psycopg2
+
+from fake_api import FakeTwitter, FakeTwitterServer, SyntheticTweets
+
+# Scratch database the benchmark creates and truncates, never the collector's own
+BENCH_DATABASE = os.environ.get('BENCH_DATABASE', 'twitter_cs_bench')
+# Seconds of simulated API latency per request
+BENCH_API_LATENCY = float(os.environ.get('BENCH_API_LATENCY', 0.01))
+# Fraction of API requests failing with a 503
+BENCH_API_ERROR_RATE = float(os.environ.get('BENCH_API_ERROR_RATE', 0.0))
+
+CREATE_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create.sql')
+
+server = FakeTwitterServer(FakeTwitter(SyntheticTweets(), BENCH_API_LATENCY,
+                                       error_rate=BENCH_API_ERROR_RATE)).start()
+os.environ.update({
+    'TWITTER_API_URL': server.base_url,
+    'PGDATABASE': BENCH_DATABASE,
+    'TWITTER_CONSUMER_KEY': 'bench', 'TWITTER_CONSUMER_SECRET': 'bench',
+    'TWITTER_ACCESS_TOKEN': 'bench', 'TWITTER_ACCESS_SECRET': 'bench',
+    'SEARCH_RATE_LIMIT': '100000', 'TIMELINE_RATE_LIMIT': '100000',
+    'LOOKUP_RATE_LIMIT': '100000',
+    'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    'RUN_REPORT_PATH': '', 'PROMETHEUS_TEXTFILE': '',
+})
+
+import db  # noqa: E402
+import fetch  # noqa: E402
+import instrument  # noqa: E402
+import main  # noqa: E402
+import ratelimit  # noqa: E402
+from twitter import Api  # noqa: E402
+
+
+def create_database():
+    """ Creates the scratch database if needed and applies create.sql to it """
+    conn = psycopg2.connect(dbname='postgres')
+    conn.autocommit = True
+    crs = conn.cursor()
+    crs.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (BENCH_DATABASE,))
+    if not crs.fetchone():
+        crs.execute(f"CREATE DATABASE {BENCH_DATABASE} ENCODING 'UTF8' TEMPLATE template0;")
+    conn.close()
+    subprocess.run(['psql', '-q', '-v', 'ON_ERROR_STOP=1', BENCH_DATABASE, '-f', CREATE_SQL],
+                   check=True, stdout=subprocess.DEVNULL,
+                   env=dict(os.environ, PGOPTIONS='-c client_min_messages=warning'))
+
+
+def truncate_tables(conn):
+    crs = conn.cursor()
+    crs.execute("""SELECT tablename FROM pg_tables WHERE schemaname = 'public';""")
+    tables = [row.tablename for row in crs.fetchall()]
+    crs.execute(f"TRUNCATE {', '.join(tables)};")
+    conn.commit()
+
+
+def count_tweets(conn) -> int:
+    crs = conn.cursor()
+    crs.execute("SELECT count(*) AS tweets FROM tweets;")
+    tweets = crs.fetchone().tweets
+    conn.commit()
+    return tweets
+
+
+def bench(conn, num_screen_names: int) -> dict:
+    """ Runs one collection over `num_screen_names` fresh accounts """
+    truncate_tables(conn)
+    ratelimit.reset()
+    os.environ['MONITORED_SCREEN_NAMES'] = ','.join(f'company{num}'
+                                                   for num in range(num_screen_names))
+    api_before = server.api.stats()
+
+    start = time.perf_counter()
+    main.main()
+    elapsed = time.perf_counter() - start
+
+    run_report = instrument.report()
+    trips = sum(query['count'] for query in run_report['timings'].get('sql', {}).values())
+    api_calls = Counter(server.api.stats())
+    api_calls.subtract(api_before)
+    return {'elapsed': elapsed, 'tweets': count_tweets(conn), 'round_trips': trips,
+            'api_calls': {endpoint: count for endpoint, count in api_calls.items() if count},
+            'stages': {name: stage['seconds']
+                       for name, stage in run_report['timings'].get('stage', {}).items()}}
+
+
+if __name__ == '__main__':
+    counts = [*map(int, sys.argv[1:])] or [10, 100, 1000]
+    if not fetch.RAW_INGEST and not hasattr(Api, 'LookupStatuses'):
+        logging.warning("The installed python-twitter has no Api.LookupStatuses, so orphan and "
+                        "truncated tweet lookups are left out of the benchmark.")
+        os.environ['LOOKUP_RATE_LIMIT'] = '0'
+    create_database()
+    conn = db.db_conn()
+    for count in counts:
+        result = bench(conn, count)
+        calls = ', '.join(f'{endpoint} {num}'
+                          for endpoint, num in sorted(result['api_calls'].items()))
+        print(f"{count:>5} screen names: {result['elapsed']:.2f}s, {result['tweets']} tweets, "
+              f"{result['tweets'] / result['elapsed']:,.0f} tweets/s, "
+              f"{result['round_trips']} DB round trips, API calls: {calls}")
+        print('       ' + ', '.join(f'{name} {seconds:.2f}s'
+                                    for name, seconds in result['stages'].items()))
+    server.shutdown()
@@ -0,0 +1,95 @@
+""" Benchmarks the COPY ingest path against the original execute_values inserts.  Every run is
+    rolled back, so it is safe to point at a database with collected tweets.
+
+    $ PYTHONPATH=$(pwd) python3.6 bench/bench_ingest.py [row counts...]
+"""
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+import db
+
+TEXTS = [
+    '@AmazonHelp my order still hasn\'t arrived, can you help?',
+    '@user{} Sorry to hear that! Please DM us your order number and we\'ll take a look. ^AB',
+    'Why is @Delta so slow today?? Still no fix\nThanks for nothing',
+    '@SpotifyCares app keeps crashing on launch \U0001f620 https://t.co/abcdefghij',
+]
+
+
+def synthetic_records(count: int, seed: int=0) -> tuple:
+    """ Generates (user records, tweet records) shaped like those of user_to_record and
+        tweet_to_record
+    """
+    rnd = random.Random(seed)
+    base_id = 10 ** 18 + rnd.randint(0, 10 ** 15)
+    start = datetime(2018, 1, 1)
+    users, tweets = [], []
+    for i in range(count):
+        user_id = str(rnd.randint(1, count // 4 + 1))
+        user = {'id': int(user_id), 'screen_name': f'user{user_id}', 'followers_count': i,
+                'description': rnd.choice(TEXTS).format(i), 'lang': 'en'}
+        tweet = {'id': base_id + i, 'text': rnd.choice(TEXTS).format(i), 'user': user,
+                 'in_reply_to_status_id': base_id + rnd.randint(0, count), 'lang': 'en',
+                 'created_at': 'Mon Jan 01 00:00:00 +0000 2018', 'truncated': False,
+                 'entities': {'hashtags': [], 'urls': [], 'user_mentions': []}}
+        users.append((user_id, json.dumps(user)))
+        tweets.append(db.TweetRecord(str(base_id + i), start + timedelta(seconds=i),
+                                     json.dumps(tweet), tweet['in_reply_to_status_id'],
+                                     user['id'], user['screen_name'], False))
+    return [*dict(users).items()], tweets
+
+
+def insert_execute_values(crs, users, tweets):
+    """ The original inserts: one multi-row INSERT per 100 records """
+    execute_values(crs, "INSERT INTO users (user_id, data) VALUES %s ON CONFLICT DO NOTHING;",
+                   users)
+    execute_values(crs, f"""INSERT INTO tweets ({', '.join(db.TWEET_COLUMNS)})
+                            VALUES %s ON CONFLICT DO NOTHING;""", tweets)
+
+
+def insert_copy(crs, users, tweets):
+    db.insert_user_records(crs, users)
+    db.insert_tweet_records(crs, tweets)
+
+
+def bench(name: str, insert, users, tweets) -> float:
+    conn = db.db_conn()
+    crs = conn.cursor()
+    try:
+        start = time.perf_counter()
+        insert(crs, users, tweets)
+        return time.perf_counter() - start
+    finally:
+        conn.rollback()
+
+
+if __name__ == '__main__':
+    counts = [*map(int, sys.argv[1:])] or [1000, 10000, 100000]
+    for count in counts:
+        users, tweets = synthetic_records(count)
+        before = bench('execute_values', insert_execute_values, users, tweets)
+        after = bench('copy', insert_copy, users, tweets)
+        print(f'{count:>8} tweets: execute_values {before:.3f}s, copy {after:.3f}s '
+              f'({before / after:.1f}x)')
+
+    # A few rows postgres can't store should only cost those rows
+    users, tweets = synthetic_records(10000, seed=1)
+    bad = {*random.Random(1).sample(range(len(tweets)), 5)}
+    tweets = [record._replace(data=record.data.replace('"lang"', '"bad": "\\u0000", "lang"'))
+              if i in bad else record
+              for i, record in enumerate(tweets)]
+    conn = db.db_conn()
+    crs = conn.cursor()
+    try:
+        start = time.perf_counter()
+        skipped = db.copy_records(crs, 'tweets', db.TWEET_COLUMNS, tweets, 'tweet')
+        print(f'Skipped {skipped} of {len(bad)} bad rows among {len(tweets)} in '
+              f'{time.perf_counter() - start:.3f}s')
+    finally:
+        conn.rollback()
+    sys.exit(0 if skipped == len(bad) else 1)
@@ -0,0 +1,88 @@
+""" Benchmarks the tweet sanitizer against the original one-pass-per-pattern pipeline.
+
+    $ PYTHONPATH=$(pwd) python3.6 bench/bench_sanitize.py [tweet count]
+"""
+import random
+import sys
+import time
+from collections import defaultdict
+
+import toolz
+
+from sanitize import BTC_RE, CC_RE, EMAIL_RE, SN_RE, Sanitizer
+
+TEMPLATES = [
+    '@{company} my order still hasn\'t arrived, can you help?',
+    "@{user} Sorry to hear that! Please DM us your order number and we'll take a look. ^{initials}",
+    '@{company} @{user} same thing happened to me last week',
+    '@{company} you can reach me at {email} about order #{order}',
+    '@{company} charged twice on card {card}, please refund',
+    '@{company} send the refund to {btc} thanks',
+    'Why is @{company} so slow today?? {year} and still no fix',
+    'Thanks for the quick help! https://t.co/{link}',
+    '@{user} We\'ve sent you a DM with more details. ^{initials}',
+]
+
+COMPANIES = ['AmazonHelp', 'AppleSupport', 'Delta', 'SpotifyCares', 'comcastcares', 'Uber_Support']
+
+
+def synthetic_tweets(count: int, seed: int=0) -> list:
+    """ Generates tweet text resembling the collected support conversations """
+    rnd = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    btc_chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+    tweets = []
+    for _ in range(count):
+        tweets.append(rnd.choice(TEMPLATES).format(
+            company=rnd.choice(COMPANIES),
+            user='user{}'.format(rnd.randint(0, count)),
+            initials=''.join(rnd.choice('ABCDEFGHIJ') for _ in range(2)),
+            email='{}@example.com'.format(''.join(rnd.choice(alphabet) for _ in range(8))),
+            order=rnd.randint(10 ** 6, 10 ** 9),
+            card=' '.join(str(rnd.randint(1000, 9999)) for _ in range(4)),
+            btc='1' + ''.join(rnd.choice(btc_chars) for _ in range(33)),
+            year=rnd.randint(2010, 2030),
+            link=''.join(rnd.choice(alphabet) for _ in range(10)),
+        ))
+    return tweets
+
+
+def screen_name_replacer():
+    """ Stand-in for the export's screen name anonymization """
+    user_ids = defaultdict(lambda: len(user_ids))
+
+    def replace_sn(sn):
+        _sn = sn.group(2).lower()
+        if _sn.startswith('__') and _sn.endswith('__'):
+            return sn.group(1) + sn.group(2)
+        return sn.group(1) + str(user_ids[_sn])
+
+    return replace_sn
+
+
+def pipeline_sanitizer(replace_sn):
+    """ The original sanitizer: one full substitution pass per pattern """
+    sn_sanitize = lambda text: SN_RE.sub(replace_sn, text)
+    email_sanitize = lambda text: EMAIL_RE.sub('__email__', text)
+    cc_sanitize = lambda text: CC_RE.sub('__credit_card__', text)
+    btc_sanitize = lambda text: BTC_RE.sub('__btc_wallet__', text)
+    return toolz.compose(cc_sanitize, btc_sanitize, sn_sanitize, email_sanitize)
+
+
+def bench(name: str, sanitize, tweets: list) -> list:
+    start = time.perf_counter()
+    results = [*map(sanitize, tweets)]
+    elapsed = time.perf_counter() - start
+    print(f'{name:>10}: {elapsed:.3f}s, {len(tweets) / elapsed:,.0f} tweets/s')
+    return results
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    tweets = synthetic_tweets(count)
+    print(f'Sanitizing {count} synthetic tweets...')
+    before = bench('pipeline', pipeline_sanitizer(screen_name_replacer()), tweets)
+    after = bench('sanitizer', Sanitizer(screen_name_replacer()), tweets)
+    mismatches = sum(1 for a, b in zip(before, after) if a != b)
+    print(f'{mismatches} outputs differ.')
+    sys.exit(1 if mismatches else 0)
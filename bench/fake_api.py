@@ -0,0 +1,316 @@
+""" Local stand-in for the Twitter API endpoints the collector uses: search/tweets,
+    statuses/user_timeline and statuses/lookup.  Serves synthetic conversations, or tweets
+    recorded as JSON lines, with configurable latency, error rate and rate limits.  Point the
+    collector at it with TWITTER_API_URL.
+
+    $ PYTHONPATH=$(pwd) python3.6 bench/fake_api.py --port 8089 [--latency 0.05] \
+        [--recorded tweets.jsonl]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+CREATED_AT_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+# Requests per 15 minute window for each endpoint, generous enough for benchmarks by default
+DEFAULT_LIMITS = {
+    'search/tweets': 100000,
+    'statuses/user_timeline': 100000,
+    'statuses/lookup': 100000,
+}
+
+# Kinds of synthetic tweets, in the order of the digit telling them apart in status IDs
+KINDS = ['older', 'at', 'reply']
+
+TEXTS = [
+    '@{company} my order still hasn\'t arrived, can you help?',
+    '@{company} charged twice on my card, please refund',
+    '@{company} the app keeps crashing since the update',
+    '@{company} been on hold for an hour, is anyone there?',
+]
+REPLY_TEXTS = [
+    '@{user} Sorry to hear that! Please DM us your order number and we\'ll take a look. ^AB',
+    '@{user} We\'ve sent you a DM with more details.',
+    '@{user} Thanks for reaching out, could you tell us which device you\'re using?',
+]
+
+
+def stable_int(*parts) -> int:
+    """ Deterministic 48 bit integer derived from the parts """
+    digest = hashlib.blake2b(':'.join(map(str, parts)).encode(), digest_size=6).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def page(tweets: List[dict], params: Dict[str, str]) -> List[dict]:
+    """ The `count` newest of the tweets, newest first, newer than `since_id` and no newer than
+        `max_id`, the way the search and timeline endpoints page
+    """
+    since_id = int(params.get('since_id') or 0)
+    max_id = int(params.get('max_id') or 0)
+    in_range = [tweet for tweet in tweets
+                if tweet['id'] > since_id and (not max_id or tweet['id'] <= max_id)]
+    return in_range[:int(params.get('count', 100))]
+
+
+class SyntheticTweets:
+    """ Deterministic conversations between each screen name and its customers.  Every account
+        has `per_account` inbound tweets and as many replies, some of which reply to tweets
+        that are only available through statuses/lookup, and some of which are truncated.
+    """
+
+    def __init__(self, per_account: int=100, lookup_miss_rate: float=0.2,
+                 truncated_rate: float=0.05):
+        self.per_account = per_account
+        self.lookup_miss_rate = lookup_miss_rate
+        self.truncated_rate = truncated_rate
+        self.now = datetime.utcnow()
+        # Screen names by the account number in their status IDs, for looking tweets up by ID
+        self.accounts = {}  # type: Dict[int, str]
+
+    def _status_id(self, screen_name: str, kind: str, num: int) -> int:
+        # Ordered by time like real status IDs, unique per account, kind and number
+        account = stable_int(screen_name) % 10 ** 6
+        self.accounts[account] = screen_name
+        return 10 ** 18 + account * 10 ** 9 + KINDS.index(kind) * 10 ** 7 + num
+
+    def _tweet(self, status_id: int, text: str, user_id: int, screen_name: str,
+               in_reply_to: Optional[int], minutes_ago: int, full: bool=False) -> dict:
+        truncated = not full and \
+            stable_int(status_id, 'truncated') % 1000 < self.truncated_rate * 1000
+        return {
+            'id': status_id, 'id_str': str(status_id),
+            'created_at': (self.now - timedelta(minutes=minutes_ago)).strftime(CREATED_AT_FORMAT),
+            'full_text': text[:40] + '… https://t.co/abcdefghij' if truncated else text,
+            'truncated': truncated, 'lang': 'en',
+            'user': {'id': user_id, 'id_str': str(user_id), 'screen_name': screen_name,
+                     'name': screen_name, 'followers_count': user_id % 1000},
+            'in_reply_to_status_id': in_reply_to,
+            'entities': {'hashtags': [], 'urls': [], 'user_mentions': []},
+        }
+
+    def _customer(self, screen_name: str, num: int) -> Tuple[int, str]:
+        user_id = stable_int(screen_name, 'customer', num % max(self.per_account // 2, 1))
+        return user_id, f'customer{user_id % 10 ** 8}'
+
+    def _older_tweet(self, screen_name: str, num: int, full: bool=False) -> dict:
+        """ The start of a conversation from before the search window, only served by lookup """
+        user_id, user_sn = self._customer(screen_name, num)
+        return self._tweet(self._status_id(screen_name, 'older', num),
+                           TEXTS[num % len(TEXTS)].format(company=screen_name), user_id, user_sn,
+                           None, 60 * 24 * 2, full)
+
+    def _at_tweet(self, screen_name: str, num: int, full: bool=False) -> dict:
+        user_id, user_sn = self._customer(screen_name, num)
+        # Every fourth tweet continues a conversation that started before the search window
+        in_reply_to = self._status_id(screen_name, 'older', num) if num % 4 == 3 else None
+        return self._tweet(self._status_id(screen_name, 'at', num),
+                           TEXTS[num % len(TEXTS)].format(company=screen_name), user_id, user_sn,
+                           in_reply_to, 2 * (self.per_account - num) + 1, full)
+
+    def _reply_tweet(self, screen_name: str, num: int, full: bool=False) -> dict:
+        user_id, user_sn = self._customer(screen_name, num)
+        return self._tweet(self._status_id(screen_name, 'reply', num),
+                           REPLY_TEXTS[num % len(REPLY_TEXTS)].format(user=user_sn),
+                           stable_int(screen_name, 'company'), screen_name,
+                           self._status_id(screen_name, 'at', num),
+                           2 * (self.per_account - num), full)
+
+    def tweets_at(self, screen_name: str) -> List[dict]:
+        return [self._at_tweet(screen_name, num) for num in reversed(range(self.per_account))]
+
+    def replies_from(self, screen_name: str) -> List[dict]:
+        return [self._reply_tweet(screen_name, num) for num in reversed(range(self.per_account))]
+
+    def _full_tweet(self, status_id: int) -> dict:
+        """ The tweet with the ID as search or the timeline serve it, but never truncated.  IDs
+            of accounts not served yet get a tweet of their own.
+        """
+        account, kind = (status_id // 10 ** 9) % 10 ** 6, (status_id // 10 ** 7) % 100
+        screen_name = self.accounts.get(account)
+        if screen_name and 10 ** 18 <= status_id < 2 * 10 ** 18 and kind < len(KINDS):
+            build = {'older': self._older_tweet, 'at': self._at_tweet,
+                     'reply': self._reply_tweet}[KINDS[kind]]
+            return build(screen_name, status_id % 10 ** 7, full=True)
+        return self._tweet(status_id, f'Full text of tweet {status_id}',
+                           stable_int(status_id, 'author'), f'user{status_id % 10 ** 6}', None,
+                           60 * 24 * 2, full=True)
+
+    def lookup(self, status_ids: List[int]) -> List[dict]:
+        """ Full versions of the requested tweets, leaving out a fraction as inaccessible """
+        return [self._full_tweet(status_id) for status_id in status_ids
+                if stable_int(status_id, 'lookup') % 1000 >= self.lookup_miss_rate * 1000]
+
+
+class RecordedTweets:
+    """ Serves tweets recorded from the API as JSON lines, one tweet object per line """
+
+    def __init__(self, path: str):
+        self.by_id = {}  # type: Dict[int, dict]
+        self.by_author = defaultdict(list)
+        self.by_mention = defaultdict(list)
+        with open(path) as infile:
+            for line in filter(str.strip, infile):
+                tweet = json.loads(line)
+                self.by_id[tweet['id']] = tweet
+                self.by_author[tweet['user']['screen_name'].lower()].append(tweet)
+                text = tweet.get('full_text') or tweet.get('text') or ''
+                for word in text.split():
+                    if word.startswith('@'):
+                        self.by_mention[word.strip('@:,.!?').lower()].append(tweet)
+
+    def tweets_at(self, screen_name: str) -> List[dict]:
+        return sorted(self.by_mention[screen_name], key=lambda t: -t['id'])
+
+    def replies_from(self, screen_name: str) -> List[dict]:
+        return sorted(self.by_author[screen_name], key=lambda t: -t['id'])
+
+    def lookup(self, status_ids: List[int]) -> List[dict]:
+        return [self.by_id[status_id] for status_id in status_ids if status_id in self.by_id]
+
+
+class FakeTwitter:
+    """ Request handling, rate limiting and counters shared by the server's threads """
+
+    def __init__(self, tweets, latency: float=0.0, jitter: float=0.0, error_rate: float=0.0,
+                 limits: Optional[Dict[str, int]]=None, window: int=900, seed: int=0):
+        self.tweets = tweets
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.window = window
+        self.random = random.Random(seed)
+        self.windows = {}  # type: Dict[str, Tuple[int, float]]
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def _take(self, endpoint: str) -> Tuple[bool, Dict[str, str], bool]:
+        """ Spends a request from the endpoint's window, returning whether one was left, the
+            rate limit headers to send and whether to inject an error
+        """
+        with self.lock:
+            now = time.time()
+            remaining, reset_at = self.windows.get(endpoint, (self.limits[endpoint], 0))
+            if now >= reset_at:
+                remaining, reset_at = self.limits[endpoint], now + self.window
+            allowed = remaining > 0
+            remaining = max(remaining - 1, 0)
+            self.windows[endpoint] = (remaining, reset_at)
+            failed = self.random.random() < self.error_rate
+        headers = {'x-rate-limit-limit': str(self.limits[endpoint]),
+                   'x-rate-limit-remaining': str(remaining),
+                   'x-rate-limit-reset': str(int(reset_at))}
+        return allowed, headers, failed
+
+    def handle(self, path: str, params: Dict[str, str]) -> Tuple[int, Dict[str, str], object]:
+        """ Returns (status code, headers, JSON body) for a request """
+        endpoint = path.strip('/').replace('1.1/', '', 1).rsplit('.json', 1)[0]
+        if endpoint not in self.limits:
+            return 404, {}, {'errors': [{'code': 34, 'message': 'Page does not exist'}]}
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.random.random() * self.jitter)
+
+        allowed, headers, failed = self._take(endpoint)
+        with self.lock:
+            self.counts[endpoint] += 1
+            if not allowed:
+                self.counts['rate_limited'] += 1
+            elif failed:
+                self.counts['errors'] += 1
+        if not allowed:
+            return 429, headers, {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}
+        if failed:
+            return 503, headers, {'errors': [{'code': 131, 'message': 'Internal error'}]}
+
+        count = int(params.get('count', 100))
+        if endpoint == 'search/tweets':
+            screen_name = params.get('q', '').strip('@').lower()
+            return 200, headers, {'statuses': page(self.tweets.tweets_at(screen_name), params),
+                                  'search_metadata': {'count': count}}
+        if endpoint == 'statuses/user_timeline':
+            screen_name = params.get('screen_name', '').lower()
+            return 200, headers, page(self.tweets.replies_from(screen_name), params)
+        status_ids = [int(status_id) for status_id in params.get('id', '').split(',') if status_id]
+        return 200, headers, self.tweets.lookup(status_ids)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counts)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """ Hands requests to the server's FakeTwitter """
+
+    def _respond(self, params: Dict[str, List[str]]):
+        path = urlparse(self.path).path
+        if path == '/stats.json':
+            status, headers, body = 200, {}, self.server.api.stats()
+        else:
+            status, headers, body = self.server.api.handle(
+                path, {key: values[-1] for key, values in params.items()})
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        params = parse_qs(urlparse(self.path).query)
+        params.update(parse_qs(body))
+        self._respond(params)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class FakeTwitterServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, api: FakeTwitter, port: int=0):
+        super().__init__(('127.0.0.1', port), RequestHandler)
+        self.api = api
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/1.1'
+
+    def start(self) -> 'FakeTwitterServer':
+        """ Serves requests from a background thread """
+        threading.Thread(target=self.serve_forever, name='fake-api', daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction failing')
+    parser.add_argument('--limit', type=int, help='requests per window for every endpoint')
+    parser.add_argument('--recorded', help='JSON lines file of tweets to serve')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+
+    tweets = RecordedTweets(args.recorded) if args.recorded else SyntheticTweets()
+    limits = {endpoint: args.limit for endpoint in DEFAULT_LIMITS} if args.limit else None
+    server = FakeTwitterServer(FakeTwitter(tweets, args.latency, args.jitter, args.error_rate,
+                                           limits), args.port)
+    logging.info(f'Serving at {server.base_url}, counters at /stats.json')
+    server.serve_forever()
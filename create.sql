@@ -1,13 +1,52 @@
 
+-- Partitioned by month of creation.  The collector adds each month's partition when its first
+-- tweets are saved, and `python3.6 partitions.py archive` dumps and drops old ones.  Databases
+-- from before tweets was partitioned are moved over with `python3.6 partitions.py migrate`.
+-- Postgres needs the partition key in the primary key, so it can't keep status_id unique on its
+-- own.  The collector checks every partition for a status_id before saving a new tweet, and
+-- overwrites tweets by status_id, replacing any row saved under another created_at.
 CREATE TABLE IF NOT EXISTS tweets (
-  status_id TEXT PRIMARY KEY,
+  status_id TEXT,
   created_at TIMESTAMP,
   observed_at TIMESTAMP default (now() at time zone 'utc'),
-  data JSONB
+  data JSONB,
+  PRIMARY KEY (status_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Tweets from months without a partition, like archived months
+DO $$
+BEGIN
+  IF (SELECT relkind FROM pg_class WHERE oid = 'tweets'::regclass) = 'p' THEN
+    CREATE TABLE IF NOT EXISTS tweets_default PARTITION OF tweets DEFAULT;
+  END IF;
+END
+$$;
+
+-- Months of tweets dumped and dropped by `python3.6 partitions.py archive`
+CREATE TABLE IF NOT EXISTS tweet_archives (
+  month TIMESTAMP PRIMARY KEY,
+  path TEXT,
+  row_count BIGINT,
+  archived_at TIMESTAMP DEFAULT (now() at time zone 'utc')
 );
 
 CREATE INDEX IF NOT EXISTS tweet_created_at ON tweets (created_at);
 
+CREATE INDEX IF NOT EXISTS tweet_observed_at ON tweets (observed_at);
+
+-- Copies of fields in `data`, set when tweets are saved.  Rows saved before these columns existed
+-- are filled in by `python3.6 backfill.py`.
+ALTER TABLE tweets ADD COLUMN IF NOT EXISTS in_reply_to_status_id BIGINT;
+ALTER TABLE tweets ADD COLUMN IF NOT EXISTS user_id BIGINT;
+ALTER TABLE tweets ADD COLUMN IF NOT EXISTS screen_name TEXT;
+ALTER TABLE tweets ADD COLUMN IF NOT EXISTS needs_refetch BOOLEAN;
+
+CREATE INDEX IF NOT EXISTS tweet_in_reply_to_status_id ON tweets (in_reply_to_status_id);
+CREATE INDEX IF NOT EXISTS tweet_user_id ON tweets (user_id);
+CREATE INDEX IF NOT EXISTS tweet_screen_name_created_at ON tweets (screen_name, created_at);
+CREATE INDEX IF NOT EXISTS tweet_needs_refetch_created_at ON tweets (created_at)
+  WHERE needs_refetch;
+
 CREATE TABLE IF NOT EXISTS users (
   user_id TEXT PRIMARY KEY,
   observed_at TIMESTAMP DEFAULT (now() at time zone 'utc'),
@@ -25,6 +64,118 @@ CREATE INDEX IF NOT EXISTS request_created_at ON requests (created_at);
 CREATE INDEX IF NOT EXISTS request_kind ON requests (kind);
 CREATE INDEX IF NOT EXISTS request_kind_created_at ON requests (kind, created_at);
 
+-- Rate limits belong to a set of API credentials, so each collector keeps its own
+CREATE TABLE IF NOT EXISTS rate_limits (
+  collector TEXT NOT NULL DEFAULT '',
+  endpoint TEXT,
+  "limit" INTEGER,
+  remaining INTEGER,
+  reset_at TIMESTAMP,
+  observed_at TIMESTAMP DEFAULT (now() at time zone 'utc'),
+  PRIMARY KEY (collector, endpoint)
+);
+
+-- Tables from before collectors kept their own rate limits are keyed on endpoint alone
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                 WHERE table_schema = current_schema() AND table_name = 'rate_limits'
+                   AND column_name = 'collector') THEN
+    ALTER TABLE rate_limits ADD COLUMN collector TEXT NOT NULL DEFAULT '';
+    ALTER TABLE rate_limits DROP CONSTRAINT rate_limits_pkey;
+    ALTER TABLE rate_limits ADD PRIMARY KEY (collector, endpoint);
+  END IF;
+END
+$$;
+
+-- Screen names and truncated tweets claimed by a collector, which other collectors leave alone
+-- until the lease runs out
+CREATE TABLE IF NOT EXISTS collection_leases (
+  kind TEXT,
+  key TEXT,
+  holder TEXT,
+  leased_until TIMESTAMP,
+  PRIMARY KEY (kind, key)
+);
+
 CREATE TABLE IF NOT EXISTS inaccessible_tweets (
   status_id TEXT PRIMARY KEY
 );
+
+-- Parents of collected replies that haven't been fetched yet, kept up to date as tweets and
+-- inaccessible tweet IDs are saved
+CREATE TABLE IF NOT EXISTS pending_parents (
+  status_id TEXT PRIMARY KEY,
+  child_created_at TIMESTAMP,
+  queued_at TIMESTAMP DEFAULT (now() at time zone 'utc'),
+  claimed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS pending_parent_child_created_at ON pending_parents (child_created_at);
+
+-- Tweets saved since their sentiment was last scored, filled with SENTIMENT_QUEUE and emptied by
+-- sentiment.py, which leases batches to score like collection_leases
+CREATE TABLE IF NOT EXISTS sentiment_queue (
+  status_id TEXT PRIMARY KEY,
+  created_at TIMESTAMP,
+  queued_at TIMESTAMP DEFAULT (now() at time zone 'utc'),
+  holder TEXT,
+  leased_until TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS sentiment_queue_queued_at ON sentiment_queue (queued_at);
+
+-- Per-account volume, kept up to date as tweets and requests are saved so runs can be prioritized
+-- without scanning tweets.  decayed_count is the account's tweets each weighted by
+-- exp(-age / ACCOUNT_RATE_DECAY_HOURS) as of decayed_at, and over the decay time approximates the
+-- account's tweet rate.
+CREATE TABLE IF NOT EXISTS account_stats (
+  screen_name TEXT PRIMARY KEY,
+  last_scraped_at TIMESTAMP,
+  decayed_count DOUBLE PRECISION NOT NULL DEFAULT 0,
+  decayed_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS account_hourly_counts (
+  screen_name TEXT,
+  hour TIMESTAMP,
+  tweet_count INTEGER NOT NULL,
+  PRIMARY KEY (screen_name, hour)
+);
+
+CREATE INDEX IF NOT EXISTS account_hourly_count_hour ON account_hourly_counts (hour);
+
+-- Newest status ID collected from each endpoint for each screen name, which the next run fetches
+-- from.  A run that stops paging early leaves the tweets between gap_since_id and gap_max_id to
+-- be fetched by later runs.
+CREATE TABLE IF NOT EXISTS high_water_marks (
+  screen_name TEXT,
+  kind TEXT,
+  since_id BIGINT,
+  gap_since_id BIGINT,
+  gap_max_id BIGINT,
+  updated_at TIMESTAMP DEFAULT (now() at time zone 'utc'),
+  PRIMARY KEY (screen_name, kind)
+);
+
+-- Anonymous IDs handed out by incremental exports, and where the last one left off
+CREATE TABLE IF NOT EXISTS export_tweet_ids (
+  status_id BIGINT PRIMARY KEY,
+  anon_id BIGINT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS export_user_ids (
+  user_id BIGINT PRIMARY KEY,
+  anon_id BIGINT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS export_screen_names (
+  screen_name TEXT PRIMARY KEY,
+  anon_id BIGINT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS export_state (
+  name TEXT PRIMARY KEY,
+  watermark TIMESTAMP,
+  exported_at TIMESTAMP DEFAULT (now() at time zone 'utc')
+);
@@ -1,40 +1,313 @@
+import functools
+import io
 import logging
+import os
+import queue
+import re
+import socket
+import threading
+import time
+from calendar import timegm
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict
+from email.utils import parsedate
+from typing import List, Dict, NamedTuple, Optional, Union
 import json
 
 import psycopg2
 import toolz
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
 from psycopg2.extras import NamedTupleConnection, execute_values
-from twitter import Status, User
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from twitter import User
 
-from fetch import ApiRequest
+import instrument
+from fetch import ApiRequest, RawTweet, Tweet
+
+
+# Tweets buffered by a WriteBuffer before its writes are flushed in one transaction
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 5000))
+# Queue saved tweets in sentiment_queue for sentiment.py to score, rather than leaving them
+# unscored.  On by default with SENTIMENT_ANALYZER set, which has the daemon score the queue.
+SENTIMENT_QUEUE = os.environ.get('SENTIMENT_QUEUE', 'true' if os.environ.get('SENTIMENT_ANALYZER')
+                                 else '').lower() in ('1', 'true', 'yes')
+# Minutes before parents claimed from the pending_parents queue can be claimed again, in case the
+# run that claimed them failed before saving them
+PENDING_CLAIM_MINUTES = int(os.environ.get('PENDING_CLAIM_MINUTES', 15))
+
+TweetRecord = NamedTuple('TweetRecord', [
+    ('status_id', str),
+    ('created_at', datetime),
+    ('data', str),
+    ('in_reply_to_status_id', Optional[int]),
+    ('user_id', Optional[int]),
+    ('screen_name', Optional[str]),
+    ('needs_refetch', bool),
+])
+
+TWEET_COLUMNS = TweetRecord._fields
+# Columns kept in sync with `data`, extracted so the reply graph, per-account and truncated tweet
+# queries can be indexed.  BACKFILL_QUERY fills them in for rows saved before they existed.
+TWEET_EXTRACTED_COLUMNS = ('in_reply_to_status_id', 'user_id', 'screen_name', 'needs_refetch')
+# Text of a tweet cut short with a link to the full version
+TRUNCATED_TEXT_RE = re.compile(r'… https://t\.co/.{10}\Z', re.IGNORECASE | re.DOTALL)
+USER_COLUMNS = ('user_id', 'data')
+
+# Newest status ID collected from an endpoint for a screen name, and the range of older tweets
+# still to be fetched after a run stopped paging early
+HighWaterMark = NamedTuple('HighWaterMark', [
+    ('screen_name', str),
+    ('kind', str),
+    ('since_id', Optional[int]),
+    ('gap_since_id', Optional[int]),
+    ('gap_max_id', Optional[int]),
+])
+# Hours for an account's estimated tweet rate to decay by a factor of e.  account_stats is seeded by
+# seed.sql with the default.
+ACCOUNT_RATE_DECAY_HOURS = float(os.environ.get('ACCOUNT_RATE_DECAY_HOURS', 24))
+# Days of per-account hourly tweet counts kept in account_hourly_counts
+ACCOUNT_HOURLY_COUNT_DAYS = int(os.environ.get('ACCOUNT_HOURLY_COUNT_DAYS', 14))
+# Database to connect to, e.g. a scratch database for benchmarks
+DB_NAME = os.environ.get('PGDATABASE', 'twitter_cs')
+# Most connections open at once.  Each thread using the database holds one.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+# Seconds a connection can sit idle before it's checked with a round trip on its next use
+DB_HEALTH_CHECK_SECONDS = int(os.environ.get('DB_HEALTH_CHECK_SECONDS', 60))
+# Catch-all partition of tweets, holding tweets from months without a partition of their own
+TWEETS_DEFAULT_PARTITION = 'tweets_default'
+# Advisory lock taken while adding partitions to tweets
+PARTITION_LOCK_ID = 1952805748
+# Name this collector holds work leases and saves rate limits under.  Collectors running at the
+# same time need different names, and each needs its own API credentials.
+COLLECTOR_ID = os.environ.get('COLLECTOR_ID') or socket.gethostname()
+# Seconds a collector holds the screen names and tweet batches it claims.  Leases run out rather
+# than being released, so no other collector takes a screen name within a rate limit window.
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', 15 * 60))
+
+
+_pool = None  # type: Optional[ThreadedConnectionPool]
+# Months known to have a partition of tweets or to be archived
+_tweet_partitions = set()
+_pool_lock = threading.RLock()
+# Connection each thread has checked out of the pool, and when it was last handed out
+_thread_conns = {}  # type: Dict[int, list]
+
+
+def get_pool() -> ThreadedConnectionPool:
+    """ The connection pool, opened on first use """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = ThreadedConnectionPool(1, DB_POOL_SIZE, dbname=DB_NAME,
+                                           connection_factory=NamedTupleConnection,
+                                           cursor_factory=instrument.NamedTupleTimingCursor)
+        return _pool
+
+
+def close_pool():
+    """ Closes every pooled connection, e.g. before forking worker processes, which must not
+        share them.  The pool is opened again on next use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+        _thread_conns.clear()
+
+
+def is_healthy(conn, idle_seconds: float) -> bool:
+    """ Whether a connection is still usable, pinging it if it has been idle a while """
+    if conn.closed or conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if idle_seconds < DB_HEALTH_CHECK_SECONDS or \
+            conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        return True
+    try:
+        with conn.cursor() as crs:
+            crs.execute('SELECT 1;')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def checkout():
+    """ Takes a connection from the pool.  If every connection is in use, those held by threads
+        that have exited are returned to the pool first.
+    """
+    with _pool_lock:
+        pool = get_pool()
+        try:
+            return pool.getconn()
+        except PoolError:
+            alive = {thread.ident for thread in threading.enumerate()}
+            for ident in [ident for ident in _thread_conns if ident not in alive]:
+                conn, _ = _thread_conns.pop(ident)
+                pool.putconn(conn, close=bool(conn.closed))
+            return pool.getconn()
+
+
+@contextmanager
+def connection(cursor_factory=None):
+    """ Checks a connection out of the pool for the block, returning it afterwards.  Work not
+        committed by the end of the block is rolled back.  Cursors return named tuples unless
+        another `cursor_factory` is given.
+    """
+    conn = checkout()
+    if cursor_factory is not None:
+        conn.cursor_factory = cursor_factory
+    try:
+        yield conn
+    finally:
+        conn.cursor_factory = instrument.NamedTupleTimingCursor
+        with _pool_lock:
+            get_pool().putconn(conn, close=bool(conn.closed))
 
 
-@toolz.memoize
 def db_conn():
-    return psycopg2.connect(dbname='twitter_cs', connection_factory=NamedTupleConnection)
+    """ The current thread's connection, checked out of the pool on first use and replaced if it
+        has been dropped.  It stays checked out until `release_conn` is called on the thread.
+    """
+    ident = threading.get_ident()
+    now = time.monotonic()
+    entry = _thread_conns.get(ident)
+    if entry is not None:
+        if is_healthy(entry[0], now - entry[1]):
+            entry[1] = now
+            return entry[0]
+        logging.warning("Database connection was lost, reconnecting...")
+        release_conn(close=True)
+    conn = checkout()
+    _thread_conns[ident] = [conn, now]
+    return conn
+
+
+def release_conn(close: bool=False):
+    """ Returns the current thread's connection to the pool, rolling back uncommitted work """
+    with _pool_lock:
+        entry = _thread_conns.pop(threading.get_ident(), None)
+        if entry is not None and _pool is not None and not _pool.closed:
+            _pool.putconn(entry[0], close=close or bool(entry[0].closed))
+
+
+def connection_lost() -> bool:
+    entry = _thread_conns.get(threading.get_ident())
+    return entry is not None and (entry[0].closed or
+                                  entry[0].info.transaction_status == TRANSACTION_STATUS_UNKNOWN)
+
+
+def reconnecting(func):
+    """ Retries `func` once on a new connection if the thread's connection drops while it runs.
+        Only for functions that run whole transactions, since work before the drop is lost.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if not connection_lost():
+                raise
+            logging.warning(f"Lost the database connection in {func.__name__}, retrying...")
+            release_conn(close=True)
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def execute_prepared(crs, name: str, query: str, params: tuple=()):
+    """ Runs `query`, written with $1-style placeholders, as a server-side prepared statement, so
+        postgres parses and plans it once per connection
+    """
+    prepared = crs.connection.__dict__.setdefault('prepared_statements', {})
+    if prepared.get(name) != query:
+        if name in prepared:
+            crs.execute(f'DEALLOCATE {name};')
+            del prepared[name]
+        crs.execute(f'PREPARE {name} AS {query}')
+        prepared[name] = query
+    if params:
+        crs.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))});", params)
+    else:
+        crs.execute(f'EXECUTE {name};')
+
+
+class DbWriter:
+    """ Runs database writes one at a time on a background thread, so concurrent collectors can
+        share the connection without interleaving their transactions.  Jobs can stage writes in
+        the writer's `buffer`, which is flushed whenever the writer is drained.
+    """
+
+    def __init__(self, buffer: Optional['WriteBuffer']=None):
+        self.buffer = buffer
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                release_conn()
+                self.jobs.task_done()
+                return
+            func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logging.exception(f"Database write {func.__name__} failed:")
+                db_conn().rollback()
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """ Queues `func(*args, **kwargs)` to run on the writer thread """
+        self.jobs.put((func, args, kwargs))
+
+    def drain(self):
+        """ Blocks until every queued write has finished and the buffer is flushed """
+        if self.buffer is not None:
+            self.submit(self.buffer.flush)
+        self.jobs.join()
+
+    def close(self):
+        """ Finishes queued writes and stops the writer thread """
+        self.drain()
+        self.jobs.put(None)
+        self.thread.join()
 
 
 LAST_TWEET_QUERY = """
     SELECT "data" FROM tweets 
-    WHERE "data" ->> 'user' ->> 'screen_name' ILIKE %s
+    WHERE screen_name = lower(%s)
     ORDER BY created_at DESC
     LIMIT 1;
 """
 
 
-def user_to_record(user: User) -> tuple:
-    """ Converts a user to a record that can be saved in postgres """
+def user_to_record(user: Union[User, dict]) -> tuple:
+    """ Converts a user, or a user's JSON object from a RawTweet, to a record that can be saved in
+        postgres
+    """
+    if isinstance(user, dict):
+        # Parsed from a response already scrubbed of NULs
+        return str(user['id']), json.dumps(user)
     return str(user.id), user.AsJsonString().replace('\u0000', '')
 
 
+def tweet_user_id(tweet: Tweet) -> Optional[int]:
+    if isinstance(tweet, RawTweet):
+        return tweet.user['id'] if tweet.user else None
+    return tweet.user.id if tweet.user else None
+
+
+@reconnecting
 def last_scraped_at(screen_name: str) -> datetime:
     """ Get the last time the screen name was scraped from the database. """
     conn = db_conn()
     crs = conn.cursor()
-    query = 'SELECT created_at FROM requests WHERE screen_name=%s ORDER BY created_at DESC LIMIT 1'
-    crs.execute(query, (screen_name, ))
+    execute_prepared(crs, 'last_scraped_at', """
+        SELECT last_scraped_at FROM account_stats
+        WHERE screen_name = $1 AND last_scraped_at IS NOT NULL;""", (screen_name, ))
     results = crs.fetchall()
     if len(results) < 1:
         return datetime(1999, 1, 1)
@@ -42,62 +315,389 @@ def last_scraped_at(screen_name: str) -> datetime:
         return results[0][0]
 
 
+@reconnecting
+def last_scraped_times(screen_names: List[str]) -> Dict[str, datetime]:
+    """ Gets the last time each screen name was scraped in a single query.  Screen names that were
+        never scraped are missing from the result.
+    """
+    conn = db_conn()
+    crs = conn.cursor()
+    crs.execute("""SELECT screen_name, last_scraped_at FROM account_stats
+                   WHERE screen_name = ANY(%s) AND last_scraped_at IS NOT NULL;""",
+                (screen_names, ))
+    return dict(crs.fetchall())
+
+
+# Looks in every partition, since postgres can't keep status_id unique across them and a tweet
+# saved under another created_at must still count as saved
+EXISTING_TWEET_IDS_QUERY = 'SELECT status_id FROM tweets WHERE status_id = ANY($1);'
+
+
+def unsaved_tweet_records(crs, records: List[TweetRecord]) -> List[TweetRecord]:
+    """ The records whose status_id isn't saved yet, under any created_at.  Inserting only these
+        keeps a tweet from getting a second row when it's seen again with another created_at.
+    """
+    if not records:
+        return []
+    execute_prepared(crs, 'existing_tweet_ids', EXISTING_TWEET_IDS_QUERY,
+                     ([record.status_id for record in records], ))
+    existing_ids = {row[0] for row in crs}
+    return [record for record in records if record.status_id not in existing_ids]
+
+
+@reconnecting
 def get_existing_tweet_ids(tweet_ids: List[str]) -> List[str]:
     """ Fetches list of tweet IDs that are already in the database """
     conn = db_conn()
     crs = conn.cursor()
-    crs.execute('SELECT status_id FROM tweets WHERE status_id=ANY(%s)', (tweet_ids,))
+    execute_prepared(crs, 'existing_tweet_ids', EXISTING_TWEET_IDS_QUERY, (list(tweet_ids), ))
     return [row[0] for row in crs]
 
 
+COPY_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+
+
+def copy_text(value) -> str:
+    """ Formats a value as a field of COPY's text format """
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    text = str(value)
+    # Most fields have none of these, and checking first is much cheaper than replacing
+    for char, escaped in COPY_ESCAPES:
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
+
+
+def copy_buffer(records: List[tuple]) -> io.StringIO:
+    """ Formats records as a COPY text stream """
+    return io.StringIO(''.join('\t'.join(map(copy_text, record)) + '\n' for record in records))
+
+
+def copy_records(crs, table: str, columns: tuple, records: List[tuple], kind: str) -> int:
+    """ COPYs records into `table` in the current transaction.  Batches postgres rejects are split
+        in half and retried under savepoints until the bad rows are found, which are logged and
+        skipped.  Returns the number of rows skipped.
+    """
+    if not records:
+        return 0
+    crs.execute('SAVEPOINT copy_records;')
+    try:
+        crs.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN;", copy_buffer(records))
+        skipped = 0
+    except psycopg2.DataError as error:
+        crs.execute('ROLLBACK TO SAVEPOINT copy_records;')
+        if len(records) == 1:
+            logging.error(f"Failed to insert {kind} {records[0][0]}, skipping it: "
+                          f"{str(error).splitlines()[0]}")
+            skipped = 1
+        else:
+            middle = len(records) // 2
+            skipped = (copy_records(crs, table, columns, records[:middle], kind)
+                       + copy_records(crs, table, columns, records[middle:], kind))
+    crs.execute('RELEASE SAVEPOINT copy_records;')
+    return skipped
+
+
+def stage_records(crs, table: str, columns: tuple, records: List[tuple], kind: str) -> str:
+    """ COPYs records into an empty session-private staging copy of `table`, which is unlogged and
+        has no indexes to maintain.  Returns the staging table's name.
+    """
+    staging_table = f'{table}_staging'
+    crs.execute(f"""CREATE TEMPORARY TABLE IF NOT EXISTS {staging_table}
+                    (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;""")
+    crs.execute(f'TRUNCATE {staging_table};')
+    copy_records(crs, staging_table, columns, records, kind)
+    return staging_table
+
+
+def merge_staged(crs, table: str, staging_table: str, columns: tuple, conflict_clause: str,
+                 dedupe=False, returning: str='', then: str=''):
+    """ Moves staged rows into `table`.  Upserts must `dedupe` staged rows by primary key, since
+        postgres refuses to update the same row twice in one statement.  `then` is run in the
+        same statement on the rows actually inserted or updated, which it reads from `merged`
+        with the `returning` columns.
+    """
+    column_list = ', '.join(columns)
+    if dedupe:
+        select = f"""SELECT DISTINCT ON ({columns[0]}) {column_list} FROM {staging_table}
+                     ORDER BY {columns[0]}"""
+    else:
+        select = f"SELECT {column_list} FROM {staging_table}"
+    merge = f"INSERT INTO {table} ({column_list}) {select} ON CONFLICT {conflict_clause}"
+    if then:
+        execute_prepared(crs, f"merge_{staging_table}{'_dedupe' if dedupe else ''}_then",
+                         f"WITH merged AS ({merge} RETURNING {returning}) {then};")
+    else:
+        execute_prepared(crs, f"merge_{staging_table}{'_dedupe' if dedupe else ''}", f"{merge};")
+
+
+def insert_user_records(crs, records: List[tuple]):
+    """ Inserts user records in the current transaction, skipping any that postgres rejects """
+    if not records:
+        return
+    staging_table = stage_records(crs, 'users', USER_COLUMNS, records, 'user')
+    merge_staged(crs, 'users', staging_table, USER_COLUMNS, 'DO NOTHING')
+
+
+@reconnecting
 def save_users(users: List[User]):
     """ Saves users pulled from tweets """
-    query = """INSERT INTO users (user_id, data) VALUES %s ON CONFLICT DO NOTHING;"""
     unique_users = [*toolz.unique(users, key=lambda u: u.id)]
     conn = db_conn()
-    try:
-        crs = conn.cursor()
-        execute_values(crs, query, [*map(user_to_record, unique_users)])
-        conn.commit()
-    except psycopg2.DataError:
-        conn.rollback()
-        crs = conn.cursor()
-        for user in unique_users:
-            try:
-                crs.execute(query, user_to_record(user))
-                conn.commit()
-            except psycopg2.DataError:
-                logging.error('Failed to insert user {}, giving up on them.'.format(user))
-            
+    crs = conn.cursor()
+    insert_user_records(crs, [*map(user_to_record, unique_users)])
+    conn.commit()
+
 
+def is_truncated(tweet: Tweet) -> bool:
+    """ Whether the tweet's full text needs to be re-fetched """
+    return bool(tweet.truncated) or bool(tweet.text and TRUNCATED_TEXT_RE.search(tweet.text))
 
-def tweet_to_record(tweet: Status) -> tuple:
-    """ Converts a tweet to a record that can be saved in postgres """
+
+def tweet_to_record(tweet: Tweet) -> TweetRecord:
+    """ Converts a tweet to a record that can be saved in postgres, with created_at in UTC """
+    if isinstance(tweet, RawTweet):
+        created_at = datetime.utcfromtimestamp(timegm(parsedate(tweet.created_at)))
+        return TweetRecord(str(tweet.id), created_at, tweet.data, tweet.in_reply_to_status_id,
+                           tweet.user['id'] if tweet.user else None,
+                           tweet.user['screen_name'].lower() if tweet.user else None,
+                           is_truncated(tweet))
     json_string = tweet.AsJsonString().replace('\u0000', '')
-    return str(tweet.id), datetime.fromtimestamp(tweet.created_at_in_seconds), json_string
+    return TweetRecord(str(tweet.id), datetime.utcfromtimestamp(tweet.created_at_in_seconds),
+                       json_string, tweet.in_reply_to_status_id,
+                       tweet.user.id if tweet.user else None,
+                       tweet.user.screen_name.lower() if tweet.user else None,
+                       is_truncated(tweet))
+
+
+def with_sentiment(data: str, sentiment: float) -> str:
+    """ Adds a sentiment key to a tweet's JSON object without serializing it again.  A sentiment
+        already there is overridden, since jsonb keeps the last of duplicate keys.
+    """
+    return data[:data.rindex('}')] + ',"sentiment":' + json.dumps(sentiment) + '}'
 
 
-def add_sentiment_to_records(analyzer, records):
-    """ Adds sentiment to records before insertion into postgres """
+def add_sentiment_to_records(analyzer, records: List[TweetRecord]) -> List[TweetRecord]:
+    """ Adds sentiment to records before insertion into postgres, parsing each record once for
+        its text
+    """
     texts = []
-    for tweet_id, created_at, json_string in records:
-        tweet = json.loads(json_string)
+    for record in records:
+        tweet = json.loads(record.data)
         texts.append(tweet.get('text') or tweet.get('full_text'))
 
     sentiments = [*map(float, analyzer.analyze(texts))]
+    return [record._replace(data=with_sentiment(record.data, sentiment))
+            for record, sentiment in zip(records, sentiments)]
+
+
+# Overwritten tweets keep their sentiment score as long as their text stays the same
+KEEP_SENTIMENT = """EXCLUDED.data || CASE
+    WHEN tweets.data ? 'sentiment' AND NOT EXCLUDED.data ? 'sentiment'
+      AND coalesce(tweets.data ->> 'full_text', tweets.data ->> 'text')
+        IS NOT DISTINCT FROM coalesce(EXCLUDED.data ->> 'full_text', EXCLUDED.data ->> 'text')
+    THEN jsonb_build_object('sentiment', tweets.data -> 'sentiment') ELSE '{}' END"""
+
+# Queues merged tweets that have no sentiment score, which are the new ones and overwritten ones
+# whose text changed.  Tweets queued again start over, even if they're being scored.
+MERGED_SENTIMENT_COLUMNS = "status_id, created_at, data ? 'sentiment' AS scored"
+QUEUE_SENTIMENT_QUERY = """
+    INSERT INTO sentiment_queue (status_id, created_at)
+    SELECT status_id, created_at FROM merged WHERE NOT scored
+    ON CONFLICT (status_id) DO UPDATE SET created_at = EXCLUDED.created_at,
+      queued_at = EXCLUDED.queued_at, holder = NULL, leased_until = NULL"""
+
+
+def insert_tweet_records(crs, records: List[TweetRecord], overwrite=False):
+    """ Inserts tweet records in the current transaction, skipping any that postgres rejects """
+    if overwrite:
+        updates = ', '.join([f'data = {KEEP_SENTIMENT}'] + [
+            f'{column} = EXCLUDED.{column}' for column in TWEET_EXTRACTED_COLUMNS])
+        # Bumping observed_at has incremental exports pick up the new version
+        conflict_clause = (f"ON CONSTRAINT tweets_pkey DO UPDATE SET {updates}, "
+                           f"observed_at = (now() at time zone 'utc')")
+    else:
+        conflict_clause = "DO NOTHING"
+    if not records:
+        return
+
+    ensure_tweet_partitions(crs, [record.created_at for record in records])
+    staging_table = stage_records(crs, 'tweets', TWEET_COLUMNS, records, 'tweet')
+    if overwrite:
+        replace_moved_tweets(crs, staging_table)
+    merge_staged(crs, 'tweets', staging_table, TWEET_COLUMNS, conflict_clause, dedupe=overwrite,
+                 returning=MERGED_SENTIMENT_COLUMNS if SENTIMENT_QUEUE else '',
+                 then=QUEUE_SENTIMENT_QUERY if SENTIMENT_QUEUE else '')
+    update_pending_parents(crs, staging_table)
+    if not overwrite:
+        update_account_stats(crs, staging_table)
+
+
+def replace_moved_tweets(crs, staging_table: str):
+    """ Deletes stored versions of staged tweets saved under another created_at, which the
+        primary key can't match, so that overwriting them doesn't leave two rows
+    """
+    execute_prepared(crs, f'replace_moved_{staging_table}', f"""
+        DELETE FROM tweets USING {staging_table} staged
+        WHERE tweets.status_id = staged.status_id AND tweets.created_at <> staged.created_at;""")
+
+
+def month_start(when: datetime) -> datetime:
+    return datetime(when.year, when.month, 1)
 
-    new_records = []
-    for (tweet_id, created_at, json_string), sentiment in zip(records, sentiments):
-        tweet = json.loads(json_string)
-        tweet['sentiment'] = sentiment
-        new_records.append((tweet_id, created_at, json.dumps(tweet)))
 
-    return new_records
+def next_month(month: datetime) -> datetime:
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
 
 
-def save_tweets(tweets: List[Status], overwrite=False, sentiment_analyzer=None):
-    """ Saves a list of tweets to postgres """
-    save_users([t.user for t in tweets])
+def tweet_partition_name(month: datetime) -> str:
+    return f'tweets_{month:%Y_%m}'
+
+
+def is_partitioned(crs, table: str) -> bool:
+    crs.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);", (table, ))
+    row = crs.fetchone()
+    return bool(row and row[0])
+
+
+def create_tweet_partition(crs, month: datetime, table: str='tweets'):
+    """ Adds the partition of a month to `table` in the current transaction, moving any of the
+        month's tweets out of its default partition
+    """
+    partition = tweet_partition_name(month)
+    crs.execute(f"CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS);")
+    crs.execute(f"""WITH moved AS (
+                      DELETE FROM {TWEETS_DEFAULT_PARTITION}
+                      WHERE created_at >= %(start)s AND created_at < %(end)s
+                      RETURNING *)
+                    INSERT INTO {partition} SELECT * FROM moved;""",
+                {'start': month, 'end': next_month(month)})
+    crs.execute(f"ALTER TABLE {table} ATTACH PARTITION {partition} "
+                f"FOR VALUES FROM (%s) TO (%s);", (month, next_month(month)))
+    logging.info(f"Created partition {partition}.")
+
+
+def ensure_tweet_partitions(crs, created_ats: List[datetime]):
+    """ Creates the monthly partitions of tweets that the given times fall in, in the current
+        transaction.  Archived months aren't created again, so their stray tweets land in the
+        default partition.  Does nothing until tweets is partitioned.
+    """
+    months = {month_start(created_at) for created_at in created_ats}.difference(_tweet_partitions)
+    if not months or not is_partitioned(crs, 'tweets'):
+        return
+    # Keeps collectors from adding the same partition at once
+    crs.execute('SELECT pg_advisory_xact_lock(%s);', (PARTITION_LOCK_ID, ))
+    crs.execute("""SELECT months.month FROM unnest(%s::TIMESTAMP[]) AS months (month)
+                   WHERE to_regclass('tweets_' || to_char(months.month, 'YYYY_MM')) IS NULL
+                     AND NOT EXISTS (SELECT 1 FROM tweet_archives
+                                     WHERE tweet_archives.month = months.month);""",
+                (sorted(months), ))
+    for (month, ) in crs.fetchall():
+        create_tweet_partition(crs, month)
+    _tweet_partitions.update(months)
+
+
+def update_account_stats(crs, staging_table: str):
+    """ Adds staged tweets to the hourly counts and decayed tweet counts of their authors, for the
+        screen names in account_stats.  A decayed count weights each tweet by
+        exp(-age / ACCOUNT_RATE_DECAY_HOURS) as of `decayed_at`, so counts as of different times
+        merge by decaying the older one forward.
+    """
+    execute_prepared(crs, f'count_hourly_{staging_table}', f"""
+        INSERT INTO account_hourly_counts (screen_name, hour, tweet_count)
+        SELECT screen_name, date_trunc('hour', created_at), count(*)
+        FROM {staging_table} JOIN account_stats USING (screen_name)
+        GROUP BY 1, 2
+        ON CONFLICT (screen_name, hour) DO UPDATE SET
+          tweet_count = account_hourly_counts.tweet_count + EXCLUDED.tweet_count;""")
+    execute_prepared(crs, f'decay_counts_{staging_table}', f"""
+        UPDATE account_stats SET
+          decayed_count = account_stats.decayed_count * exp(least(EXTRACT(EPOCH FROM
+              coalesce(account_stats.decayed_at, batch.decayed_at) - batch.decayed_at), 0) / $1)
+            + batch.decayed_count * exp(least(EXTRACT(EPOCH FROM
+              batch.decayed_at - coalesce(account_stats.decayed_at, batch.decayed_at)), 0) / $1),
+          decayed_at = greatest(account_stats.decayed_at, batch.decayed_at)
+        FROM (
+          SELECT screen_name, max(newest) AS decayed_at,
+            sum(exp(EXTRACT(EPOCH FROM created_at - newest) / $1)) AS decayed_count
+          FROM (SELECT screen_name, created_at,
+                  max(created_at) OVER (PARTITION BY screen_name) AS newest
+                FROM {staging_table}) staged
+          GROUP BY screen_name
+        ) batch
+        WHERE account_stats.screen_name = batch.screen_name;""",
+                     (ACCOUNT_RATE_DECAY_HOURS * 3600, ))
+
+
+def update_pending_parents(crs, staging_table: str):
+    """ Queues the missing parents of staged tweets and resolves queued parents that were staged """
+    execute_prepared(crs, f'queue_parents_{staging_table}', f"""
+        INSERT INTO pending_parents (status_id, child_created_at)
+        SELECT DISTINCT ON (in_reply_to_status_id) in_reply_to_status_id::TEXT, created_at
+        FROM {staging_table} staged
+        WHERE in_reply_to_status_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM tweets
+                          WHERE tweets.status_id = staged.in_reply_to_status_id::TEXT)
+          AND NOT EXISTS (SELECT 1 FROM inaccessible_tweets
+                          WHERE inaccessible_tweets.status_id = staged.in_reply_to_status_id::TEXT)
+        ORDER BY in_reply_to_status_id, created_at DESC
+        ON CONFLICT (status_id) DO UPDATE SET child_created_at =
+          greatest(pending_parents.child_created_at, EXCLUDED.child_created_at);""")
+    execute_prepared(crs, f'resolve_parents_{staging_table}', f"""
+        DELETE FROM pending_parents USING {staging_table} staged
+        WHERE pending_parents.status_id = staged.status_id;""")
+
+
+def insert_inaccessible_tweet_ids(crs, tweet_ids: List[str]):
+    """ Records inaccessible tweets in the current transaction and resolves them in the
+        pending_parents queue
+    """
+    if not tweet_ids:
+        return
+    tweet_ids = [*map(str, tweet_ids)]
+    execute_prepared(crs, 'insert_inaccessible', """
+        INSERT INTO inaccessible_tweets (status_id) SELECT unnest($1::TEXT[])
+        ON CONFLICT DO NOTHING;""", (tweet_ids, ))
+    execute_prepared(crs, 'resolve_inaccessible',
+                     'DELETE FROM pending_parents WHERE status_id = ANY($1::TEXT[]);',
+                     (tweet_ids, ))
+
+
+def delete_tweet_ids(crs, tweet_ids: List[str]):
+    """ Deletes tweets in the current transaction """
+    if tweet_ids:
+        execute_prepared(crs, 'delete_tweets',
+                         'DELETE FROM tweets WHERE status_id = ANY($1::TEXT[]);',
+                         ([*map(str, tweet_ids)], ))
+
+
+def insert_request_records(crs, records: List[tuple]):
+    """ Inserts (screen name, kind, created at) request records in the current transaction and
+        records the scrapes in account_stats
+    """
+    if records:
+        screen_names, kinds, created_ats = map(list, zip(*records))
+        execute_prepared(crs, 'insert_requests', """
+            INSERT INTO requests (screen_name, kind, created_at)
+            SELECT * FROM unnest($1::TEXT[], $2::TEXT[], $3::TIMESTAMP[]);""",
+                         (screen_names, kinds, created_ats))
+        execute_prepared(crs, 'record_scrapes', """
+            INSERT INTO account_stats (screen_name, last_scraped_at)
+            SELECT screen_name, max(created_at)
+            FROM unnest($1::TEXT[], $2::TIMESTAMP[]) AS scrapes (screen_name, created_at)
+            GROUP BY 1
+            ON CONFLICT (screen_name) DO UPDATE SET last_scraped_at =
+              greatest(account_stats.last_scraped_at, EXCLUDED.last_scraped_at);""",
+                         (screen_names, created_ats))
+
+
+@reconnecting
+def save_tweets(tweets: List[Tweet], overwrite=False, sentiment_analyzer=None):
+    """ Saves a list of tweets and their users to postgres """
+    unique_users = [t.user for t in toolz.unique(tweets, key=tweet_user_id) if t.user]
     unique_tweets = [*toolz.unique(tweets, key=lambda t: t.id)]
     conn = db_conn()
     crs = conn.cursor()
@@ -107,25 +707,178 @@ def save_tweets(tweets: List[Status], overwrite=False, sentiment_analyzer=None):
         logging.info(f"Calculating sentiment for {len(records)} records...")
         records = add_sentiment_to_records(sentiment_analyzer, records)
 
-    if overwrite:
-        conflict_clause = "(status_id) DO UPDATE SET data = EXCLUDED.data"
-    else:
-        conflict_clause = "DO NOTHING"
-
-    execute_values(crs, f"""INSERT INTO tweets (status_id, created_at, data)
-                            VALUES %s ON CONFLICT {conflict_clause};""",
-                   records)
+    if not overwrite:
+        records = unsaved_tweet_records(crs, records)
+    insert_user_records(crs, [*map(user_to_record, unique_users)])
+    insert_tweet_records(crs, records, overwrite)
     conn.commit()
 
 
+class WriteBuffer:
+    """ Collects the tweets, users, requests, high-water marks and inaccessible tweet IDs of a
+        collection run and writes them in batches, one transaction per flush, so marks only
+        advance along with the tweets they cover.  Not thread-safe; use it from the DbWriter
+        thread.
+    """
+
+    def __init__(self, batch_size: int=WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.users = {}  # type: Dict[str, tuple]
+        self.tweets = {}  # type: Dict[str, TweetRecord]
+        self.overwrites = {}  # type: Dict[str, TweetRecord]
+        self.requests = []  # type: List[tuple]
+        self.inaccessible_ids = set()
+        self.deleted_ids = set()
+        self.marks = {}  # type: Dict[tuple, HighWaterMark]
+
+    def __len__(self) -> int:
+        return len(self.tweets) + len(self.overwrites)
+
+    def add_tweets(self, tweets: List[Tweet], overwrite=False):
+        """ Buffers tweets and their users, replacing stored versions if `overwrite` is set """
+        pending = self.overwrites if overwrite else self.tweets
+        for tweet in tweets:
+            pending[str(tweet.id)] = tweet_to_record(tweet)
+            user_id = str(tweet_user_id(tweet))
+            if tweet.user and user_id not in self.users:
+                self.users[user_id] = user_to_record(tweet.user)
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def add_request(self, request: ApiRequest):
+        self.requests.append((request.screen_name, request.request_kind, datetime.utcnow()))
+
+    def set_high_water_mark(self, mark: HighWaterMark):
+        self.marks[mark.screen_name, mark.kind] = mark
+
+    def add_inaccessible_tweet_ids(self, tweet_ids: List[str]):
+        self.inaccessible_ids.update(map(str, tweet_ids))
+
+    def delete_tweets(self, tweet_ids: List[str]):
+        self.deleted_ids.update(map(str, tweet_ids))
+
+    def clear(self):
+        self.users, self.tweets, self.overwrites, self.requests = {}, {}, {}, []
+        self.inaccessible_ids, self.deleted_ids, self.marks = set(), set(), {}
+
+    def flush(self):
+        """ Writes everything buffered in a single transaction """
+        if not (self.tweets or self.overwrites or self.requests or self.inaccessible_ids
+                or self.deleted_ids or self.marks):
+            return
+        try:
+            self._write()
+        finally:
+            self.clear()
+
+    @reconnecting
+    def _write(self):
+        conn = db_conn()
+        crs = conn.cursor()
+        try:
+            with instrument.timed('write', 'dedup'):
+                records = unsaved_tweet_records(crs, list(self.tweets.values()))
+            overwrites = list(self.overwrites.values())
+
+            with instrument.timed('write', 'insert'):
+                # Requests first, so tweets count towards accounts scraped for the first time
+                insert_request_records(crs, self.requests)
+                insert_user_records(crs, list(self.users.values()))
+                insert_tweet_records(crs, records)
+                insert_tweet_records(crs, overwrites, overwrite=True)
+                insert_inaccessible_tweet_ids(crs, list(self.inaccessible_ids))
+                delete_tweet_ids(crs, list(self.deleted_ids))
+                save_high_water_marks(crs, list(self.marks.values()))
+            with instrument.timed('write', 'commit'):
+                conn.commit()
+            for name, count in [('new', len(records)),
+                                ('duplicate', len(self.tweets) - len(records)),
+                                ('overwritten', len(overwrites)),
+                                ('inaccessible', len(self.inaccessible_ids)),
+                                ('deleted', len(self.deleted_ids))]:
+                instrument.increment('tweets', name, count)
+            logging.info(f"Flushed {len(records)} new of {len(self.tweets)} tweets, "
+                         f"{len(overwrites)} overwrites, {len(self.requests)} requests, "
+                         f"{len(self.inaccessible_ids)} inaccessible and "
+                         f"{len(self.deleted_ids)} deleted tweets.")
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            # Partitions created in the transaction went with it
+            _tweet_partitions.clear()
+            raise
+
+
+@reconnecting
 def save_request(request: ApiRequest):
     """ Saves an API request to postgres """
     conn = db_conn()
     crs = conn.cursor()
-    crs.execute("INSERT INTO requests (screen_name, kind) VALUES (%s, %s);", request)
+    insert_request_records(crs, [(request.screen_name, request.request_kind, datetime.utcnow())])
     conn.commit()
 
 
+@reconnecting
+def get_high_water_marks(screen_names: List[str]) -> Dict[tuple, HighWaterMark]:
+    """ High-water marks of the screen names, by (screen name, request kind) """
+    conn = db_conn()
+    crs = conn.cursor()
+    crs.execute("""SELECT screen_name, kind, since_id, gap_since_id, gap_max_id
+                   FROM high_water_marks WHERE screen_name = ANY(%s);""", (list(screen_names), ))
+    marks = [HighWaterMark(*row) for row in crs]
+    conn.commit()
+    return {(mark.screen_name, mark.kind): mark for mark in marks}
+
+
+def save_high_water_marks(crs, marks: List[HighWaterMark]):
+    """ Saves high-water marks in the current transaction.  A mark never moves back, in case
+        another run has advanced it meanwhile.
+    """
+    if not marks:
+        return
+    execute_prepared(crs, 'save_high_water_marks', """
+        INSERT INTO high_water_marks (screen_name, kind, since_id, gap_since_id, gap_max_id)
+        SELECT * FROM unnest($1::TEXT[], $2::TEXT[], $3::BIGINT[], $4::BIGINT[], $5::BIGINT[])
+        ON CONFLICT (screen_name, kind) DO UPDATE SET
+          since_id = greatest(high_water_marks.since_id, EXCLUDED.since_id),
+          gap_since_id = EXCLUDED.gap_since_id, gap_max_id = EXCLUDED.gap_max_id,
+          updated_at = (now() at time zone 'utc');""", tuple(map(list, zip(*marks))))
+
+
+@reconnecting
+def get_rate_limits() -> List[tuple]:
+    """ Rate limit state saved by earlier runs for windows that haven't reset yet, as
+        (endpoint, limit, remaining, reset epoch seconds) tuples.
+    """
+    conn = db_conn()
+    crs = conn.cursor()
+    crs.execute("""SELECT endpoint, "limit", remaining, EXTRACT(EPOCH FROM reset_at)
+                   FROM rate_limits
+                   WHERE collector = %s AND reset_at > (now() at time zone 'utc');""",
+                (COLLECTOR_ID, ))
+    return [(endpoint, limit, remaining, float(reset_at))
+            for endpoint, limit, remaining, reset_at in crs]
+
+
+@reconnecting
+def save_rate_limits(limits: List[tuple]):
+    """ Saves (endpoint, limit, remaining, reset epoch seconds) rate limit state """
+    if not limits:
+        return
+    conn = db_conn()
+    crs = conn.cursor()
+    execute_values(crs, """
+        INSERT INTO rate_limits (collector, endpoint, "limit", remaining, reset_at)
+        VALUES %s
+        ON CONFLICT (collector, endpoint) DO UPDATE SET
+          "limit" = EXCLUDED."limit", remaining = EXCLUDED.remaining,
+          reset_at = EXCLUDED.reset_at, observed_at = (now() at time zone 'utc');""",
+                   [(COLLECTOR_ID, *limit) for limit in limits],
+                   template="(%s, %s, %s, %s, to_timestamp(%s) at time zone 'utc')")
+    conn.commit()
+
+
+@reconnecting
 def prioritize_by_last_scrape(screen_names: List[str]) -> List[str]:
     """ Re-orders provided screen names by collection priority.  Can be based on inferred volume,
         time since last collect, and other metadata.
@@ -140,41 +893,27 @@ def prioritize_by_last_scrape(screen_names: List[str]) -> List[str]:
     return sorted(screen_names, key=lambda sn: requests.get(sn.strip('@').lower(), 0))
 
 
+@reconnecting
 def prioritize_by_uncollected(screen_names: List[str]) -> List[str]:
-    """ Prioritizes by inferring how many tweets have happened since the last scrape for each
-        screen name.
+    """ Prioritizes by estimating how many tweets have happened since the last scrape for each
+        screen name, from the decayed tweet rates in account_stats.  Screen names never scraped
+        come first, then ones with no tweets to estimate from.
     """
     logging.info(f"Prioritizing {len(screen_names)} screen names for scrape...")
     conn = db_conn()
     query = """
-        WITH max_request AS (
-          SELECT max(created_at) AS max_created_at FROM requests
-        ), daily_counts AS (
-          SELECT
-            lower(data #>> '{user,screen_name}') AS screen_name,
-            EXTRACT(EPOCH FROM max(created_at) - min(created_at)) / 86400.0 AS tweet_period,
-            count(*) AS tweet_count
-          FROM tweets
-          WHERE created_at > now() - INTERVAL '1 week'
-          GROUP BY 1
-        ), last_scrapes AS (
-          SELECT
-            screen_name,
-            EXTRACT(EPOCH FROM max_created_at - max(created_at)) / 86400.0 AS scrape_age
-          FROM requests, max_request
-          GROUP BY screen_name, max_created_at
-        )
         SELECT
           screen_name,
-          abs(scrape_age * tweet_count / (tweet_period + 0.0001)) AS missing_tweets,
-          scrape_age,
-          tweet_count,
-          tweet_period
-        FROM daily_counts RIGHT JOIN last_scrapes USING (screen_name)
-        ORDER BY 2 DESC;
+          decayed_count / %(decay_seconds)s
+            * exp(-EXTRACT(EPOCH FROM (now() at time zone 'utc') - decayed_at) / %(decay_seconds)s)
+            * EXTRACT(EPOCH FROM (now() at time zone 'utc') - last_scraped_at) AS missing_tweets
+        FROM account_stats
+        WHERE screen_name = ANY(%(screen_names)s) AND last_scraped_at IS NOT NULL
+        ORDER BY 2 DESC NULLS FIRST;
     """
     crs = conn.cursor()
-    crs.execute(query)
+    crs.execute(query, {'decay_seconds': ACCOUNT_RATE_DECAY_HOURS * 3600,
+                        'screen_names': list(screen_names)})
 
     priortized_sns = [row[0] for row in crs]
 
@@ -183,24 +922,96 @@ def prioritize_by_uncollected(screen_names: List[str]) -> List[str]:
     return [sn for sn in screen_names if sn not in found_sns] + priortized_sns
 
 
+@reconnecting
+def estimate_tweet_rates(screen_names: List[str]) -> Dict[str, float]:
+    """ Current tweets per second of each screen name, from the decayed tweet rates in
+        account_stats.  Screen names with nothing to estimate from are left out.
+    """
+    conn = db_conn()
+    crs = conn.cursor()
+    crs.execute("""
+        SELECT
+          screen_name,
+          decayed_count / %(decay_seconds)s
+            * exp(-EXTRACT(EPOCH FROM (now() at time zone 'utc') - decayed_at) / %(decay_seconds)s)
+        FROM account_stats
+        WHERE screen_name = ANY(%(screen_names)s) AND decayed_at IS NOT NULL;
+    """, {'decay_seconds': ACCOUNT_RATE_DECAY_HOURS * 3600, 'screen_names': list(screen_names)})
+    rates = {screen_name: float(rate) for screen_name, rate in crs}
+    conn.commit()
+    return rates
+
+
+@reconnecting
+def claim_screen_names(screen_names: List[str], limit: int) -> List[str]:
+    """ Leases up to `limit` of the screen names to this collector, taking them in the order
+        given and skipping ones another collector holds.  A collector can renew its own leases.
+    """
+    if not screen_names or limit <= 0:
+        return []
+    conn = db_conn()
+    crs = conn.cursor()
+    crs.execute("""INSERT INTO collection_leases (kind, key)
+                   SELECT 'screen_name', unnest(%s::TEXT[])
+                   ON CONFLICT DO NOTHING;""", (list(screen_names), ))
+    crs.execute("""
+        UPDATE collection_leases
+        SET holder = %(holder)s,
+            leased_until = (now() at time zone 'utc') + %(seconds)s * interval '1 second'
+        WHERE kind = 'screen_name' AND key IN (
+          SELECT key
+          FROM collection_leases JOIN unnest(%(screen_names)s::TEXT[]) WITH ORDINALITY
+            AS queue (key, priority) USING (key)
+          WHERE kind = 'screen_name'
+            AND (leased_until IS NULL OR leased_until < (now() at time zone 'utc')
+                 OR holder = %(holder)s)
+          ORDER BY priority
+          LIMIT %(limit)s
+          FOR UPDATE OF collection_leases SKIP LOCKED
+        )
+        RETURNING key;
+    """, {'holder': COLLECTOR_ID, 'seconds': LEASE_SECONDS, 'screen_names': list(screen_names),
+          'limit': limit})
+    claimed = {row[0] for row in crs}
+    conn.commit()
+    return [screen_name for screen_name in screen_names if screen_name in claimed]
+
+
+@reconnecting
+def prune_leases():
+    """ Deletes leases that have run out """
+    conn = db_conn()
+    crs = conn.cursor()
+    crs.execute("""DELETE FROM collection_leases
+                   WHERE leased_until < (now() at time zone 'utc');""")
+    conn.commit()
+
+
 def estimate_daily_volume(conn) -> Dict[str, float]:
     """ Estimate the number of tweets an account gets a day """
     logging.info(f"Estimating daily volume...")
     query = """
-        WITH last_scrape AS (
-          SELECT screen_name, max(created_at) AS last FROM requests GROUP BY screen_name
-        ), sn_tweets AS (
-          SELECT data #>> '{user,screen_name}' as sn, created_at FROM tweets 
-          ORDER BY created_at DESC LIMIT 200000
-        ) SELECT screen_name, count(*) / 3.0 AS daily_tweets 
-        FROM last_scrape JOIN sn_tweets ON sn ILIKE screen_name 
-        WHERE created_at > last_scrape.last - INTERVAL '3 days' GROUP BY screen_name;  
+        SELECT screen_name, sum(tweet_count) / 3.0 AS daily_tweets
+        FROM account_stats JOIN account_hourly_counts USING (screen_name)
+        WHERE hour > last_scraped_at - INTERVAL '3 days'
+        GROUP BY screen_name;
     """
     crs = conn.cursor()
     crs.execute(query)
     return {sn: daily_count for sn, daily_count in crs}
 
 
+@reconnecting
+def prune_account_stats():
+    """ Deletes hourly tweet counts older than ACCOUNT_HOURLY_COUNT_DAYS """
+    conn = db_conn()
+    crs = conn.cursor()
+    crs.execute("""DELETE FROM account_hourly_counts
+                   WHERE hour < (now() at time zone 'utc') - %s * interval '1 day';""",
+                (ACCOUNT_HOURLY_COUNT_DAYS, ))
+    conn.commit()
+
+
 def days_since_collect(conn, screen_name: str) -> float:
     """ Get the number of days since the screen name has been collected """
     datetime_since = get_all_days_since_collect(conn).get(screen_name.strip('@').lower())
@@ -217,50 +1028,131 @@ def get_all_days_since_collect(conn) -> Dict[str, float]:
     return dict(crs.fetchall())
 
 
-def get_orphaned_tweets() -> List[int]:
-    """ Finds orphaned tweet IDs.  Orphans are tweets we don't have the in-reply-to tweet yet. """
-    no_request_query = """
-        SELECT replies.data->>'in_reply_to_status_id' AS reply_to_id
-        FROM tweets replies LEFT JOIN tweets requests
-          ON replies.data->>'in_reply_to_status_id'=requests.data->>'id'
-        LEFT JOIN inaccessible_tweets
-          ON  replies.data->>'in_reply_to_status_id'::TEXT=inaccessible_tweets.status_id
-        WHERE replies.data->>'in_reply_to_status_id' IS NOT NULL 
-          AND requests.data IS NULL
-          AND inaccessible_tweets.status_id IS NULL
-          AND replies.created_at > (now() - interval '1 day')
-        LIMIT 25000;
+@reconnecting
+def get_orphaned_tweets(limit: int=25000) -> List[str]:
+    """ Claims up to `limit` orphaned tweet IDs from the pending_parents queue, newest replies
+        first.  Orphans are tweets we don't have the in-reply-to tweet yet.  Claims expire after
+        PENDING_CLAIM_MINUTES, so concurrent runs don't fetch the same parents.
+    """
+    claim_query = """
+        UPDATE pending_parents SET claimed_at = (now() at time zone 'utc')
+        WHERE status_id IN (
+          SELECT status_id FROM pending_parents
+          WHERE child_created_at > (now() at time zone 'utc') - interval '1 day'
+            AND (claimed_at IS NULL
+                 OR claimed_at < (now() at time zone 'utc') - %s * interval '1 minute')
+          ORDER BY child_created_at DESC
+          LIMIT %s
+          FOR UPDATE SKIP LOCKED
+        )
+        RETURNING status_id;
     """
 
     conn = db_conn()
     crs = conn.cursor()
-    crs.execute(no_request_query)
-    return [row.reply_to_id for row in crs.fetchall()]
+    crs.execute(claim_query, (PENDING_CLAIM_MINUTES, limit))
+    status_ids = [row.status_id for row in crs.fetchall()]
+    conn.commit()
+    return status_ids
 
 
+@reconnecting
 def save_inaccessible_tweet_ids(tweet_ids: List[str]):
     """ Insert inaccessible tweet IDs into postgres """
     conn = db_conn()
     crs = conn.cursor()
-    execute_values(crs, "INSERT INTO inaccessible_tweets (status_id) VALUES %s",
-                   [(status_id, ) for status_id in tweet_ids])
+    insert_inaccessible_tweet_ids(crs, tweet_ids)
+    conn.commit()
 
 
-def get_truncated_tweets() -> List[int]:
-    """ Finds a list of tweets that have been truncated """
+@reconnecting
+def get_truncated_tweets(limit: int=25000) -> List[str]:
+    """ Finds up to `limit` truncated tweets that need re-fetching, newest first.  They stay
+        flagged until their full versions are saved with `overwrite=True`.
+    """
     conn = db_conn()
     crs = conn.cursor()
-    crs.execute("""SELECT status_id FROM tweets WHERE CAST(data ->> 'truncated' AS boolean)
-                   OR data ->> 'text' ILIKE '%… https://t.co/__________';""")
+    crs.execute("""SELECT status_id FROM tweets WHERE needs_refetch
+                   ORDER BY created_at DESC LIMIT %s;""", (limit, ))
     return [row[0] for row in crs]
 
 
+@reconnecting
+def claim_truncated_tweets(limit: int=25000) -> List[str]:
+    """ Leases up to `limit` truncated tweets that need re-fetching to this collector, newest
+        first, skipping ones another collector holds
+    """
+    conn = db_conn()
+    crs = conn.cursor()
+    crs.execute("""
+        WITH batch AS (
+          SELECT status_id FROM tweets
+          WHERE needs_refetch AND NOT EXISTS (
+            SELECT 1 FROM collection_leases
+            WHERE kind = 'truncated' AND key = status_id
+              AND leased_until > (now() at time zone 'utc'))
+          ORDER BY created_at DESC
+          LIMIT %(limit)s
+          FOR UPDATE SKIP LOCKED
+        )
+        INSERT INTO collection_leases (kind, key, holder, leased_until)
+        SELECT 'truncated', status_id, %(holder)s,
+               (now() at time zone 'utc') + %(seconds)s * interval '1 second'
+        FROM batch
+        ON CONFLICT (kind, key) DO UPDATE SET
+          holder = EXCLUDED.holder, leased_until = EXCLUDED.leased_until
+        WHERE collection_leases.leased_until < (now() at time zone 'utc')
+          OR collection_leases.holder = EXCLUDED.holder
+        RETURNING key;
+    """, {'limit': limit, 'holder': COLLECTOR_ID, 'seconds': LEASE_SECONDS})
+    status_ids = [row[0] for row in crs]
+    conn.commit()
+    return status_ids
+
+
+@reconnecting
 def delete_tweets(ids: List[str]):
     """ Deletes tweets for these tweet status IDs """
     conn = db_conn()
     crs = conn.cursor()
+    delete_tweet_ids(crs, ids)
+    conn.commit()
 
-    array_ids = ', '.join(f"'{_id}'" for _id in ids)
-    crs.execute(f"DELETE FROM tweets WHERE status_id = ANY(ARRAY[{array_ids}]);")
 
-    conn.commit()
+BACKFILL_QUERY = """
+    WITH batch AS (
+      SELECT status_id FROM tweets WHERE status_id > %s ORDER BY status_id LIMIT %s
+    ), backfilled AS (
+      UPDATE tweets SET
+        in_reply_to_status_id = CAST(data ->> 'in_reply_to_status_id' AS BIGINT),
+        user_id = CAST(data #>> '{user,id}' AS BIGINT),
+        screen_name = lower(data #>> '{user,screen_name}'),
+        needs_refetch = coalesce(CAST(data ->> 'truncated' AS boolean), false)
+          OR coalesce(data ->> 'text' ILIKE '%%… https://t.co/__________', false)
+      FROM batch
+      WHERE tweets.status_id = batch.status_id
+        AND (tweets.screen_name IS NULL OR tweets.needs_refetch IS NULL)
+      RETURNING 1
+    )
+    SELECT max(status_id) AS last_status_id, count(*) AS scanned,
+      (SELECT count(*) FROM backfilled) AS updated
+    FROM batch;
+"""
+
+
+def backfill_extracted_columns(batch_size: int=10000) -> int:
+    """ Fills in the extracted tweet columns for rows saved before they existed, committing
+        after each batch of `batch_size` status IDs so it can run next to the collector and be
+        resumed.  Returns the number of rows updated.
+    """
+    conn = db_conn()
+    crs = conn.cursor()
+    last_status_id, total = '', 0
+    while True:
+        crs.execute(BACKFILL_QUERY, (last_status_id, batch_size))
+        last_status_id, scanned, updated = crs.fetchone()
+        conn.commit()
+        total += updated
+        if scanned < batch_size:
+            return total
+        logging.info(f"Backfilled {total} tweets, up to status {last_status_id}...")
@@ -1,13 +1,25 @@
 """ Exports TWCS dataset """
-import csv
+import hashlib
+import json
+import logging
+import multiprocessing
 import os
-import re
+import resource
 import sys
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-import commonregex
 import psycopg2
-import toolz
+from psycopg2.extras import execute_values
+
+import db
+import instrument
+from export_formats import EXPORT_FORMAT, SINKS
+from sanitize import SN_RE, Sanitizer
+from support_accounts import CUSTOMER_SUPPORT_SNS
 
 EXPORT_QUERY = """
     SELECT 
@@ -18,134 +30,651 @@ EXPORT_QUERY = """
       data ->> 'text',
       data ->> 'full_text',
       CAST(data ->> 'in_reply_to_status_id' AS BIGINT)
-    FROM tweets;
+    FROM tweets
+    ORDER BY 1;
 """
 
-CUSTOMER_SUPPORT_SNS = {
-    'nikesupport', 'xboxsupport', 'upshelp', 'comcastcares', 'amazonhelp', 'jetblue', 'americanair',
-    'tacobellteam', 'mcdonalds', 'kimpton', 'ihgservice', 'spotifycares', 'hiltonhelp',
-    'applesupport', 'microsofthelps', 'googleplaymusic', 'scsupport', 'pandorasupport',
-    'hoteltonightcx', 'dunkindonuts', 'jackbox', 'chipotletweets', 'askpanera', 'carlsjr', 'att',
-    'tmobilehelp', 'sprintcare', 'verizonsupport', 'boostcare', 'uscellularcares', 'alaskaair',
-    'virginamerica', 'virginatlantic', 'delta', 'british_airways', 'southwestair', 'awssupport',
-    'twittersupport', 'askplaystation', 'neweggservice', 'dropboxsupport', 'hpsupport',
-    'atviassist', 'azuresupport', 'nortonsupport', 'dellcares', 'hulu_support', 'askrobinhood',
-    'officesupport', 'arbyscares', 'pearsonsupport', 'yahoocare', 'idea_cares', 'airtel_care',
-    'coxhelp', 'kfc_uki_help', 'asurioncares', 'adobecare', 'glocare', 'sizehelpteam',
-    'airasiasupport', 'safaricom_care', 'oppocarein', 'bofa_help', 'chasesupport', 'askciti',
-    'ask_wellsfargo', 'keybank_help', 'moo', 'centurylinkhelp', 'mediatemplehelp', 'godaddyhelp',
-    'postmates_help', 'doordash_help', 'airbnbhelp', 'uber_support', 'asklyft', 'askseagate',
-    'ask_spectrum', 'askpaypal', 'asksalesforce', 'askvirginmoney', 'askdsc', 'askpapajohns',
-    'askrbc', 'askebay', 'asktigogh', 'vmucare', 'askamex', 'ask_progressive', 'mtnc_care',
-    'askvisa', 'tesco', 'sainsburys', 'walmart', 'asktarget', 'morrisons', 'aldiuk', 'argoshelpers',
-    'greggsofficial', 'marksandspencer', 'virgintrains', 'nationalrailenq', 'sw_help',
-    'londonmidland', 'gwrhelp', 'tfl', 'o2'
-}
+INDEX_QUERY = """
+    SELECT
+      CAST(status_id AS BIGINT),
+      CAST(data #>> '{user,id}' AS BIGINT),
+      data #>> '{user,screen_name}',
+      CAST(data ->> 'in_reply_to_status_id' AS BIGINT)
+    FROM tweets
+    ORDER BY 1;
+"""
+
+TEXT_QUERY = """
+    SELECT
+      CAST(status_id AS BIGINT),
+      data #>> '{user,screen_name}',
+      data ->>'created_at',
+      data ->> 'text',
+      data ->> 'full_text'
+    FROM tweets
+    WHERE status_id = ANY(%s);
+"""
+
+# Every screen name mentioned in a tweet.  A superset of the sanitizer's matches, since any @
+# counts, not just ones after a non-word character.
+MENTIONS_QUERY = """
+    SELECT DISTINCT lower(mention[1])
+    FROM tweets, regexp_matches(coalesce(data ->> 'text', '') || ' ' ||
+                                coalesce(data ->> 'full_text', ''), '@([a-zA-Z0-9_]+)', 'g')
+      AS mention;
+"""
+
+CHANGED_QUERY = """
+    SELECT CAST(status_id AS BIGINT) FROM tweets WHERE observed_at > %s AND observed_at <= %s;
+"""
 
 ANON = True
 
+EXPORT_MODE = os.environ.get('EXPORT_MODE', 'memory')
+# Rows pulled per round trip from the server-side cursor in streaming mode
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 50000))
+# Tweets whose text is held in memory at once while writing conversations in streaming mode
+EXPORT_TEXT_BATCH = int(os.environ.get('EXPORT_TEXT_BATCH', 10000))
+# Adds a thread_id column identifying the conversation each tweet belongs to
+EXPORT_THREAD_IDS = os.environ.get('EXPORT_THREAD_IDS', '').lower() in ('1', 'true', 'yes')
+# Worker processes and tweets per shard in parallel mode
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', os.cpu_count() or 1))
+EXPORT_SHARD_SIZE = int(os.environ.get('EXPORT_SHARD_SIZE', 20000))
+# Writes parallel exports as one file per shard plus a manifest into this directory
+EXPORT_SHARD_DIR = os.environ.get('EXPORT_SHARD_DIR')
+# Seconds behind the present the incremental export watermark is kept, so tweets whose inserts
+# were still committing when an export started are picked up by the next one
+EXPORT_WATERMARK_LAG = int(os.environ.get('EXPORT_WATERMARK_LAG', 300))
 
-def export_to(fileio):
-    """ Writes dataset to provided file path """
-    conn = psycopg2.connect(dbname='twitter_cs')
-    crs = conn.cursor()
-    crs.execute(EXPORT_QUERY)
-
-    screen_name_to_id = {}
-    replies = defaultdict(list)
-    unseen_screen_names = defaultdict(lambda: len(unseen_screen_names))
-    tweet_ids = defaultdict(lambda : len(tweet_ids))
-    tweet_ids[None] = ''
-    user_ids = defaultdict(lambda : len(user_ids))
-    header = ['tweet_id', 'author_id', 'inbound', 'created_at', 'text', 'response_tweet_id',
-              'in_response_to_tweet_id']
-    sn_re = re.compile('(\W@|^@)([a-zA-Z0-9_]+)')
-    writer = csv.writer(fileio)
-    writer.writerow(header)
-
-    rows = list(crs)
-    row_dict = {row[0]: row for row in rows}
+HEADER = ['tweet_id', 'author_id', 'inbound', 'created_at', 'text', 'response_tweet_id',
+          'in_response_to_tweet_id']
 
-    for row in rows:
-        # Construct screen name to id mapping and add forward links to replies
-        if isinstance(row[2], str):
-            screen_name_to_id[row[2].lower()] = row[1]
-            if row[6]:
-                replies[row[6]].append(row[0])
+def peak_memory_mb() -> float:
+    """ Peak resident set size of this process in megabytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
 
-    for row in rows:
-        for prefix, sn in sn_re.findall(row[4] or row[5]):
-            _sn = sn.lower()
-            if _sn not in screen_name_to_id:
-                screen_name_to_id[_sn] = unseen_screen_names[_sn]
-                user_ids[unseen_screen_names[_sn]]
 
+class TweetIndex:
+    """ Compact index over every tweet, sorted by tweet ID.  Each tweet costs a few packed int64s
+        instead of a full row, and replies are kept as CSR offsets into `children`.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.authors = array('q')
+        self.parents = array('q')
+        self.parent_positions = array('q')
+        self.companies = bytearray()
+        self.screen_name_to_id = {}
+        self.child_offsets = array('q')
+        self.children = array('q')
+        self.user_ids = array('q')
+        self.missing_parents = array('q')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append(self, tweet_id: int, author_id: Optional[int], screen_name: Optional[str],
+               parent_id: Optional[int]):
+        """ Adds a tweet to the index.  Tweets must be appended in ascending ID order. """
+        if self.ids and tweet_id <= self.ids[-1]:
+            raise ValueError(f'Tweet {tweet_id} appended out of order.')
+        is_company = False
+        if isinstance(screen_name, str):
+            _sn = screen_name.lower()
+            self.screen_name_to_id[_sn] = author_id
+            is_company = _sn in CUSTOMER_SUPPORT_SNS
+        self.ids.append(tweet_id)
+        self.authors.append(author_id or 0)
+        self.parents.append(parent_id or 0)
+        self.companies.append(is_company)
+
+    def find(self, tweet_id: Optional[int]) -> int:
+        """ Position of the tweet ID in the index, or -1 if it isn't there """
+        if not tweet_id:
+            return -1
+        pos = bisect_left(self.ids, tweet_id)
+        return pos if pos < len(self.ids) and self.ids[pos] == tweet_id else -1
+
+    def link_replies(self):
+        """ Resolves parent positions and builds the reply adjacency once all tweets are in """
+        self.parent_positions = array('q', map(self.find, self.parents))
+        offsets = array('q', bytes(8 * (len(self.ids) + 1)))
+        for parent_pos in self.parent_positions:
+            if parent_pos >= 0:
+                offsets[parent_pos + 1] += 1
+        for pos in range(len(self.ids)):
+            offsets[pos + 1] += offsets[pos]
+
+        children = array('q', bytes(8 * offsets[-1]))
+        fill = array('q', offsets)
+        for pos, parent_pos in enumerate(self.parent_positions):
+            if parent_pos >= 0:
+                children[fill[parent_pos]] = pos
+                fill[parent_pos] += 1
+        self.child_offsets = offsets
+        self.children = children
+        self.user_ids = array('q', sorted(set(self.authors)))
+        self.missing_parents = array('q', sorted({
+            parent for parent, parent_pos in zip(self.parents, self.parent_positions)
+            if parent and parent_pos < 0}))
+
+    def replies_to(self, pos: int) -> array:
+        """ Positions of the replies to the tweet at `pos`, in ID order """
+        return self.children[self.child_offsets[pos]:self.child_offsets[pos + 1]]
+
+    def nbytes(self) -> int:
+        """ Approximate size of the packed per-tweet arrays """
+        arrays = [self.ids, self.authors, self.parents, self.parent_positions, self.child_offsets,
+                  self.children, self.user_ids, self.missing_parents]
+        return sum(a.itemsize * len(a) for a in arrays) + len(self.companies)
+
+
+def begin_snapshot(crs, snapshot: Optional[str]=None):
+    """ Starts a REPEATABLE READ transaction, so the index and the texts read later see the same
+        tweets even if some are archived or deleted meanwhile.  Parallel workers join the
+        parent's transaction by importing the `snapshot` it exported.
+    """
+    crs.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+    if snapshot is not None:
+        crs.execute('SET TRANSACTION SNAPSHOT %s;', (snapshot, ))
+
+
+def build_index(conn, chunk_size: int) -> TweetIndex:
+    """ Reads the tweet index through a server-side cursor, `chunk_size` rows at a time """
+    index = TweetIndex()
+    crs = conn.cursor(name='export_index')
+    crs.itersize = chunk_size
+    crs.execute(INDEX_QUERY)
+    for tweet_id, author_id, screen_name, parent_id in crs:
+        index.append(tweet_id, author_id, screen_name, parent_id)
+    crs.close()
+    index.link_replies()
+    return index
+
+
+def iter_threads(index: TweetIndex) -> Iterator[array]:
+    """ Yields the conversation threads worth exporting: connected components of the reply graph
+        that contain a customer support response to a known tweet.  Threads are ordered by root
+        tweet ID, hold positions in depth-first reply order, and every tweet is visited once.
+    """
+    for root in range(len(index)):
+        if index.parent_positions[root] >= 0:
+            continue
+        thread = array('q')
+        has_support_response = False
+        stack = [root]
+        while stack:
+            pos = stack.pop()
+            thread.append(pos)
+            has_support_response = has_support_response or (pos != root and index.companies[pos])
+            stack.extend(reversed(index.replies_to(pos)))
+        if has_support_response:
+            yield thread
+
+
+def load_mentioned_screen_names(crs) -> List[str]:
+    """ Reads every screen name mentioned in the tweets, for numbering ones that aren't authors """
+    crs.execute(MENTIONS_QUERY)
+    return [row[0] for row in crs]
+
+
+def anon_salt() -> bytes:
+    """ Key for ordering unseen screen names, random for each export unless EXPORT_ANON_SALT is
+        set
+    """
+    salt = os.environ.get('EXPORT_ANON_SALT')
+    return hashlib.sha256(salt.encode()).digest() if salt else os.urandom(32)
+
+
+class Anonymizer:
+    """ Assigns anonymous IDs as pure functions of the tweet index.  Tweets are numbered by index
+        position and authors by rank, so any shard of the export can be anonymized on its own and
+        gets the same IDs it would in a serial export.  Mentioned `screen_names` that never
+        authored a tweet are numbered after the authors, in an order shuffled by `salt` so the
+        IDs don't give away the names' alphabetical order.
+    """
+
+    def __init__(self, index: TweetIndex, salt: bytes, screen_names: Iterable[str]):
+        self.index = index
+        unseen = {sn for sn in screen_names if sn not in index.screen_name_to_id}
+        order = sorted(unseen, key=lambda sn: (
+            hashlib.blake2b(sn.encode(), key=salt, digest_size=8).digest(), sn))
+        self.unseen_ids = {sn: len(index.user_ids) + rank for rank, sn in enumerate(order)}
+
+    def tweet_id(self, pos: int) -> int:
+        return pos + 1
+
+    def parent_id(self, pos: int):
+        """ Anonymous ID of the tweet's parent, numbered after the index if it wasn't collected """
+        parent_pos = self.index.parent_positions[pos]
+        if parent_pos >= 0:
+            return parent_pos + 1
+        parent = self.index.parents[pos]
+        if not parent:
+            return ''
+        return len(self.index) + 1 + bisect_left(self.index.missing_parents, parent)
+
+    def user_id(self, author_id: int) -> int:
+        return bisect_left(self.index.user_ids, author_id)
+
+    def screen_name_id(self, screen_name: str) -> int:
+        """ Anonymous user ID for a lowercased screen name mentioned in tweet text """
+        if screen_name in self.index.screen_name_to_id:
+            return self.user_id(self.index.screen_name_to_id[screen_name] or 0)
+        if screen_name not in self.unseen_ids:
+            raise KeyError(f'@{screen_name} is missing from the screen names read with the index')
+        return self.unseen_ids[screen_name]
+
+
+class PersistentAnonymizer:
+    """ Assigns anonymous IDs that stay the same across exports by saving them in postgres.  New
+        tweets, users and mentioned screen names are numbered after the highest saved ID, and
+        screen names of authors share their author's ID.  IDs are cached once looked up, and
+        `prefetch` looks up a batch of tweets' IDs in a few queries.  Keys looked up without a
+        saved ID are remembered too, so they get new IDs without being looked up again.
+    """
+
+    def __init__(self, index: TweetIndex, crs):
+        self.index = index
+        self.crs = crs
+        self.tweet_ids = {}  # type: Dict[int, int]
+        self.user_ids = {}  # type: Dict[int, int]
+        self.screen_name_ids = {}  # type: Dict[str, int]
+        self.looked_up = defaultdict(set)  # type: Dict[str, set]
+        self.new_tweet_ids, self.new_user_ids, self.new_screen_name_ids = [], [], []
+        crs.execute('SELECT coalesce(max(anon_id), 0) FROM export_tweet_ids;')
+        self.next_tweet_id = crs.fetchone()[0] + 1
+        crs.execute("""SELECT greatest(
+                         (SELECT coalesce(max(anon_id), 0) FROM export_user_ids),
+                         (SELECT coalesce(max(anon_id), 0) FROM export_screen_names));""")
+        self.next_user_id = crs.fetchone()[0] + 1
+
+    def _load(self, table: str, key: str, cache: dict, keys: set):
+        looked_up = self.looked_up[table]
+        missing = [k for k in keys if k not in cache and k not in looked_up]
+        if missing:
+            self.crs.execute(f'SELECT {key}, anon_id FROM {table} WHERE {key} = ANY(%s);',
+                             (missing, ))
+            cache.update(self.crs.fetchall())
+            looked_up.update(missing)
+
+    def prefetch(self, positions: List[int], tweets: list):
+        """ Looks up the saved IDs needed to build rows for the tweets at `positions`, given their
+            (screen_name, created_at, text) tuples
+        """
+        index = self.index
+        status_ids, user_ids = set(), set()
+        for pos in positions:
+            status_ids.add(index.ids[pos])
+            status_ids.update(index.ids[reply] for reply in index.replies_to(pos))
+            if index.parents[pos]:
+                status_ids.add(index.parents[pos])
+            user_ids.add(index.authors[pos])
+        screen_names = {match.group(2).lower() for _, _, text in tweets
+                        for match in SN_RE.finditer(text or '')}
+        user_ids.update(index.screen_name_to_id[sn] or 0 for sn in screen_names
+                        if sn in index.screen_name_to_id)
+        self._load('export_tweet_ids', 'status_id', self.tweet_ids, status_ids)
+        self._load('export_user_ids', 'user_id', self.user_ids, user_ids)
+        self._load('export_screen_names', 'screen_name', self.screen_name_ids,
+                   {sn for sn in screen_names if sn not in index.screen_name_to_id})
+
+    def _status_anon_id(self, status_id: int) -> int:
+        if status_id not in self.tweet_ids:
+            self._load('export_tweet_ids', 'status_id', self.tweet_ids, {status_id})
+        if status_id not in self.tweet_ids:
+            self.tweet_ids[status_id] = self.next_tweet_id
+            self.new_tweet_ids.append((status_id, self.next_tweet_id))
+            self.next_tweet_id += 1
+        return self.tweet_ids[status_id]
+
+    def tweet_id(self, pos: int) -> int:
+        return self._status_anon_id(self.index.ids[pos])
+
+    def parent_id(self, pos: int):
+        parent = self.index.parents[pos]
+        return self._status_anon_id(parent) if parent else ''
+
+    def user_id(self, author_id: int) -> int:
+        if author_id not in self.user_ids:
+            self._load('export_user_ids', 'user_id', self.user_ids, {author_id})
+        if author_id not in self.user_ids:
+            self.user_ids[author_id] = self.next_user_id
+            self.new_user_ids.append((author_id, self.next_user_id))
+            self.next_user_id += 1
+        return self.user_ids[author_id]
+
+    def screen_name_id(self, screen_name: str) -> int:
+        """ Anonymous user ID for a lowercased screen name mentioned in tweet text """
+        if screen_name in self.index.screen_name_to_id:
+            return self.user_id(self.index.screen_name_to_id[screen_name] or 0)
+        if screen_name not in self.screen_name_ids:
+            self._load('export_screen_names', 'screen_name', self.screen_name_ids, {screen_name})
+        if screen_name not in self.screen_name_ids:
+            self.screen_name_ids[screen_name] = self.next_user_id
+            self.new_screen_name_ids.append((screen_name, self.next_user_id))
+            self.next_user_id += 1
+        return self.screen_name_ids[screen_name]
+
+    def save(self):
+        """ Saves the IDs assigned during this export in the current transaction """
+        execute_values(self.crs, 'INSERT INTO export_tweet_ids (status_id, anon_id) VALUES %s;',
+                       self.new_tweet_ids)
+        execute_values(self.crs, 'INSERT INTO export_user_ids (user_id, anon_id) VALUES %s;',
+                       self.new_user_ids)
+        execute_values(self.crs,
+                       'INSERT INTO export_screen_names (screen_name, anon_id) VALUES %s;',
+                       self.new_screen_name_ids)
+        logging.info(f"Assigned {len(self.new_tweet_ids)} tweet IDs, {len(self.new_user_ids)} "
+                     f"user IDs and {len(self.new_screen_name_ids)} screen name IDs.")
+
+
+def make_sanitizer(anonymizer: Anonymizer) -> Sanitizer:
+    """ Builds the text anonymization function """
     def replace_sn(sn):
         _sn = sn.group(2).lower()
         if _sn in CUSTOMER_SUPPORT_SNS or _sn.startswith('__') and _sn.endswith('__'):
             return sn.group(1) + sn.group(2)
-        return sn.group(1) + str(user_ids[screen_name_to_id[_sn]])
-
-    sn_sanitize = lambda text: sn_re.sub(replace_sn, text)
-    email_re = re.compile(commonregex.email)
-    email_sanitize = lambda text: email_re.sub('__email__', text)
-    cc_re = re.compile(commonregex.credit_card)
-    cc_sanitize = lambda text: cc_re.sub('__credit_card__', text)
-    btc_re = re.compile(commonregex.btc_address)
-    btc_sanitize = lambda text: btc_re.sub('__btc_wallet__', text)
-    sanitize = toolz.compose(cc_sanitize, btc_sanitize, sn_sanitize, email_sanitize)
-
-    def write_row(row: list):
-        """ Writes tweet to file if it hasn't been written yet. """
-        if row[0] in written_tweet_ids:
-            return
-        is_company = row[2] is not None and row[2].lower() in CUSTOMER_SUPPORT_SNS
-        tweet_id = tweet_ids[row[0]] if ANON else row[0]
-        author_id = (row[2] if is_company else user_ids[row[1]]) if ANON else row[2]
-        inbound = (row[2] is None) or (row[2].lower() not in CUSTOMER_SUPPORT_SNS)
-        created_at = row[3]
-        text = sanitize(row[4] or row[5]) if ANON else row[4] or row[5]
-        response_tweet_ids = ','.join([str(tweet_ids[reply]) for reply in replies[row[0]]]) \
-            if ANON else ','.join(map(str, replies[row[0]]))
-        respond_to_id = tweet_ids[row[6]] if ANON else row[6]
-        writer.writerow([tweet_id, author_id, inbound, created_at, text, response_tweet_ids,
-                         respond_to_id])
-        written_tweet_ids.add(row[0])
-
-    written_tweet_ids = set()
-
-    def walk_conversations_fowards(row: list):
-        """ Walk tweet conversations forward and writes them to file """
-        write_row(row)
-        for reply in replies[row[0]]:
-            if reply not in row_dict:
-                continue
-            _row = row_dict[reply]
-            write_row(_row)
-            walk_conversations_fowards(_row)
-
-    def walk_conversations_backwards(row: list):
-        """ Walks tweet conversations and writes them to file """
-        write_row(row)
-        if row[6] and row[6] in row_dict:
-            walk_conversations_backwards(row_dict[row[6]])
+        return sn.group(1) + str(anonymizer.screen_name_id(_sn))
+
+    return Sanitizer(replace_sn)
+
+
+class RowBuilder:
+    """ Builds output rows for tweets in the index.  Keeps no state between rows, so rows can be
+        built in any order or in separate processes.
+    """
+
+    def __init__(self, index: TweetIndex, anonymizer: Anonymizer):
+        self.index = index
+        self.anonymizer = anonymizer
+        self.sanitize = make_sanitizer(anonymizer)
+
+    def __call__(self, pos: int, thread_id: int, screen_name: Optional[str], created_at: str,
+                 text: str) -> list:
+        """ Output row for the tweet at `pos`, with its reply IDs as a list """
+        index, anonymizer = self.index, self.anonymizer
+        is_company = bool(index.companies[pos])
+        replies = index.replies_to(pos)
+        if ANON:
+            author_id = screen_name if is_company else anonymizer.user_id(index.authors[pos])
+            row = [anonymizer.tweet_id(pos), author_id, not is_company, created_at,
+                   self.sanitize(text), [anonymizer.tweet_id(reply) for reply in replies],
+                   anonymizer.parent_id(pos)]
+        else:
+            row = [index.ids[pos], screen_name, not is_company, created_at, text,
+                   [index.ids[reply] for reply in replies], index.parents[pos] or None]
+        return row + [thread_id] if EXPORT_THREAD_IDS else row
+
+
+def output_header() -> List[str]:
+    return HEADER + ['thread_id'] if EXPORT_THREAD_IDS else HEADER
+
 
+def open_sink(fileio):
+    """ Starts writing the export to the file in EXPORT_FORMAT """
+    return SINKS[EXPORT_FORMAT](fileio, output_header())
+
+
+def iter_batches(index: TweetIndex, batch_size: int,
+                 threads: Optional[Iterator[array]]=None) -> Iterator[Tuple[array, array]]:
+    """ Groups exported threads, or the given `threads`, into batches of at least `batch_size`
+        tweets, except for the last.  Yields (positions, thread IDs) with one entry per tweet.
+    """
+    positions, thread_ids = array('q'), array('q')
+    threads = iter_threads(index) if threads is None else threads
+    for thread_id, thread in enumerate(threads, 1):
+        positions.extend(thread)
+        thread_ids.extend(array('q', [thread_id]) * len(thread))
+        if len(positions) >= batch_size:
+            yield positions, thread_ids
+            positions, thread_ids = array('q'), array('q')
+    if positions:
+        yield positions, thread_ids
+
+
+def write_rows(writer, build_row: RowBuilder, positions: array, thread_ids: array, tweets: list):
+    """ Writes a batch of tweets in conversation order """
+    for pos, thread_id, tweet in zip(positions, thread_ids, tweets):
+        writer.writerow(build_row(pos, thread_id, *tweet))
+
+
+def write_conversations(fileio, index: TweetIndex, screen_names: Iterable[str], load_tweets,
+                        batch_size: int) -> int:
+    """ Writes every exported thread to the file and returns the number of tweets written.
+        `load_tweets` maps a list of index positions to (screen_name, created_at, text) tuples and
+        is called with batches of roughly `batch_size` positions.  `screen_names` must include
+        every screen name mentioned in the texts.
+    """
+    build_row = RowBuilder(index, Anonymizer(index, anon_salt(), screen_names))
+    sink = open_sink(fileio)
+    written = 0
+    for positions, thread_ids in iter_batches(index, batch_size):
+        write_rows(sink, build_row, positions, thread_ids, load_tweets(positions.tolist()))
+        written += len(positions)
+    sink.close()
+    return written
+
+
+def load_tweet_texts(crs, index: TweetIndex, positions: List[int]) -> list:
+    """ Fetches (screen_name, created_at, text) for the tweets at the given index positions """
+    crs.execute(TEXT_QUERY, ([str(index.ids[pos]) for pos in positions], ))
+    texts = {row[0]: row[1:] for row in crs}
+    return [(screen_name, created_at, text or full_text)
+            for screen_name, created_at, text, full_text
+            in (texts[index.ids[pos]] for pos in positions)]
+
+
+def export_to(fileio):
+    """ Writes dataset to provided file path """
+    with db.connection(instrument.TimingCursor) as conn:
+        crs = conn.cursor()
+        begin_snapshot(crs)
+        crs.execute(EXPORT_QUERY)
+        rows = crs.fetchall()
+        screen_names = load_mentioned_screen_names(crs)
+    index = TweetIndex()
     for row in rows:
-        if row[2] is None or row[2].lower() not in CUSTOMER_SUPPORT_SNS or not row[6] or row[6] not in row_dict:
-            # Skip non-customer support response tweets to start each conversation
-            continue
+        index.append(row[0], row[1], row[2], row[6])
+    index.link_replies()
 
-        walk_conversations_fowards(row)
-        walk_conversations_backwards(row)
+    def load_tweets(positions: List[int]) -> list:
+        return [(rows[pos][2], rows[pos][3], rows[pos][4] or rows[pos][5]) for pos in positions]
+
+    written = write_conversations(fileio, index, screen_names, load_tweets, EXPORT_TEXT_BATCH)
+    logging.info(f"Wrote {written} tweets, peak memory {peak_memory_mb():.1f}MB.")
+
+
+def export_streaming(fileio, chunk_size: int=EXPORT_CHUNK_SIZE,
+                     text_batch_size: int=EXPORT_TEXT_BATCH):
+    """ Writes dataset to provided file path without holding every row in memory.  Only the
+        compact tweet index stays resident; text is fetched as conversations are written out.
+    """
+    with db.connection(instrument.TimingCursor) as conn:
+        text_crs = conn.cursor()
+        begin_snapshot(text_crs)
+        logging.info(f"Indexing tweets in chunks of {chunk_size}...")
+        index = build_index(conn, chunk_size)
+        logging.info(f"Indexed {len(index)} tweets into "
+                     f"{index.nbytes() / 2 ** 20:.1f}MB of arrays.")
+        screen_names = load_mentioned_screen_names(text_crs)
+        load_tweets = lambda positions: load_tweet_texts(text_crs, index, positions)
+        written = write_conversations(fileio, index, screen_names, load_tweets, text_batch_size)
+    logging.info(f"Wrote {written} tweets, peak memory {peak_memory_mb():.1f}MB.")
+
+
+def export_incremental(fileio, chunk_size: int=EXPORT_CHUNK_SIZE,
+                       text_batch_size: int=EXPORT_TEXT_BATCH):
+    """ Writes the threads that gained or changed tweets since the last incremental export, with
+        anonymous IDs that are saved and reused across exports.  Each row replaces any row with
+        the same tweet ID from an earlier export, and thread IDs are the anonymous IDs of the
+        threads' first tweets.  The IDs and the new watermark are only saved once the whole file
+        has been written.
+    """
+    with db.connection(instrument.TimingCursor) as conn:
+        crs = conn.cursor()
+        begin_snapshot(crs)
+        # Held until commit, so two incremental exports can't assign the same IDs
+        crs.execute("LOCK TABLE export_state IN EXCLUSIVE MODE NOWAIT;")
+        crs.execute("SELECT watermark FROM export_state WHERE name = 'incremental';")
+        row = crs.fetchone()
+        since = row[0] if row else datetime(1970, 1, 1)
+        crs.execute("SELECT (now() at time zone 'utc') - %s * interval '1 second';",
+                    (EXPORT_WATERMARK_LAG, ))
+        until = crs.fetchone()[0]
+
+        logging.info(f"Indexing tweets in chunks of {chunk_size}...")
+        index = build_index(conn, chunk_size)
+        changed = bytearray(len(index))
+        crs.execute(CHANGED_QUERY, (since, until))
+        for (tweet_id, ) in crs:
+            pos = index.find(tweet_id)
+            if pos >= 0:
+                changed[pos] = 1
+        logging.info(f"Found {sum(changed)} tweets observed between {since} and {until}.")
+
+        anonymizer = PersistentAnonymizer(index, crs)
+        build_row = RowBuilder(index, anonymizer)
+        sink = open_sink(fileio)
+        threads = (thread for thread in iter_threads(index) if any(changed[pos] for pos in thread))
+        written = 0
+        for positions, thread_nums in iter_batches(index, text_batch_size, threads):
+            tweets = load_tweet_texts(crs, index, positions.tolist())
+            anonymizer.prefetch(positions.tolist(), tweets)
+            roots = {}
+            for pos, thread_num in zip(positions, thread_nums):
+                roots.setdefault(thread_num, pos)
+            thread_ids = array('q', (anonymizer.tweet_id(roots[num]) for num in thread_nums))
+            write_rows(sink, build_row, positions, thread_ids, tweets)
+            written += len(positions)
+        sink.close()
+
+        anonymizer.save()
+        crs.execute("""INSERT INTO export_state (name, watermark) VALUES ('incremental', %s)
+                       ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark,
+                         exported_at = (now() at time zone 'utc');""", (until, ))
+        conn.commit()
+    logging.info(f"Wrote {written} tweets, peak memory {peak_memory_mb():.1f}MB.")
+
+
+# Export state inherited by forked workers in parallel mode
+_worker_state = {}
+
+
+def _shard_rows(positions: array, thread_ids: array) -> List[list]:
+    """ Loads and builds the rows of one shard of tweets in a worker process """
+    if 'crs' not in _worker_state:
+        _worker_state['crs'] = db.db_conn().cursor(cursor_factory=instrument.TimingCursor)
+        begin_snapshot(_worker_state['crs'], _worker_state['snapshot'])
+    index, build_row = _worker_state['index'], _worker_state['build_row']
+    tweets = load_tweet_texts(_worker_state['crs'], index, positions.tolist())
+    return [build_row(pos, thread_id, *tweet)
+            for pos, thread_id, tweet in zip(positions, thread_ids, tweets)]
+
+
+def _serialize_shard(task: Tuple[int, array, array]) -> tuple:
+    """ Serializes a shard in EXPORT_FORMAT for the parent to merge """
+    shard_num, positions, thread_ids = task
+    rows = _shard_rows(positions, thread_ids)
+    return len(rows), SINKS[EXPORT_FORMAT].encode_rows(rows, output_header())
+
+
+def _write_shard(task: Tuple[int, array, array]) -> dict:
+    """ Writes a shard to its own file and returns its manifest entry """
+    shard_num, positions, thread_ids = task
+    sink_type = SINKS[EXPORT_FORMAT]
+    filename = f'twcs-{shard_num:05d}.{sink_type.extension}'
+    rows = _shard_rows(positions, thread_ids)
+    with open(os.path.join(_worker_state['shard_dir'], filename),
+              'wb' if sink_type.binary else 'w') as outfile:
+        sink = sink_type(outfile, output_header())
+        for row in rows:
+            sink.writerow(row)
+        sink.close()
+    return {'path': filename, 'rows': len(positions), 'first_thread_id': thread_ids[0],
+            'last_thread_id': thread_ids[-1]}
+
+
+def export_parallel(fileio, chunk_size: int=EXPORT_CHUNK_SIZE, shard_size: int=EXPORT_SHARD_SIZE,
+                    workers: int=EXPORT_WORKERS, shard_dir: Optional[str]=EXPORT_SHARD_DIR):
+    """ Writes dataset to provided file path using a pool of worker processes, each of which
+        fetches, sanitizes and serializes a shard of threads.  Shards are merged in thread order,
+        so the output matches a serial export.  When `shard_dir` is set, shards are instead
+        written there as separate files along with a manifest.
+    """
+    # Kept out of the pool and open until the workers finish, since they read from the snapshot
+    # of its transaction
+    snapshot_conn = psycopg2.connect(dbname=db.DB_NAME, cursor_factory=instrument.TimingCursor)
+    try:
+        crs = snapshot_conn.cursor()
+        begin_snapshot(crs)
+        crs.execute('SELECT pg_export_snapshot();')
+        snapshot = crs.fetchone()[0]
+        logging.info(f"Indexing tweets in chunks of {chunk_size}...")
+        index = build_index(snapshot_conn, chunk_size)
+        screen_names = load_mentioned_screen_names(crs)
+        # Forked workers open connections of their own
+        db.close_pool()
+        written = _export_shards(fileio, index, screen_names, snapshot, shard_size, workers,
+                                 shard_dir)
+    finally:
+        snapshot_conn.close()
+    logging.info(f"Wrote {written} tweets, peak memory {peak_memory_mb():.1f}MB.")
+
+
+def _export_shards(fileio, index: TweetIndex, screen_names: List[str], snapshot: str,
+                   shard_size: int, workers: int, shard_dir: Optional[str]) -> int:
+    """ Exports the index's threads in shards with a pool of workers reading from `snapshot` """
+    logging.info(f"Indexed {len(index)} tweets into {index.nbytes() / 2 ** 20:.1f}MB of arrays.")
+
+    # Workers are forked after this, so they share the index and anonymizer without pickling them
+    _worker_state.update(index=index, shard_dir=shard_dir, snapshot=snapshot,
+                         build_row=RowBuilder(index, Anonymizer(index, anon_salt(), screen_names)))
+    tasks = ((shard_num, positions, thread_ids) for shard_num, (positions, thread_ids)
+             in enumerate(iter_batches(index, shard_size)))
+    logging.info(f"Exporting shards of {shard_size} tweets with {workers} workers...")
+
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        if shard_dir:
+            os.makedirs(shard_dir, exist_ok=True)
+            shards = [*pool.imap(_write_shard, tasks)]
+            written = sum(shard['rows'] for shard in shards)
+            with open(os.path.join(shard_dir, 'manifest.json'), 'w') as manifest:
+                json.dump({'header': output_header(), 'rows': written, 'shards': shards},
+                          manifest, indent=2)
+        else:
+            written = 0
+            sink = open_sink(fileio)
+            for num_rows, chunk in pool.imap(_serialize_shard, tasks):
+                sink.write_chunk(chunk)
+                written += num_rows
+            sink.close()
+    return written
+
+
+EXPORTERS = {
+    'memory': export_to,
+    'stream': export_streaming,
+    'parallel': export_parallel,
+    'incremental': export_incremental,
+}
 
 
 if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(levelname)s:%(asctime)s.%(msecs)03d [%(threadName)s] - %(message)s',
+        datefmt='%Y-%m-%d,%H:%M:%S',
+        level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')))
+    exporter = EXPORTERS[EXPORT_MODE]
     outpath = os.environ.get('OUTFILE')
 
+    binary = SINKS[EXPORT_FORMAT].binary
+
     if outpath:
-        with open(outpath, 'w') as outfile:
-            export_to(outfile)
+        with open(outpath, 'wb' if binary else 'w') as outfile:
+            exporter(outfile)
     else:
-        export_to(sys.stdout)
+        exporter(sys.stdout.buffer if binary else sys.stdout)
 
 
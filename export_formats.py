@@ -0,0 +1,206 @@
+""" Output formats for the TWCS export.  Each sink takes rows built by export.RowBuilder, whose
+    `response_tweet_id` is a list of reply IDs.
+"""
+import csv
+import gzip
+import io
+import os
+from abc import ABC, abstractmethod
+from typing import List, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT', 'csv')
+# Rows per Parquet row group or Arrow record batch, outside of parallel mode's shards
+EXPORT_ROW_GROUP_SIZE = int(os.environ.get('EXPORT_ROW_GROUP_SIZE', 100000))
+# Codec for columnar formats: zstd, gzip, snappy, brotli, lz4 or none for Parquet, and only zstd,
+# lz4 or none for Arrow
+EXPORT_COMPRESSION = os.environ.get('EXPORT_COMPRESSION', 'zstd')
+
+CREATED_AT_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+
+
+def csv_row(row: list) -> list:
+    """ Joins the reply IDs of a row with commas """
+    row = list(row)
+    row[5] = ','.join(map(str, row[5]))
+    return row
+
+
+class CsvSink:
+    """ Writes rows as CSV text """
+    binary = False
+    extension = 'csv'
+
+    def __init__(self, fileio, header: List[str]):
+        self.fileio = fileio
+        self.writer = csv.writer(fileio)
+        self.writer.writerow(header)
+
+    @staticmethod
+    def encode_rows(rows: List[list], header: List[str]) -> str:
+        """ Serializes rows into a chunk for `write_chunk`, e.g. in a worker process """
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(map(csv_row, rows))
+        return buffer.getvalue()
+
+    def writerow(self, row: list):
+        self.writer.writerow(csv_row(row))
+
+    def write_chunk(self, chunk: str):
+        self.fileio.write(chunk)
+
+    def close(self):
+        """ Finishes the output, leaving the file open """
+        self.fileio.flush()
+
+
+class GzipCsvSink(CsvSink):
+    """ Writes rows as gzip-compressed CSV to a binary file """
+    binary = True
+    extension = 'csv.gz'
+
+    def __init__(self, fileio, header: List[str]):
+        self.compressed = gzip.GzipFile(fileobj=fileio, mode='wb')
+        super().__init__(io.TextIOWrapper(self.compressed, encoding='utf-8', newline=''), header)
+
+    def close(self):
+        # Closing the text wrapper closes the gzip stream, but not the underlying file
+        self.fileio.close()
+
+
+class ZstdCsvSink(CsvSink):
+    """ Writes rows as zstd-compressed CSV to a binary file """
+    binary = True
+    extension = 'csv.zst'
+
+    def __init__(self, fileio, header: List[str]):
+        if zstandard is None:
+            raise RuntimeError('Writing zstd-compressed CSV requires the zstandard package.')
+        self.compressed = zstandard.ZstdCompressor().stream_writer(fileio, closefd=False)
+        super().__init__(io.TextIOWrapper(self.compressed, encoding='utf-8', newline=''), header)
+
+    def close(self):
+        self.fileio.close()
+
+
+def arrow_schema(header: List[str]) -> 'pyarrow.Schema':
+    """ Typed schema for the export columns.  Author IDs are strings, since support accounts
+        keep their screen names.
+    """
+    import pyarrow
+    types = {
+        'tweet_id': pyarrow.int64(),
+        'author_id': pyarrow.string(),
+        'inbound': pyarrow.bool_(),
+        'created_at': pyarrow.timestamp('s', tz='UTC'),
+        'text': pyarrow.string(),
+        'response_tweet_id': pyarrow.list_(pyarrow.int64()),
+        'in_response_to_tweet_id': pyarrow.int64(),
+        'thread_id': pyarrow.int64(),
+    }
+    return pyarrow.schema([(name, types[name]) for name in header])
+
+
+class ColumnarSink(ABC):
+    """ Buffers rows and writes them as typed record batches.  pyarrow is imported when a sink is
+        opened, since it takes more memory than the rest of a streaming CSV export.
+    """
+    binary = True
+    # EXPORT_COMPRESSION values the format supports
+    codecs = ()  # type: Tuple[str, ...]
+
+    def __init__(self, fileio, header: List[str]):
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError(f'Writing {self.extension} exports requires the pyarrow package.')
+        if EXPORT_COMPRESSION not in self.codecs:
+            raise ValueError(f"EXPORT_COMPRESSION must be one of {', '.join(self.codecs)} for "
+                             f"{self.extension} exports, not {EXPORT_COMPRESSION!r}.")
+        self.header = header
+        self.schema = arrow_schema(header)
+        self.writer = self.open_writer(fileio)
+        self.pending = []
+
+    @abstractmethod
+    def open_writer(self, fileio):
+        """ Opens the format's writer on the file """
+
+    @staticmethod
+    def encode_rows(rows: List[list], header: List[str]) -> 'pyarrow.RecordBatch':
+        """ Converts rows to a record batch for `write_chunk`, e.g. in a worker process """
+        import pyarrow
+        import pyarrow.compute
+        schema = arrow_schema(header)
+        columns = [*zip(*rows)] if rows else [()] * len(header)
+        arrays = []
+        for name, values in zip(header, columns):
+            if name == 'author_id':
+                values = [*map(str, values)]
+            elif name == 'in_response_to_tweet_id':
+                values = [value if value != '' else None for value in values]
+            elif name == 'response_tweet_id':
+                values = [*map(list, values)]
+            if name == 'created_at':
+                array = pyarrow.compute.strptime(pyarrow.array(values, pyarrow.string()),
+                                                 format=CREATED_AT_FORMAT, unit='s')
+                arrays.append(array.cast(schema.field(name).type))
+            else:
+                arrays.append(pyarrow.array(values, schema.field(name).type))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def writerow(self, row: list):
+        self.pending.append(row)
+        if len(self.pending) >= EXPORT_ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.write_chunk(self.encode_rows(self.pending, self.header))
+            self.pending = []
+
+    def write_chunk(self, batch: 'pyarrow.RecordBatch'):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        """ Writes buffered rows and the file footer, leaving the file open """
+        self.flush()
+        self.writer.close()
+
+
+class ParquetSink(ColumnarSink):
+    """ Writes rows as Parquet, one row group per batch """
+    extension = 'parquet'
+    codecs = ('zstd', 'gzip', 'snappy', 'brotli', 'lz4', 'none')
+
+    def open_writer(self, fileio):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(fileio, self.schema, compression=EXPORT_COMPRESSION)
+
+    def write_chunk(self, batch: 'pyarrow.RecordBatch'):
+        self.writer.write_batch(batch, row_group_size=len(batch))
+
+
+class ArrowSink(ColumnarSink):
+    """ Writes rows as an Arrow IPC file """
+    extension = 'arrow'
+    codecs = ('zstd', 'lz4', 'none')
+
+    def open_writer(self, fileio):
+        import pyarrow.ipc
+        codec = None if EXPORT_COMPRESSION == 'none' else EXPORT_COMPRESSION
+        options = pyarrow.ipc.IpcWriteOptions(compression=codec)
+        return pyarrow.ipc.new_file(fileio, self.schema, options=options)
+
+
+SINKS = {
+    'csv': CsvSink,
+    'csv.gz': GzipCsvSink,
+    'csv.zst': ZstdCsvSink,
+    'parquet': ParquetSink,
+    'arrow': ArrowSink,
+}
@@ -1,50 +1,249 @@
 """ Tools for fetching tweets using the API """
+from contextlib import contextmanager
 from datetime import datetime
 
+import json
+import logging
 import os
-from typing import Optional, List, NamedTuple, Tuple
+import re
+import threading
+import time
+from typing import Optional, List, NamedTuple, Tuple, Union
 
 from retrying import retry
-from twitter import Api, Status
+from twitter import Api, Status, TwitterError
+
+import instrument
+import ratelimit
 
 MAX_FETCH_COUNT = 100
+# Most pages of MAX_FETCH_COUNT tweets fetched from one endpoint for one screen name in a run
+FETCH_MAX_PAGES = int(os.environ.get('FETCH_MAX_PAGES', 10))
+# Base URL of the API, e.g. the local stand-in in bench/fake_api.py.  Defaults to Twitter's.
+TWITTER_API_URL = os.environ.get('TWITTER_API_URL')
+# Keep each tweet's JSON as the API sent it instead of parsing it into a python-twitter Status and
+# serializing that again.  Saved tweets then hold the API's fields rather than python-twitter's.
+RAW_INGEST = os.environ.get('RAW_INGEST', '').lower() in ('1', 'true', 'yes')
 
 ApiRequest = NamedTuple('ApiRequest', [
     ('screen_name', str),
     ('request_kind', str)
 ])
 
+# A tweet kept as the API sent it: the fields collection and the extracted columns need, and the
+# tweet's JSON sliced untouched out of the response
+RawTweet = NamedTuple('RawTweet', [
+    ('id', int),
+    ('created_at', str),
+    ('user', Optional[dict]),
+    ('in_reply_to_status_id', Optional[int]),
+    ('text', Optional[str]),
+    ('truncated', bool),
+    ('data', str),
+])
+
+# NUL characters, escaped in JSON as \u0000, which postgres refuses in jsonb.  An escaped backslash
+# before "u0000" is left alone.
+NUL_ESCAPE_RE = re.compile(rb'(?<!\\)((?:\\\\)*)\\u0000')
+# Start of the tweets in a search response, a key that tweets themselves never have
+STATUSES_START_RE = re.compile(r'"statuses"\s*:\s*\[\s*')
+ARRAY_START_RE = re.compile(r'\s*\[\s*')
+ARRAY_SEPARATOR_RE = re.compile(r'\s*([,\]])\s*')
+
+# Tweets are python-twitter Statuses, or RawTweets with RAW_INGEST
+Tweet = Union[Status, RawTweet]
+
+_decoder = json.JSONDecoder()
+
+
+# Error code the API returns along with a 429 when a rate limit is exceeded
+RATE_LIMIT_EXCEEDED = 88
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """ Whether the API refused the request for exceeding its rate limit """
+    if not isinstance(error, TwitterError):
+        return False
+    messages = error.message if isinstance(error.message, list) else [error.message]
+    return any(isinstance(m, dict) and m.get('code') == RATE_LIMIT_EXCEEDED for m in messages)
+
+
+def retry_if_not_exhausted(error: Exception) -> bool:
+    """ Retry failed requests, but not ones refused because the local budget is spent.  Requests
+        that hit the API's rate limit have emptied their bucket until the window resets, so
+        retrying them waits for the reset or gives up with BudgetExhausted.
+    """
+    return not isinstance(error, ratelimit.BudgetExhausted)
+
+
+@contextmanager
+def tracked_request(api: Api, endpoint: str):
+    """ Feeds the rate limit headers of the API's response to the endpoint's bucket, emptying the
+        bucket until the window resets if the request was refused for exceeding the rate limit.
+        Also records the request's latency and any error with instrument.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        instrument.increment('api_errors', endpoint)
+        if is_rate_limit_error(error):
+            ratelimit.bucket(endpoint).exhaust()
+        raise
+    finally:
+        instrument.record('api', endpoint, time.perf_counter() - start)
+        limit = api.rate_limit.get_limit('{}/{}.json'.format(api.base_url, endpoint))
+        if limit.limit:
+            ratelimit.bucket(endpoint).observe(limit.limit, limit.remaining, limit.reset)
+
+
+_local = threading.local()
+
 
 def get_api() -> Api:
-    """ Memoized constructor for API that pulls secrets from env """
+    """ Memoized constructor for API that pulls secrets from env.  Each thread keeps its own
+        client, since they hold a requests session.
+    """
+    if getattr(_local, 'api', None) is not None:
+        return _local.api
     api = Api(consumer_key=os.environ['TWITTER_CONSUMER_KEY'],
               consumer_secret=os.environ['TWITTER_CONSUMER_SECRET'],
               access_token_key=os.environ['TWITTER_ACCESS_TOKEN'],
               access_token_secret=os.environ['TWITTER_ACCESS_SECRET'],
-              timeout=10)
+              timeout=10,
+              **({'base_url': TWITTER_API_URL} if TWITTER_API_URL else {}))
     api.tweet_mode = 'extended'
+    _local.api = api
     return api
 
 
-@retry(stop_max_attempt_number=5)
-def fetch_tweets_at_user(screen_name: str, since: datetime=datetime(1999, 1, 1)
-                         ) -> Tuple[List[Status], ApiRequest]:
-    """ Fetches the most recent 100 tweets at the provided screen name """
+def scrub_nul_escapes(content: bytes) -> bytes:
+    """ Drops escaped NULs from a JSON response """
+    if b'\\u0000' not in content:
+        return content
+    return NUL_ESCAPE_RE.sub(rb'\1', content)
+
+
+def raw_tweet(tweet: dict, data: str) -> RawTweet:
+    return RawTweet(tweet['id'], tweet['created_at'], tweet.get('user'),
+                    tweet.get('in_reply_to_status_id'), tweet.get('full_text') or tweet.get('text'),
+                    bool(tweet.get('truncated')), data)
+
+
+def parse_raw_tweets(api: Api, content: bytes, search: bool=False) -> List[RawTweet]:
+    """ Splits the tweets out of a response holding an array of them, or a search response,
+        parsing each tweet once and keeping its JSON as sent.  Responses without tweets are left
+        to python-twitter's checks, which raise TwitterError for API errors.
+    """
+    text = scrub_nul_escapes(content).decode('utf-8')
+    start = STATUSES_START_RE.search(text) if search else ARRAY_START_RE.match(text)
+    if start is None:
+        api._ParseAndCheckTwitter(text)
+        return []
+    tweets, pos = [], start.end()
+    if text.startswith(']', pos):
+        return tweets
+    try:
+        while True:
+            tweet, end = _decoder.raw_decode(text, pos)
+            tweets.append(raw_tweet(tweet, text[pos:end]))
+            separator = ARRAY_SEPARATOR_RE.match(text, end)
+            if separator is None:
+                raise ValueError(f'Expected , or ] at character {end}')
+            if separator.group(1) == ']':
+                return tweets
+            pos = separator.end()
+    except (ValueError, KeyError) as error:
+        raise TwitterError({'message': f'Malformed response: {error!r}'})
+
+
+def fetch_raw_tweets(api: Api, endpoint: str, parameters: dict) -> List[RawTweet]:
+    """ Requests tweets from an endpoint through python-twitter's session, keeping the bytes of
+        the response rather than having python-twitter parse it into Statuses
+    """
+    parameters = {key: value for key, value in parameters.items() if value is not None}
+    response = api._RequestUrl(f'{api.base_url}/{endpoint}.json', 'GET', data=parameters)
+    return parse_raw_tweets(api, response.content, search=endpoint == 'search/tweets')
+
+
+@retry(stop_max_attempt_number=5, retry_on_exception=retry_if_not_exhausted)
+def fetch_tweets_at_user(screen_name: str, since: datetime=datetime(1999, 1, 1),
+                         since_id: Optional[int]=None, max_id: Optional[int]=None
+                         ) -> Tuple[List[Tweet], ApiRequest]:
+    """ Fetches the most recent 100 tweets at the provided screen name, newer than `since_id`
+        and no newer than `max_id` if given
+    """
+    ratelimit.acquire('search/tweets')
     api = get_api()
-    return api.GetSearch(term='@{}'.format(screen_name), count=MAX_FETCH_COUNT,
-                         since=since.strftime('%Y-%m-%d')), ApiRequest(screen_name, 'get_ats')
+    with tracked_request(api, 'search/tweets'):
+        if RAW_INGEST:
+            tweets = fetch_raw_tweets(api, 'search/tweets', {
+                'q': '@{}'.format(screen_name), 'count': MAX_FETCH_COUNT,
+                'since': since.strftime('%Y-%m-%d'), 'since_id': since_id, 'max_id': max_id,
+                'result_type': 'mixed'})
+        else:
+            tweets = api.GetSearch(term='@{}'.format(screen_name), count=MAX_FETCH_COUNT,
+                                   since=since.strftime('%Y-%m-%d'), since_id=since_id,
+                                   max_id=max_id)
+        return tweets, ApiRequest(screen_name, 'get_ats')
 
 
-@retry(stop_max_attempt_number=5)
-def fetch_replies_from_user(screen_name: str, since_id: Optional[str]=None
-                            ) -> Tuple[List[Status], ApiRequest]:
-    """ Fetches the most recent 100 replies from the provided screen name """
+@retry(stop_max_attempt_number=5, retry_on_exception=retry_if_not_exhausted)
+def fetch_replies_from_user(screen_name: str, since_id: Optional[int]=None,
+                            max_id: Optional[int]=None) -> Tuple[List[Tweet], ApiRequest]:
+    """ Fetches the most recent 100 replies from the provided screen name, newer than `since_id`
+        and no newer than `max_id` if given
+    """
+    ratelimit.acquire('statuses/user_timeline')
     api = get_api()
-    return api.GetUserTimeline(screen_name=screen_name, exclude_replies=False, since_id=since_id,
-                               count=MAX_FETCH_COUNT), ApiRequest(screen_name, 'get_replies')
+    with tracked_request(api, 'statuses/user_timeline'):
+        if RAW_INGEST:
+            tweets = fetch_raw_tweets(api, 'statuses/user_timeline', {
+                'screen_name': screen_name, 'since_id': since_id, 'max_id': max_id,
+                'count': MAX_FETCH_COUNT, 'include_rts': True, 'trim_user': False,
+                'exclude_replies': False})
+        else:
+            tweets = api.GetUserTimeline(screen_name=screen_name, exclude_replies=False,
+                                         since_id=since_id, max_id=max_id, count=MAX_FETCH_COUNT)
+        return tweets, ApiRequest(screen_name, 'get_replies')
 
 
-@retry(stop_max_attempt_number=5)
-def fetch_tweets_by_id(tweet_ids: List[int]) -> List[Status]:
+def fetch_pages(fetch_page, screen_name: str, since_id: Optional[int]=None,
+                max_id: Optional[int]=None, max_pages: int=FETCH_MAX_PAGES
+                ) -> Tuple[List[Tweet], List[ApiRequest], Optional[int]]:
+    """ Pages back through `fetch_page(screen_name, since_id=, max_id=)` from `max_id`, or the
+        newest tweet, until reaching `since_id`.  Only an empty page is taken as the end, since
+        the API often returns short pages while older tweets remain.  Returns the tweets, the
+        requests made, and the `max_id` to resume from if paging stopped early because of
+        `max_pages`, the rate limit or an error.  Errors on the first page are raised.
+    """
+    tweets, requests = [], []
+    for page_num in range(max_pages):
+        try:
+            page, request = fetch_page(screen_name, since_id=since_id, max_id=max_id)
+        except (TwitterError, ratelimit.BudgetExhausted) as error:
+            if not page_num:
+                raise
+            logging.warning(f"Stopped paging {screen_name} after {page_num} pages: {error!r}")
+            return tweets, requests, max_id
+        requests.append(request)
+        if not page:
+            return tweets, requests, None
+        tweets.extend(page)
+        max_id = min(tweet.id for tweet in page) - 1
+        if since_id is not None and max_id <= since_id:
+            return tweets, requests, None
+    return tweets, requests, max_id
+
+
+@retry(stop_max_attempt_number=5, retry_on_exception=retry_if_not_exhausted)
+def fetch_tweets_by_id(tweet_ids: List[int]) -> List[Tweet]:
     """ Fetches a batch of tweets by ID from the statuses/lookup endpoint """
-    return get_api().LookupStatuses(tweet_ids)
+    ratelimit.acquire('statuses/lookup')
+    api = get_api()
+    with tracked_request(api, 'statuses/lookup'):
+        if RAW_INGEST:
+            return fetch_raw_tweets(api, 'statuses/lookup', {
+                'id': ','.join(map(str, tweet_ids)), 'include_entities': True,
+                'trim_user': False})
+        return api.LookupStatuses(tweet_ids)
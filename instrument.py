@@ -0,0 +1,232 @@
+""" Timing instrumentation for collection runs: time per stage and per screen name, API calls and
+    latencies per endpoint, and SQL time per query, written out as a JSON report and a Prometheus
+    textfile-collector file when the run finishes.
+"""
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+from psycopg2.extensions import cursor
+from psycopg2.extras import NamedTupleCursor
+
+# JSON report written at the end of each run, or nothing if empty
+RUN_REPORT_PATH = os.environ.get('RUN_REPORT_PATH', 'run_report.json')
+# Prometheus textfile-collector file written at the end of each run, or nothing if empty.  Point
+# it into node_exporter's --collector.textfile.directory to scrape it.
+PROMETHEUS_TEXTFILE = os.environ.get('PROMETHEUS_TEXTFILE', 'twcs_collector.prom')
+# Seconds between samples of every thread's stack, or 0 to leave the profiler off
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0))
+# Sampled stacks in the folded format flamegraph.pl and speedscope read
+PROFILE_PATH = os.environ.get('PROFILE_PATH', 'profile.folded')
+
+# Label each kind of timing gets in the Prometheus file.  Per screen name timings are left to the
+# JSON report, since one series per account would swamp Prometheus.
+PROMETHEUS_LABELS = {'stage': 'stage', 'write': 'step', 'api': 'endpoint', 'sql': 'query'}
+
+INLINE_VALUES_RE = re.compile(r'\bVALUES \(.*', re.IGNORECASE)
+
+_timings = defaultdict(lambda: defaultdict(lambda: array('d')))
+_counters = defaultdict(Counter)
+_lock = threading.Lock()
+_run = {}  # type: Dict[str, float]
+_profiler = None  # type: Optional[StackSampler]
+
+
+def record(kind: str, name: str, seconds: float):
+    """ Records one timing, e.g. record('api', 'search/tweets', 0.2) """
+    with _lock:
+        _timings[kind][name].append(seconds)
+
+
+def increment(kind: str, name: str, count: int=1):
+    with _lock:
+        _counters[kind][name] += count
+
+
+@contextmanager
+def timed(kind: str, name: str):
+    """ Records the time spent in the block, whether or not it raises """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, name, time.perf_counter() - start)
+
+
+def stage(name: str):
+    """ Times a stage of the run """
+    return timed('stage', name)
+
+
+def query_label(query) -> str:
+    """ Short, whitespace-collapsed form of a query to group its timings by.  Drops the values
+        execute_values writes into its queries.
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = ' '.join(str(query).split())
+    return INLINE_VALUES_RE.sub('VALUES ...', query)[:80]
+
+
+class TimingCursor(cursor):
+    """ Cursor recording the time of every statement and COPY it sends """
+
+    def execute(self, query, vars=None):
+        with timed('sql', query_label(query)):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with timed('sql', query_label(query)):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        with timed('sql', query_label(sql)):
+            return super().copy_expert(sql, file, size)
+
+
+class NamedTupleTimingCursor(TimingCursor, NamedTupleCursor):
+    """ TimingCursor returning rows as named tuples """
+
+
+def summarize(samples: array) -> dict:
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'seconds': round(sum(ordered), 6),
+        'p50': round(ordered[len(ordered) // 2], 6),
+        'p95': round(ordered[int(len(ordered) * 0.95)], 6),
+        'max': round(ordered[-1], 6),
+    }
+
+
+def report() -> dict:
+    """ Timings and counters recorded since the run started """
+    with _lock:
+        timings = {kind: {name: summarize(samples) for name, samples in names.items()}
+                   for kind, names in _timings.items()}
+        counters = {kind: dict(counts) for kind, counts in _counters.items()}
+    run = dict(_run)
+    if 'started_at' in run:
+        run['started_at'] = datetime.utcfromtimestamp(run['started_at']).isoformat() + 'Z'
+    return {**run, 'timings': timings, 'counters': counters}
+
+
+def prometheus_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(run_report: dict) -> str:
+    """ Formats a run report in the Prometheus text exposition format """
+    lines = [
+        '# HELP twcs_run_duration_seconds Wall time of the last collection run.',
+        '# TYPE twcs_run_duration_seconds gauge',
+        f"twcs_run_duration_seconds {run_report.get('duration_seconds', 0)}",
+        '# HELP twcs_run_success Whether the last collection run finished without an error.',
+        '# TYPE twcs_run_success gauge',
+        f"twcs_run_success {int(run_report.get('succeeded', False))}",
+        '# TYPE twcs_run_finished_timestamp_seconds gauge',
+        f"twcs_run_finished_timestamp_seconds {run_report.get('finished_at', 0)}",
+    ]
+    for kind, label in PROMETHEUS_LABELS.items():
+        timings = run_report['timings'].get(kind, {})
+        for metric, field in [('seconds', 'seconds'), ('calls', 'count')]:
+            lines.append(f'# TYPE twcs_{kind}_{metric} gauge')
+            lines.extend(f'twcs_{kind}_{metric}{{{label}="{prometheus_label(name)}"}} '
+                         f'{summary[field]}'
+                         for name, summary in sorted(timings.items()))
+    for kind, counts in sorted(run_report['counters'].items()):
+        lines.append(f'# TYPE twcs_{kind} gauge')
+        lines.extend(f'twcs_{kind}{{name="{prometheus_label(name)}"}} {count}'
+                     for name, count in sorted(counts.items()))
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomically(path: str, text: str):
+    """ Writes through a temporary file, so readers like node_exporter never see half a file """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as outfile:
+        outfile.write(text)
+    os.replace(temp_path, path)
+
+
+class StackSampler:
+    """ Samples the stack of every thread at an interval, counting identical stacks """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def _run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == self.thread.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}'
+                                 f':{code.co_firstlineno})')
+                    frame = frame.f_back
+                thread_name = names.get(ident, str(ident)).split('_')[0]
+                self.stacks[';'.join([thread_name] + stack[::-1])] += 1
+
+    def start(self) -> 'StackSampler':
+        self.thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+
+def start_run():
+    """ Clears recorded timings and starts the profiler if PROFILE_SAMPLE_INTERVAL is set """
+    global _profiler
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+    _run.clear()
+    _run['started_at'] = time.time()
+    _run['start'] = time.perf_counter()
+    if PROFILE_SAMPLE_INTERVAL > 0:
+        _profiler = StackSampler(PROFILE_SAMPLE_INTERVAL).start()
+
+
+def finish_run(succeeded: bool) -> dict:
+    """ Stops the profiler, writes the run's reports and returns the JSON report """
+    global _profiler
+    elapsed = time.perf_counter() - _run.pop('start', time.perf_counter())
+    _run['duration_seconds'] = round(elapsed, 3)
+    _run['finished_at'] = round(time.time(), 3)
+    _run['succeeded'] = succeeded
+    run_report = report()
+
+    stages = run_report['timings'].get('stage', {})
+    logging.info(f"Run took {run_report['duration_seconds']:.1f}s: " + ', '.join(
+        f"{name} {summary['seconds']:.1f}s" for name, summary in stages.items()))
+    if RUN_REPORT_PATH:
+        write_atomically(RUN_REPORT_PATH, json.dumps(run_report, indent=2) + '\n')
+    if PROMETHEUS_TEXTFILE:
+        write_atomically(PROMETHEUS_TEXTFILE, prometheus_text(run_report))
+    if _profiler is not None:
+        stacks = _profiler.stop()
+        _profiler = None
+        write_atomically(PROFILE_PATH, ''.join(f'{stack} {count}\n'
+                                               for stack, count in stacks.most_common()))
+        logging.info(f"Wrote {sum(stacks.values())} stack samples to {PROFILE_PATH}.")
+    return run_report
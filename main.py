@@ -1,105 +1,350 @@
 import logging
 import os
+import signal
+import threading
+import time
 import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List
 
 import toolz
 from dotenv import load_dotenv
 from twitter import TwitterError
 
-import fetch
-import db
+# Settings are read as modules are imported, so .env has to be loaded first
+load_dotenv('.env')
+
+import fetch  # noqa: E402
+import db  # noqa: E402
+import instrument  # noqa: E402
+import ratelimit  # noqa: E402
+import scheduler  # noqa: E402
+import sentiment  # noqa: E402
+from fetch import ApiRequest, Tweet  # noqa: E402
 
 
 # Rate limit info for app-based access per 15 minute period:
 # search/tweets - 450
 # statuses/lookup - 300
-API_LIMIT = int(os.environ['SCREEN_NAMES_LIMIT'])
+# Per-endpoint budgets are tracked by the token buckets in ratelimit.py, which follow the rate
+# limit headers of each response.  SCREEN_NAMES_LIMIT optionally caps screen names per run.
+API_LIMIT = int(os.environ.get('SCREEN_NAMES_LIMIT', 0))
+# Number of threads making API requests at once
+COLLECTION_WORKERS = int(os.environ.get('COLLECTION_WORKERS', 8))
+# Seconds between the daemon's flushes of buffered writes
+DAEMON_FLUSH_SECONDS = float(os.environ.get('DAEMON_FLUSH_SECONDS', 10))
+# Seconds between the daemon's run reports, saves of rate limit state and schedule updates
+DAEMON_REPORT_SECONDS = float(os.environ.get('DAEMON_REPORT_SECONDS', 300))
+# Seconds the daemon waits to look for orphaned or truncated tweets again after finding none
+DAEMON_IDLE_SECONDS = float(os.environ.get('DAEMON_IDLE_SECONDS', 60))
 
 
-def main():
-    """ Run the collector """
-    load_dotenv('.env')
-    logging.basicConfig(
-        format='%(levelname)s:%(asctime)s.%(msecs)03d [%(threadName)s] - %(message)s',
-        datefmt='%Y-%m-%d,%H:%M:%S',
-        level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')))
+def save_new_tweets(buffer: db.WriteBuffer, tweets: List[Tweet], requests: List[ApiRequest],
+                    mark: db.HighWaterMark):
+    """ Buffers the requests, their tweets and the high-water mark they advance to.  Runs on the DB
+        writer.
+    """
+    logging.info(f"Buffering {len(requests)} {mark.kind} requests with {len(tweets)} tweets...")
+    for request in requests:
+        buffer.add_request(request)
+    buffer.add_tweets(tweets)
+    buffer.set_high_water_mark(mark)
+
+
+def save_orphans(buffer: db.WriteBuffer, tweet_ids: List[str], tweets: List[Tweet]):
+    """ Buffers fetched orphan parents and marks the rest inaccessible.  Runs on the DB writer. """
+    inaccessible_tweets = {*map(int, tweet_ids)}.difference({int(t.id) for t in tweets})
+    logging.info(f"Buffering {len(tweets)} tweets and {len(inaccessible_tweets)} inaccessible...")
+    buffer.add_inaccessible_tweet_ids(list(inaccessible_tweets))
+    buffer.add_tweets(tweets)
+
+
+def save_refetched_tweets(buffer: db.WriteBuffer, tweet_ids: List[str], tweets: List[Tweet]):
+    """ Overwrites truncated tweets with their full versions and deletes ones that have gone
+        missing.  Runs on the DB writer.
+    """
+    inaccessible_tweets = {*map(int, tweet_ids)}.difference({int(t.id) for t in tweets})
+    logging.info(f"Buffering {len(tweets)} full tweets and {len(inaccessible_tweets)} deletions...")
+    buffer.delete_tweets(list(map(str, inaccessible_tweets)))
+    buffer.add_tweets(tweets, overwrite=True)
+
+
+def collect_pages(writer: db.DbWriter, fetch_page, mark: db.HighWaterMark, max_pages: int
+                  ) -> db.HighWaterMark:
+    """ Fetches the tweets newer than the high-water mark, then any gap an earlier run left, and
+        queues them to be saved along with the advanced mark, which is returned
+    """
+    tweets, requests, resume_max_id = fetch.fetch_pages(
+        fetch_page, mark.screen_name, since_id=mark.since_id, max_pages=max_pages)
+    since_id = max([mark.since_id or 0] + [tweet.id for tweet in tweets]) or None
+    if resume_max_id is not None:
+        if mark.gap_max_id is not None:
+            logging.warning(f"Giving up on {mark.kind} tweets for {mark.screen_name} between "
+                            f"{mark.gap_since_id} and {mark.gap_max_id}.")
+        mark = mark._replace(gap_since_id=mark.since_id, gap_max_id=resume_max_id)
+    elif mark.gap_max_id is not None and len(requests) < max_pages:
+        try:
+            gap_tweets, gap_requests, resume_max_id = fetch.fetch_pages(
+                fetch_page, mark.screen_name, since_id=mark.gap_since_id,
+                max_id=mark.gap_max_id, max_pages=max_pages - len(requests))
+        except (TwitterError, ratelimit.BudgetExhausted) as error:
+            logging.warning(f"Leaving the {mark.kind} gap for {mark.screen_name}: {error!r}")
+        else:
+            tweets, requests = tweets + gap_tweets, requests + gap_requests
+            mark = mark._replace(gap_max_id=resume_max_id,
+                                 gap_since_id=mark.gap_since_id if resume_max_id else None)
+    mark = mark._replace(since_id=since_id)
+    writer.submit(save_new_tweets, writer.buffer, tweets, requests, mark)
+    return mark
+
+
+def collect_screen_name(writer: db.DbWriter, screen_name: str,
+                        marks: Dict[tuple, db.HighWaterMark], max_pages: Dict[str, int]):
+    """ Fetches replies from and tweets at the screen name since its high-water marks, queues
+        them to be saved and advances the marks
+    """
+    clean_sn = screen_name.strip('@').lower()
+    logging.info(f"Collecting tweets for {screen_name}...")
+
+    with instrument.timed('screen_name', clean_sn):
+        for kind, fetch_page, description in [
+                ('get_replies', fetch.fetch_replies_from_user, 'replies from'),
+                ('get_ats', fetch.fetch_tweets_at_user, 'tweets at')]:
+            mark = marks.get((clean_sn, kind), db.HighWaterMark(clean_sn, kind, None, None, None))
+            try:
+                marks[clean_sn, kind] = collect_pages(writer, fetch_page, mark, max_pages[kind])
+            except TwitterError:
+                logging.error(f"Failed to fetch {description} {screen_name}:")
+                traceback.print_exc()
+
+    logging.info(f"Finished collection for {screen_name}.")
+
+
+def lookup_tweets(writer: db.DbWriter, save, tweet_ids: List[str]):
+    """ Fetches a batch of tweets by ID and queues `save(buffer, tweet_ids, tweets)` """
+    logging.info(f"Fetching {len(tweet_ids)} tweets by ID...")
+    tweets = fetch.fetch_tweets_by_id(tweet_ids)
+    writer.submit(save, writer.buffer, tweet_ids, tweets)
+
+
+def log_failure(future: Future, name: str):
+    """ Logs the error a finished job failed with, if any, so one failing job doesn't stop the
+        others or keep the daemon from rescheduling its account
+    """
+    try:
+        future.result()
+    except ratelimit.BudgetExhausted as error:
+        logging.warning(f"No {error} requests left this window, skipping.")
+    except TwitterError:
+        logging.error(f"Failed to run {name}:")
+        traceback.print_exc()
+    except Exception:
+        logging.exception(f"Failed to run {name} with an unexpected error")
+
+
+def run_concurrently(pool: ThreadPoolExecutor, func, arg_lists: List[tuple]):
+    """ Runs `func` over each argument list on the pool and waits for them all to finish """
+    futures = [pool.submit(func, *args) for args in arg_lists]
+    for future in futures:
+        log_failure(future, func.__name__)
+
+
+def screen_name_budget() -> int:
+    """ Number of screen names the remaining search and timeline budgets can collect """
+    budget = min(ratelimit.bucket('search/tweets').available(),
+                 ratelimit.bucket('statuses/user_timeline').available())
+    return min(budget, API_LIMIT) if API_LIMIT else budget
+
 
+def pages_per_screen_name(endpoint: str, num_screen_names: int) -> int:
+    """ Pages each screen name may fetch from the endpoint, sharing out its remaining budget """
+    available = ratelimit.bucket(endpoint).available()
+    return max(1, min(fetch.FETCH_MAX_PAGES, available // max(num_screen_names, 1)))
+
+
+def run_collection():
+    """ Collects the monitored screen names, then the orphaned and truncated tweets """
     logging.info("Starting twitter scrape...")
     monitored_screen_names = [sn.strip('@').lower()
                               for sn in os.environ['MONITORED_SCREEN_NAMES'].split(',')]
-    screen_names_to_collect = db.prioritize_by_uncollected(monitored_screen_names)[:API_LIMIT]
-    logging.info(f'Collecting the following screen names: {", ".join(screen_names_to_collect)}')
+    with instrument.stage('prioritize'):
+        ratelimit.restore(db.get_rate_limits())
+        screen_names_to_collect = db.claim_screen_names(
+            db.prioritize_by_uncollected(monitored_screen_names), screen_name_budget())
+        logging.info(f'Collecting the following screen names: '
+                     f'{", ".join(screen_names_to_collect)}')
+        marks = db.get_high_water_marks(screen_names_to_collect)
+        max_pages = {kind: pages_per_screen_name(endpoint, len(screen_names_to_collect))
+                     for kind, endpoint in [('get_replies', 'statuses/user_timeline'),
+                                            ('get_ats', 'search/tweets')]}
 
-    for screen_name in screen_names_to_collect:
-        clean_sn = screen_name.strip('@').lower()
-        last_scraped_at = db.last_scraped_at(clean_sn)
-        logging.info(f"Collecting tweets for {screen_name}...")
+    writer = db.DbWriter(db.WriteBuffer())
+    lookups = ratelimit.bucket('statuses/lookup')
+    with ThreadPoolExecutor(COLLECTION_WORKERS, thread_name_prefix='collector') as pool:
+        with instrument.stage('collect'):
+            run_concurrently(pool, collect_screen_name, [(writer, sn, marks, max_pages)
+                                                         for sn in screen_names_to_collect])
+        with instrument.stage('collect_flush'):
+            writer.drain()
 
-        try:
-            tweets, request = fetch.fetch_replies_from_user(clean_sn, )
-            logging.info(f"Removing old tweets from {len(tweets)} fetched...")
-            old_tweet_ids = set(db.get_existing_tweet_ids([str(t.id) for t in tweets]))
-            new_tweets = [t for t in tweets if str(t.id) not in old_tweet_ids]
-            logging.info("Saving replies request...")
-            db.save_request(request)
-            logging.info(f"Saving {len(new_tweets)} tweets...")
-            db.save_tweets(new_tweets)
-            logging.info("Finished saving replies.")
-        except TwitterError:
-            logging.error(f"Failed to fetch replies from {screen_name}:")
-            traceback.print_exc()
+        with instrument.stage('orphans'):
+            logging.info("Fetching orphaned tweets...")
+            orphaned_tweet_ids = db.get_orphaned_tweets(100 * lookups.available())
+            orphan_batches = [*toolz.partition_all(100, orphaned_tweet_ids)]
+            run_concurrently(pool, lookup_tweets,
+                             [(writer, save_orphans, tweet_ids) for tweet_ids in orphan_batches])
+            writer.drain()
 
-        try:
-            tweets, request = fetch.fetch_tweets_at_user(clean_sn, since=last_scraped_at)
-            logging.info(f"Removing old tweets from {len(tweets)} fetched...")
-            old_tweet_ids = set(db.get_existing_tweet_ids([str(t.id) for t in tweets]))
-            new_tweets = [t for t in tweets if str(t.id) not in old_tweet_ids]
-            logging.info("Saving ats request...")
-            db.save_request(request)
-            logging.info(f"Saving {len(new_tweets)} tweets...")
-            db.save_tweets(new_tweets)
-        except TwitterError:
-            logging.error(f"Failed to fetch tweets at {screen_name}:")
-            traceback.print_exc()
-
-        logging.info(f"Finished collection for {screen_name}.")
-
-    logging.info("Fetching orphaned tweets...")
-    orphaned_tweet_ids = set(db.get_orphaned_tweets())
-    orphan_batches = [*toolz.take(250, toolz.partition_all(100, orphaned_tweet_ids))]
-
-    for tweet_ids in orphan_batches:
-        logging.info(f"Fetching {len(tweet_ids)} orphans from twitter...")
-        tweets = fetch.fetch_tweets_by_id(tweet_ids)
-        inaccessible_tweets = {*map(int, tweet_ids)}.difference({int(t.id) for t in tweets})
-        logging.info(f"Saving {len(inaccessible_tweets)} inaccessible tweets...")
-        db.save_inaccessible_tweet_ids(list(inaccessible_tweets))
-        logging.info(f"Saving {len(tweets)} tweets...")
-        db.save_tweets(tweets)
-
-    truncated_tweets = db.get_truncated_tweets()
-    logging.info(f"Found {len(truncated_tweets)} truncated tweets that need re-fetching.")
-    remaining_fetches = 250 - len(orphan_batches)
-    truncate_batches = [*toolz.take(remaining_fetches, toolz.partition_all(100, truncated_tweets))]
-    try:
-        for tweet_ids in truncate_batches:
-            logging.info(f"Fetching {len(tweet_ids)} truncated tweets...")
-            tweets = fetch.fetch_tweets_by_id(tweet_ids)
-            inaccessible_tweets = {*map(int, tweet_ids)}.difference({int(t.id) for t in tweets})
-            if inaccessible_tweets:
-                logging.info(f"Deleting {len(inaccessible_tweets)} missing tweets...")
-                db.delete_tweets(list(map(str, inaccessible_tweets)))
-
-            if tweets:
-                logging.info(f"Saving {len(tweets)} tweets...")
-                db.save_tweets(tweets, overwrite=True)
+        with instrument.stage('truncated'):
+            truncated_tweets = db.claim_truncated_tweets(100 * lookups.available())
+            logging.info(f"Found {len(truncated_tweets)} truncated tweets that need re-fetching.")
+            truncate_batches = [*toolz.partition_all(100, truncated_tweets)]
+            run_concurrently(pool, lookup_tweets, [(writer, save_refetched_tweets, tweet_ids)
+                                                   for tweet_ids in truncate_batches])
+            writer.close()
+
+    db.save_rate_limits(ratelimit.snapshot())
+    db.prune_account_stats()
+    db.prune_leases()
+
+
+def refresh_schedule(schedule: scheduler.Scheduler):
+    """ Updates the schedule from the accounts' current tweet rates and the rate limits """
+    rates = db.estimate_tweet_rates(list(schedule.intervals))
+    schedule.update(rates, min(ratelimit.bucket(endpoint).rate
+                               for endpoint in ['search/tweets', 'statuses/user_timeline']))
+
+
+def checkpoint(writer: db.DbWriter):
+    """ Writes everything buffered, saves the rate limit state and starts a new run report """
+    writer.drain()
+    db.save_rate_limits(ratelimit.snapshot())
+    db.prune_account_stats()
+    db.prune_leases()
+    instrument.finish_run(True)
+    instrument.start_run()
+
+
+def run_daemon(stopping: threading.Event):
+    """ Collects each monitored screen name whenever the schedule says it's due and its lease can
+        be claimed, until `stopping` is set.  Workers left free by the schedule fetch orphaned and
+        truncated tweets, one batch of each at a time, with the lookup budget.  With
+        SENTIMENT_ANALYZER set, a background thread scores the sentiment queue meanwhile.
+    """
+    logging.info("Starting twitter collection daemon...")
+    monitored_screen_names = [sn.strip('@').lower()
+                              for sn in os.environ['MONITORED_SCREEN_NAMES'].split(',')]
+    ratelimit.restore(db.get_rate_limits())
+    schedule = scheduler.Scheduler(db.prioritize_by_uncollected(monitored_screen_names))
+    marks = {}  # type: Dict[tuple, db.HighWaterMark]
+    writer = db.DbWriter(db.WriteBuffer())
+    timelines, searches, lookups = map(ratelimit.bucket, ['statuses/user_timeline',
+                                                          'search/tweets', 'statuses/lookup'])
+    lookup_jobs = {'orphans': save_orphans, 'truncated': save_refetched_tweets}
+    idle_until = dict.fromkeys(lookup_jobs, 0.0)
+    running = {}  # type: Dict[Future, tuple]
+    flushed_at = checkpointed_at = time.time()
+    refresh_schedule(schedule)
+    # Scores queued tweets alongside collection if an analyzer is configured
+    scorer = threading.Thread(target=sentiment.run_worker, args=(stopping, ), name='sentiment',
+                              daemon=True)
+    if sentiment.SENTIMENT_ANALYZER:
+        if not db.SENTIMENT_QUEUE:
+            logging.warning("SENTIMENT_ANALYZER is set but SENTIMENT_QUEUE is off, so only tweets "
+                            "already queued will be scored.")
+        scorer.start()
+
+    with ThreadPoolExecutor(COLLECTION_WORKERS, thread_name_prefix='collector') as pool:
+        while not stopping.is_set():
+            now = time.time()
+            if now - checkpointed_at >= DAEMON_REPORT_SECONDS:
+                checkpoint(writer)
+                refresh_schedule(schedule)
+                checkpointed_at = flushed_at = now
+            elif now - flushed_at >= DAEMON_FLUSH_SECONDS:
+                writer.submit(writer.buffer.flush)
+                flushed_at = now
+
+            due = []
+            while (len(running) + len(due) < COLLECTION_WORKERS
+                   and len(due) < min(timelines.available(), searches.available())):
+                screen_name = schedule.pop_due(now)
+                if screen_name is None:
+                    break
+                due.append(screen_name)
+            claimed = db.claim_screen_names(due, len(due))
+            # Marks may have moved on while other collectors held the screen names
+            marks.update(db.get_high_water_marks(claimed) if claimed else {})
+            for screen_name in set(due).difference(claimed):
+                schedule.reschedule(screen_name, now)
+            for screen_name in claimed:
+                max_pages = {kind: pages_per_screen_name(endpoint, len(schedule))
+                             for kind, endpoint in [('get_replies', 'statuses/user_timeline'),
+                                                    ('get_ats', 'search/tweets')]}
+                future = pool.submit(collect_screen_name, writer, screen_name, marks, max_pages)
+                running[future] = ('collect', screen_name)
+
+            busy = {kind for kind, _ in running.values()}
+            for kind, save in lookup_jobs.items():
+                if (len(running) >= COLLECTION_WORKERS or kind in busy or idle_until[kind] > now
+                        or not lookups.available()):
+                    continue
+                if kind == 'orphans':
+                    tweet_ids = db.get_orphaned_tweets(100)
+                else:
+                    tweet_ids = db.claim_truncated_tweets(100)
+                if not tweet_ids:
+                    idle_until[kind] = now + DAEMON_IDLE_SECONDS
+                    continue
+                running[pool.submit(lookup_tweets, writer, save, tweet_ids)] = (kind, None)
+
+            next_due = schedule.next_due()
+            timeout = min(1.0, max(next_due - now, 0.01)) if next_due is not None else 1.0
+            if running:
+                wait(running, timeout, return_when=FIRST_COMPLETED)
             else:
-                logging.info('No tweetse to save.')
+                stopping.wait(timeout)
+            for future in [future for future in running if future.done()]:
+                kind, screen_name = running.pop(future)
+                log_failure(future, kind)
+                if screen_name is not None:
+                    schedule.reschedule(screen_name, time.time())
+
+        logging.info(f"Stopping, waiting for {len(running)} jobs to finish...")
+        for future, (kind, _) in running.items():
+            log_failure(future, kind)
+    writer.close()
+    if scorer.is_alive():
+        scorer.join()
+    db.save_rate_limits(ratelimit.snapshot())
 
-    except TwitterError:
-        logging.error(f"Failed to fetch truncated tweets.")
-        traceback.print_exc()
 
+def main():
+    """ Run the collector """
+    logging.basicConfig(
+        format='%(levelname)s:%(asctime)s.%(msecs)03d [%(threadName)s] - %(message)s',
+        datefmt='%Y-%m-%d,%H:%M:%S',
+        level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')))
+
+    # 'daemon' keeps collecting until SIGTERM, anything else makes a single pass
+    daemon = os.environ.get('COLLECTION_MODE', 'once') == 'daemon'
+    stopping = threading.Event()
+    if daemon:
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(signum, lambda signum, frame: stopping.set())
+        # The daemon has no next run to leave requests to
+        ratelimit.wait_for_reset()
+
+    instrument.start_run()
+    succeeded = False
+    try:
+        if daemon:
+            run_daemon(stopping)
+        else:
+            run_collection()
+        succeeded = True
+    finally:
+        instrument.finish_run(succeeded)
     logging.info("Done!")
 
 
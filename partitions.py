@@ -0,0 +1,367 @@
+""" Maintenance of the monthly partitions of tweets.  `migrate` moves a database from before
+    tweets was partitioned over to a partitioned table in batches, while the collector keeps
+    running.  `archive` dumps months older than the retention period to compressed CSV files and
+    drops them.  `dedupe` drops extra rows of tweets saved under more than one created_at, and
+    `utc` moves tweets saved with a local created_at to their UTC one.
+
+    $ PYTHONPATH=$(pwd) python3.6 partitions.py migrate
+    $ PYTHONPATH=$(pwd) python3.6 partitions.py dedupe
+    $ PYTHONPATH=$(pwd) python3.6 partitions.py utc
+    $ PYTHONPATH=$(pwd) python3.6 partitions.py archive [months to keep]
+"""
+import gzip
+import logging
+import os
+import re
+import sys
+from datetime import datetime
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Settings are read as modules are imported, so .env has to be loaded first
+load_dotenv('.env')
+
+import db  # noqa: E402
+
+# Tweets copied per transaction by `migrate`
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 10000))
+# Months of tweets `archive` keeps, counting the current one
+TWEET_RETENTION_MONTHS = int(os.environ.get('TWEET_RETENTION_MONTHS', 24))
+# Directory `archive` writes dumps to
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+# Compression of archived months, zstd or gzip.  zstd needs the zstandard package.
+ARCHIVE_COMPRESSION = os.environ.get('ARCHIVE_COMPRESSION', 'zstd' if zstandard else 'gzip')
+
+# Partitioned table the migration fills, renamed to tweets once it's caught up
+MIGRATION_TABLE = 'tweets_partitioned'
+# Suffix of the migration table's indexes until they take over the names of the old table's
+MIGRATION_SUFFIX = '_partitioned'
+TABLE_IN_INDEX_RE = re.compile(r' ON (\w+\.)?tweets ')
+PARTITION_NAME_RE = re.compile(r'^tweets_(\d{4})_(\d{2})$')
+
+MIGRATE_BATCH_QUERY = f"""
+    WITH batch AS (
+      SELECT * FROM tweets WHERE status_id > %s ORDER BY status_id LIMIT %s
+    ), copied AS (
+      INSERT INTO {MIGRATION_TABLE} SELECT * FROM batch WHERE created_at IS NOT NULL
+      ON CONFLICT DO NOTHING
+      RETURNING 1
+    )
+    SELECT max(status_id) AS last_status_id, count(*) AS scanned,
+      (SELECT count(*) FROM copied) AS copied
+    FROM batch;
+"""
+
+# Keeps the most recently observed row of each tweet, only joining the status IDs with more than
+# one row
+DEDUPE_QUERY = """
+    WITH duplicated AS (
+      SELECT status_id FROM tweets GROUP BY status_id HAVING count(*) > 1
+    )
+    DELETE FROM tweets stale USING duplicated, tweets kept
+    WHERE stale.status_id = duplicated.status_id AND kept.status_id = duplicated.status_id
+      AND (stale.observed_at, stale.created_at) < (kept.observed_at, kept.created_at);
+"""
+
+# created_at as the tweet's own data has it, in UTC whatever the server's time zone
+UTC_BATCH_QUERY = """
+    SELECT status_id, created_at, (data ->> 'created_at')::TIMESTAMPTZ AT TIME ZONE 'utc' AS utc
+    FROM tweets WHERE status_id > %s ORDER BY status_id LIMIT %s;
+"""
+# Bumping observed_at has incremental exports pick up the new created_at
+MOVE_TO_UTC_QUERY = """
+    WITH moves AS (
+      SELECT * FROM unnest(%s::TEXT[], %s::TIMESTAMP[], %s::TIMESTAMP[])
+        AS moves (status_id, created_at, utc)
+    ), moved AS (
+      UPDATE tweets SET created_at = moves.utc, observed_at = (now() at time zone 'utc')
+      FROM moves
+      WHERE tweets.status_id = moves.status_id
+        AND tweets.created_at IS NOT DISTINCT FROM moves.created_at
+      RETURNING tweets.status_id, tweets.created_at
+    ), requeued AS (
+      UPDATE sentiment_queue SET created_at = moved.created_at FROM moved
+      WHERE sentiment_queue.status_id = moved.status_id
+    )
+    SELECT count(*) FROM moved;
+"""
+
+
+def months_before(month: datetime, count: int) -> datetime:
+    months = month.year * 12 + month.month - 1 - count
+    return datetime(months // 12, months % 12 + 1, 1)
+
+
+def table_indexes(crs, table: str) -> List[Tuple[str, str]]:
+    """ (name, definition) of each index on the table """
+    crs.execute("""SELECT indexname, indexdef FROM pg_indexes
+                   WHERE schemaname = current_schema() AND tablename = %s;""", (table, ))
+    return [(name, definition) for name, definition in crs.fetchall()]
+
+
+def start_migration(conn) -> bool:
+    """ Creates the partitioned table with partitions for every month tweets has and the same
+        indexes, unless a migration has already started.  Returns False if tweets is already
+        partitioned.
+    """
+    crs = conn.cursor()
+    if db.is_partitioned(crs, 'tweets'):
+        return False
+    crs.execute("""CREATE TABLE IF NOT EXISTS tweet_partition_migration (
+                     started_at TIMESTAMP, last_status_id TEXT);""")
+    crs.execute("SELECT 1 FROM tweet_partition_migration;")
+    if crs.fetchone():
+        conn.commit()
+        return True
+
+    logging.info(f"Creating {MIGRATION_TABLE}...")
+    crs.execute(f"""CREATE TABLE {MIGRATION_TABLE} (LIKE tweets INCLUDING DEFAULTS)
+                    PARTITION BY RANGE (created_at);""")
+    crs.execute(f"""ALTER TABLE {MIGRATION_TABLE} ADD CONSTRAINT tweets_pkey{MIGRATION_SUFFIX}
+                    PRIMARY KEY (status_id, created_at);""")
+    crs.execute(f"CREATE TABLE {db.TWEETS_DEFAULT_PARTITION} PARTITION OF {MIGRATION_TABLE} "
+                f"DEFAULT;")
+    crs.execute("SELECT min(created_at) AS first, max(created_at) AS last FROM tweets;")
+    first, last = crs.fetchone()
+    now = datetime.utcnow()
+    # Through next month, so tweets collected during the migration have partitions too
+    month = db.month_start(first or now)
+    until = db.next_month(db.month_start(max(last or now, now)))
+    while month <= until:
+        db.create_tweet_partition(crs, month, MIGRATION_TABLE)
+        month = db.next_month(month)
+    for name, definition in table_indexes(crs, 'tweets'):
+        if name != 'tweets_pkey':
+            logging.info(f"Creating index {name}{MIGRATION_SUFFIX}...")
+            definition = definition.replace(f'INDEX {name} ', f'INDEX {name}{MIGRATION_SUFFIX} ', 1)
+            crs.execute(TABLE_IN_INDEX_RE.sub(f' ON {MIGRATION_TABLE} ', definition, count=1))
+    # Rows the collector deletes or moves to another created_at after they've been copied have to
+    # be removed from the copy too
+    crs.execute("CREATE TABLE tweet_partition_migration_removals (status_id TEXT, "
+                "created_at TIMESTAMP);")
+    crs.execute("""CREATE FUNCTION record_tweet_partition_migration_removal() RETURNS TRIGGER AS $$
+                   BEGIN
+                     IF TG_OP = 'DELETE' OR OLD.created_at IS DISTINCT FROM NEW.created_at THEN
+                       INSERT INTO tweet_partition_migration_removals
+                       VALUES (OLD.status_id, OLD.created_at);
+                     END IF;
+                     RETURN NULL;
+                   END $$ LANGUAGE plpgsql;""")
+    crs.execute("""CREATE TRIGGER tweet_partition_migration_removal
+                   AFTER DELETE OR UPDATE OF created_at ON tweets FOR EACH ROW
+                   EXECUTE PROCEDURE record_tweet_partition_migration_removal();""")
+    crs.execute("""INSERT INTO tweet_partition_migration (started_at, last_status_id)
+                   VALUES ((now() at time zone 'utc'), '');""")
+    conn.commit()
+    return True
+
+
+def copy_batches(conn, batch_size: int):
+    """ Copies tweets into the partitioned table in batches of `batch_size` status IDs,
+        committing the position after each so the copy can be resumed
+    """
+    crs = conn.cursor()
+    crs.execute("SELECT last_status_id FROM tweet_partition_migration;")
+    last_status_id, total = crs.fetchone()[0], 0
+    while True:
+        crs.execute(MIGRATE_BATCH_QUERY, (last_status_id, batch_size))
+        batch_last_status_id, scanned, copied = crs.fetchone()
+        if batch_last_status_id is not None:
+            last_status_id = batch_last_status_id
+            crs.execute("UPDATE tweet_partition_migration SET last_status_id = %s;",
+                        (last_status_id, ))
+        conn.commit()
+        total += copied
+        if scanned < batch_size:
+            return
+        logging.info(f"Copied {total} tweets, up to status {last_status_id}...")
+
+
+def finish_migration(conn):
+    """ Blocks writes to tweets while removing the copies of tweets deleted or moved since the
+        migration started and copying the tweets saved or changed since, then swaps the
+        partitioned table in.  The old table is kept as tweets_unpartitioned.
+    """
+    crs = conn.cursor()
+    crs.execute("LOCK TABLE tweets IN SHARE ROW EXCLUSIVE MODE;")
+    crs.execute("SELECT started_at FROM tweet_partition_migration;")
+    started_at = crs.fetchone()[0]
+    crs.execute("""SELECT DISTINCT date_trunc('month', created_at) AS month FROM tweets
+                   WHERE observed_at >= %s AND created_at IS NOT NULL;""", (started_at, ))
+    for (month, ) in crs.fetchall():
+        crs.execute('SELECT to_regclass(%s);', (db.tweet_partition_name(month), ))
+        if crs.fetchone()[0] is None:
+            db.create_tweet_partition(crs, month, MIGRATION_TABLE)
+    crs.execute(f"""DELETE FROM {MIGRATION_TABLE} copied
+                    USING tweet_partition_migration_removals removed
+                    WHERE copied.status_id = removed.status_id
+                      AND copied.created_at = removed.created_at;""")
+    logging.info(f"Removed {crs.rowcount} tweets deleted or moved during the migration.")
+    updates = ', '.join(f'{column} = EXCLUDED.{column}'
+                        for column in ('observed_at', ) + db.TWEET_COLUMNS[2:])
+    crs.execute(f"""INSERT INTO {MIGRATION_TABLE}
+                    SELECT * FROM tweets WHERE observed_at >= %s AND created_at IS NOT NULL
+                    ON CONFLICT (status_id, created_at) DO UPDATE SET {updates};""",
+                (started_at, ))
+    logging.info(f"Copied {crs.rowcount} tweets saved during the migration.")
+
+    crs.execute("SELECT count(*) FROM tweets WHERE created_at IS NULL;")
+    skipped = crs.fetchone()[0]
+    if skipped:
+        logging.warning(f"Left out {skipped} tweets without a created_at.")
+    for name, _ in table_indexes(crs, 'tweets'):
+        crs.execute(f"ALTER INDEX {name} RENAME TO {name}_unpartitioned;")
+    crs.execute("ALTER TABLE tweets RENAME TO tweets_unpartitioned;")
+    crs.execute(f"ALTER TABLE {MIGRATION_TABLE} RENAME TO tweets;")
+    for name, _ in table_indexes(crs, 'tweets'):
+        if name.endswith(MIGRATION_SUFFIX):
+            crs.execute(f"ALTER INDEX {name} RENAME TO {name[:-len(MIGRATION_SUFFIX)]};")
+    crs.execute("DROP TRIGGER tweet_partition_migration_removal ON tweets_unpartitioned;")
+    crs.execute("DROP FUNCTION record_tweet_partition_migration_removal();")
+    crs.execute("DROP TABLE tweet_partition_migration, tweet_partition_migration_removals;")
+    conn.commit()
+
+
+def migrate(batch_size: int=MIGRATION_BATCH_SIZE):
+    """ Moves tweets over to a partitioned table.  Can be stopped and run again, and the
+        collector can keep running until the final swap, which briefly blocks its writes.
+        Collectors need restarting afterwards to pick up the new table's partitions.
+    """
+    conn = db.db_conn()
+    if not start_migration(conn):
+        logging.info("tweets is already partitioned.")
+        return
+    copy_batches(conn, batch_size)
+    finish_migration(conn)
+    logging.info("tweets is now partitioned.  The old table is kept as tweets_unpartitioned, "
+                 "drop it once you're happy with the new one.")
+
+
+def dedupe():
+    """ Drops all but the most recently observed row of tweets saved under more than one
+        created_at, which earlier versions could do and which breaks exports
+    """
+    conn = db.db_conn()
+    crs = conn.cursor()
+    crs.execute(DEDUPE_QUERY)
+    logging.info(f"Dropped {crs.rowcount} duplicate tweets.")
+    conn.commit()
+
+
+def move_to_utc(batch_size: int=MIGRATION_BATCH_SIZE):
+    """ Sets each tweet's created_at to the UTC time in its data, for tweets saved by earlier
+        versions, which stored the collector's local time.  Runs `dedupe` first, since a tweet
+        saved under both would otherwise end up with two rows of the same key.  Goes through
+        tweets in batches of `batch_size` status IDs, and can be stopped and run again.
+    """
+    dedupe()
+    conn = db.db_conn()
+    crs = conn.cursor()
+    last_status_id, total = '', 0
+    while True:
+        crs.execute(UTC_BATCH_QUERY, (last_status_id, batch_size))
+        batch = crs.fetchall()
+        if not batch:
+            conn.commit()
+            break
+        last_status_id = batch[-1].status_id
+        moves = [row for row in batch if row.created_at != row.utc]
+        if moves:
+            db.ensure_tweet_partitions(crs, [row.utc for row in moves])
+            crs.execute(MOVE_TO_UTC_QUERY, ([row.status_id for row in moves],
+                                            [row.created_at for row in moves],
+                                            [row.utc for row in moves]))
+            total += crs.fetchone()[0]
+        conn.commit()
+        if len(batch) < batch_size:
+            break
+        logging.info(f"Moved {total} tweets to UTC, up to status {last_status_id}...")
+    logging.info(f"Moved {total} tweets to UTC.")
+
+
+def open_archive(path: str):
+    """ Binary file compressing what's written to it """
+    if ARCHIVE_COMPRESSION == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Archiving with zstd compression requires the zstandard package.')
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return gzip.open(path, 'wb')
+
+
+def dump_partition(crs, table: str, path: str) -> int:
+    """ Writes the table as compressed CSV with a header, through a temporary file so a dump is
+        never left half written.  Returns the number of rows written.
+    """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open_archive(temp_path) as outfile:
+        crs.copy_expert(f"COPY {table} TO STDOUT WITH (FORMAT csv, HEADER);", outfile)
+        rows = crs.rowcount
+    os.replace(temp_path, path)
+    return rows
+
+
+def archive(keep_months: int=TWEET_RETENTION_MONTHS, archive_dir: str=ARCHIVE_DIR):
+    """ Detaches the partitions of months before the last `keep_months`, dumps them into
+        `archive_dir` and drops them.  Months are recorded in tweet_archives when they are
+        detached, so the collector doesn't create them again, and an interrupted archive picks
+        up where it stopped.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = months_before(db.month_start(datetime.utcnow()), keep_months - 1)
+    extension = 'zst' if ARCHIVE_COMPRESSION == 'zstd' else 'gz'
+    conn = db.db_conn()
+    crs = conn.cursor()
+    crs.execute("""SELECT child.relname FROM pg_inherits
+                   JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                   WHERE pg_inherits.inhparent = 'tweets'::regclass;""")
+    partitions = [row[0] for row in crs.fetchall()]
+    conn.commit()
+    for partition in sorted(partitions):
+        match = PARTITION_NAME_RE.match(partition)
+        if not match or datetime(int(match.group(1)), int(match.group(2)), 1) >= cutoff:
+            continue
+        logging.info(f"Detaching {partition}...")
+        crs.execute(f"ALTER TABLE tweets DETACH PARTITION {partition};")
+        crs.execute("""INSERT INTO tweet_archives (month, path) VALUES (%s, %s)
+                       ON CONFLICT (month) DO UPDATE SET path = EXCLUDED.path;""",
+                    (datetime(int(match.group(1)), int(match.group(2)), 1),
+                     os.path.join(archive_dir, f'{partition}.csv.{extension}')))
+        conn.commit()
+
+    # Also finishes months detached by an earlier, interrupted archive
+    crs.execute("""SELECT month, path FROM tweet_archives
+                   WHERE to_regclass('tweets_' || to_char(month, 'YYYY_MM')) IS NOT NULL
+                   ORDER BY month;""")
+    detached = crs.fetchall()
+    conn.commit()
+    for month, path in detached:
+        partition = db.tweet_partition_name(month)
+        rows = dump_partition(crs, partition, path)
+        crs.execute(f"DROP TABLE {partition};")
+        crs.execute("UPDATE tweet_archives SET row_count = %s WHERE month = %s;", (rows, month))
+        conn.commit()
+        logging.info(f"Archived {rows} tweets from {partition} to {path}.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(levelname)s:%(asctime)s.%(msecs)03d [%(threadName)s] - %(message)s',
+        datefmt='%Y-%m-%d,%H:%M:%S',
+        level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')))
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'migrate':
+        migrate()
+    elif command == 'dedupe':
+        dedupe()
+    elif command == 'utc':
+        move_to_utc()
+    elif command == 'archive':
+        archive(int(sys.argv[2]) if len(sys.argv) > 2 else TWEET_RETENTION_MONTHS)
+    else:
+        sys.exit(__doc__)
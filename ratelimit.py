@@ -0,0 +1,161 @@
+""" Token buckets enforcing the Twitter API's per-endpoint rate limits """
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Length of the Twitter API rate limit window
+WINDOW_SECONDS = 15 * 60
+
+# Requests per window assumed for each endpoint until the API reports its actual limits,
+# overridable from the environment.  Lookups keep some headroom below the 300 allowed for
+# app-based access.
+DEFAULT_LIMITS = {
+    'search/tweets': ('SEARCH_RATE_LIMIT', 450),
+    'statuses/user_timeline': ('TIMELINE_RATE_LIMIT', 1500),
+    'statuses/lookup': ('LOOKUP_RATE_LIMIT', 250),
+}
+
+
+# Seconds a request waits for a spent budget when RATE_LIMIT_WAIT isn't set.  One-shot runs skip
+# the request until the next run, so they finish within their cron slot, and daemon mode waits
+# for the window to reset with `wait_for_reset`.
+_default_wait = 0.0
+
+
+class BudgetExhausted(Exception):
+    """ Raised when an endpoint has no requests left in the current window """
+
+
+class TokenBucket:
+    """ Thread-safe token bucket holding up to `capacity` requests.  Until the API has reported
+        the endpoint's rate limit it refills evenly over the window; after that it follows the
+        reported remaining calls and refills in full when the reported window resets.
+    """
+
+    def __init__(self, capacity: int, window: float=WINDOW_SECONDS):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = float(capacity)
+        self.reset_at = None  # type: Optional[float]
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        if self.reset_at is None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        elif now >= self.reset_at:
+            self.tokens = float(self.capacity)
+            self.reset_at = None
+        self.updated_at = now
+
+    def _seconds_until_token(self) -> float:
+        if self.reset_at is not None:
+            return max(self.reset_at - time.time(), 0)
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+    def available(self) -> int:
+        """ Number of requests that can be made right now """
+        with self.lock:
+            self._refill()
+            return int(self.tokens)
+
+    def acquire(self, timeout: float=0) -> bool:
+        """ Takes a token, waiting up to `timeout` seconds for one to refill """
+        deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = self._seconds_until_token()
+            if time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def observe(self, limit: int, remaining: int, reset_at: float):
+        """ Syncs the bucket with the limit, remaining calls and reset time (epoch seconds) the
+            API reported for the endpoint.
+        """
+        with self.lock:
+            self._refill()
+            if reset_at <= time.time():
+                return
+            if reset_at != self.reset_at:
+                # First report for this window, calls made before it are already counted
+                self.tokens = float(remaining)
+            else:
+                self.tokens = min(self.tokens, float(remaining))
+            self.capacity = limit
+            self.rate = limit / WINDOW_SECONDS
+            self.reset_at = reset_at
+
+    def exhaust(self):
+        """ Empties the bucket until the window resets, assuming a full window if the reset time
+            isn't known.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = 0.0
+            if self.reset_at is None:
+                self.reset_at = time.time() + WINDOW_SECONDS
+
+    def state(self) -> Tuple[int, int, Optional[float]]:
+        """ The bucket's (limit, remaining, reset time) """
+        with self.lock:
+            self._refill()
+            return self.capacity, int(self.tokens), self.reset_at
+
+
+_buckets = {}  # type: Dict[str, TokenBucket]
+_buckets_lock = threading.Lock()
+
+
+def bucket(endpoint: str) -> TokenBucket:
+    """ Shared bucket for the endpoint, created from the environment on first use """
+    with _buckets_lock:
+        if endpoint not in _buckets:
+            env_var, default = DEFAULT_LIMITS[endpoint]
+            _buckets[endpoint] = TokenBucket(int(os.environ.get(env_var, default)))
+        return _buckets[endpoint]
+
+
+def reset():
+    """ Forgets every bucket, so they are created again from the environment """
+    with _buckets_lock:
+        _buckets.clear()
+
+
+def wait_for_reset():
+    """ Has requests that find their budget spent wait for the window to reset by default """
+    global _default_wait
+    _default_wait = WINDOW_SECONDS
+
+
+def acquire(endpoint: str):
+    """ Takes a request from the endpoint's budget.  If it's spent, waits for RATE_LIMIT_WAIT
+        seconds if that's set, and otherwise not at all, or for the window to reset after
+        `wait_for_reset`.  Raises BudgetExhausted if no request frees up in time.
+    """
+    wait = os.environ.get('RATE_LIMIT_WAIT')
+    if not bucket(endpoint).acquire(_default_wait if wait is None else float(wait)):
+        raise BudgetExhausted(endpoint)
+
+
+def restore(limits: List[Tuple[str, int, int, float]]):
+    """ Seeds buckets from saved (endpoint, limit, remaining, reset time) rate limit state """
+    for endpoint, limit, remaining, reset_at in limits:
+        if endpoint in DEFAULT_LIMITS:
+            bucket(endpoint).observe(limit, remaining, reset_at)
+
+
+def snapshot() -> List[Tuple[str, int, int, float]]:
+    """ (endpoint, limit, remaining, reset time) for every bucket the API has reported on """
+    with _buckets_lock:
+        buckets = list(_buckets.items())
+    states = [(endpoint, endpoint_bucket.state()) for endpoint, endpoint_bucket in buckets]
+    return [(endpoint, *state) for endpoint, state in states if state[2] is not None]
@@ -0,0 +1,54 @@
+""" Redaction of personal information from tweet text """
+import re
+from typing import Callable, Match
+
+import commonregex
+
+EMAIL_RE = re.compile(commonregex.email)
+SN_RE = re.compile('(\W@|^@)([a-zA-Z0-9_]+)')
+BTC_RE = re.compile(commonregex.btc_address)
+CC_RE = re.compile(commonregex.credit_card)
+
+# Characters that may precede the @ of an email address, mentions are preceded by anything else.
+# The pattern is case insensitive, so this includes the non-ASCII letters that fold into a-z.
+EMAIL_LOCAL_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                              "0123456789!#$%&'*+/=?^_`{|.}~-\u0130\u0131\u017f\u212a")
+
+# Both credit card number forms contain eight digits with at most one separator after the fourth
+CC_PROBE_RE = re.compile(r'\d{4}[- ]?\d{4}')
+
+
+def may_contain_email(text: str, at: int) -> bool:
+    """ Whether any @ from position `at` on could be part of an email address """
+    while at >= 0:
+        if at > 0 and text[at - 1] in EMAIL_LOCAL_CHARS and text.find('.', at) >= 0:
+            return True
+        at = text.find('@', at + 1)
+    return False
+
+
+class Sanitizer:
+    """ Redacts emails, screen names, BTC wallets and credit card numbers from tweet text.
+
+        Output is identical to running each substitution over the whole text in turn (emails,
+        screen names, BTC wallets, then credit cards).  Matches of different patterns can overlap,
+        so the passes can't be merged into one alternation; instead each pass is skipped when
+        a cheap check proves it can't match, which is the case for most tweets.
+    """
+
+    def __init__(self, replace_screen_name: Callable[[Match], str]):
+        self.replace_screen_name = replace_screen_name
+
+    def __call__(self, text: str) -> str:
+        at = text.find('@')
+        if at >= 0:
+            if may_contain_email(text, at):
+                text = EMAIL_RE.sub('__email__', text)
+            if '@' in text:
+                text = SN_RE.sub(self.replace_screen_name, text)
+        if '1' in text or '3' in text:
+            # BTC wallet addresses always start with a 1 or 3
+            text = BTC_RE.sub('__btc_wallet__', text)
+        if CC_PROBE_RE.search(text) is not None:
+            text = CC_RE.sub('__credit_card__', text)
+        return text
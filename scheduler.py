@@ -0,0 +1,70 @@
+""" Priority queue deciding when the collector daemon next collects each screen name """
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Tweets a screen name is left to gather between collections, about a page from each endpoint
+SCHEDULE_TARGET_TWEETS = int(os.environ.get('SCHEDULE_TARGET_TWEETS', 100))
+# Bounds on the seconds between two collections of a screen name.  The upper bound gives way when
+# the rate limits can't keep up with every screen name at once.
+SCHEDULE_MIN_INTERVAL = float(os.environ.get('SCHEDULE_MIN_INTERVAL', 60))
+SCHEDULE_MAX_INTERVAL = float(os.environ.get('SCHEDULE_MAX_INTERVAL', 3600))
+
+
+class Scheduler:
+    """ Thread-safe queue of screen names ordered by when they are next due.  A screen name's
+        interval is the time it takes to gather SCHEDULE_TARGET_TWEETS at its estimated tweet
+        rate, within the configured bounds.  If together the intervals would need more requests
+        than the rate limits allow, they are all stretched by the same factor.
+    """
+
+    def __init__(self, screen_names: List[str]):
+        self.heap = []  # type: List[tuple]
+        self.intervals = {}  # type: Dict[str, float]
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        now = time.time()
+        for screen_name in screen_names:
+            self.intervals[screen_name] = SCHEDULE_MIN_INTERVAL
+            heapq.heappush(self.heap, (now, next(self.order), screen_name))
+
+    def __len__(self) -> int:
+        return len(self.intervals)
+
+    def update(self, rates: Dict[str, float], collections_per_second: float):
+        """ Recomputes the intervals from tweets per second per screen name, and the collections
+            per second the rate limits leave room for
+        """
+        intervals = {}
+        for screen_name in self.intervals:
+            rate = rates.get(screen_name)
+            interval = SCHEDULE_TARGET_TWEETS / rate if rate else SCHEDULE_MAX_INTERVAL
+            intervals[screen_name] = min(max(interval, SCHEDULE_MIN_INTERVAL),
+                                         SCHEDULE_MAX_INTERVAL)
+        demand = sum(1 / interval for interval in intervals.values())
+        if collections_per_second > 0 and demand > collections_per_second:
+            stretch = demand / collections_per_second
+            intervals = {sn: interval * stretch for sn, interval in intervals.items()}
+        with self.lock:
+            self.intervals = intervals
+
+    def next_due(self) -> Optional[float]:
+        """ When the next screen name is due, or None if every one is being collected """
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: float) -> Optional[str]:
+        """ Takes the screen name that has been due the longest, if any is due """
+        with self.lock:
+            if not self.heap or self.heap[0][0] > now:
+                return None
+            return heapq.heappop(self.heap)[2]
+
+    def reschedule(self, screen_name: str, collected_at: float):
+        """ Queues a screen name taken with `pop_due` again, one interval after its collection """
+        with self.lock:
+            heapq.heappush(self.heap, (collected_at + self.intervals[screen_name],
+                                       next(self.order), screen_name))
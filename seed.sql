@@ -0,0 +1,47 @@
+-- Seeds the tables the collector keeps up to date as it saves tweets, from tweets saved before
+-- those tables existed.  The seeds read the extracted tweet columns, so backfill.py runs this once
+-- it has filled them in.  Safe to run again.
+
+-- Parents of the last day's replies that haven't been fetched yet
+INSERT INTO pending_parents (status_id, child_created_at)
+SELECT replies.in_reply_to_status_id::TEXT, max(replies.created_at)
+FROM tweets replies
+WHERE replies.in_reply_to_status_id IS NOT NULL
+  AND replies.created_at > (now() at time zone 'utc') - interval '1 day'
+  AND NOT EXISTS (SELECT 1 FROM tweets WHERE tweets.status_id = replies.in_reply_to_status_id::TEXT)
+  AND NOT EXISTS (SELECT 1 FROM inaccessible_tweets
+                  WHERE inaccessible_tweets.status_id = replies.in_reply_to_status_id::TEXT)
+GROUP BY 1
+ON CONFLICT DO NOTHING;
+
+-- Accounts and their hourly tweet counts over the last 14 days
+INSERT INTO account_stats (screen_name, last_scraped_at)
+SELECT screen_name, max(created_at) FROM requests WHERE screen_name IS NOT NULL GROUP BY 1
+ON CONFLICT DO NOTHING;
+
+INSERT INTO account_hourly_counts (screen_name, hour, tweet_count)
+SELECT screen_name, date_trunc('hour', created_at), count(*)
+FROM tweets JOIN account_stats USING (screen_name)
+WHERE created_at > (now() at time zone 'utc') - interval '14 days'
+GROUP BY 1, 2
+ON CONFLICT (screen_name, hour) DO UPDATE SET tweet_count =
+  greatest(account_hourly_counts.tweet_count, EXCLUDED.tweet_count);
+
+-- Decays the seeded counts over the default ACCOUNT_RATE_DECAY_HOURS of 24
+UPDATE account_stats SET decayed_count = seed.decayed_count, decayed_at = seed.decayed_at
+FROM (
+  SELECT screen_name, max(newest) AS decayed_at,
+    sum(tweet_count * exp(EXTRACT(EPOCH FROM hour - newest) / 86400.0)) AS decayed_count
+  FROM (SELECT screen_name, hour, tweet_count,
+          max(hour) OVER (PARTITION BY screen_name) AS newest
+        FROM account_hourly_counts) hourly
+  GROUP BY screen_name
+) seed
+WHERE account_stats.screen_name = seed.screen_name AND account_stats.decayed_at IS NULL;
+
+-- Resumes collection from the newest reply collected from each account
+INSERT INTO high_water_marks (screen_name, kind, since_id)
+SELECT screen_name, 'get_replies', max(status_id::BIGINT)
+FROM tweets JOIN account_stats USING (screen_name)
+GROUP BY 1
+ON CONFLICT DO NOTHING;
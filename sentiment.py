@@ -0,0 +1,267 @@
+""" Scores the sentiment of tweets queued in sentiment_queue, apart from collection.  Tweets are
+    leased off the queue in batches, scored by the analyzer SENTIMENT_ANALYZER names outside of
+    any transaction, and their scores are written back with one update per batch.  Scores are
+    cached by a hash of the text, in memory and on disk, so retweets and templated replies are
+    only scored once.
+
+    $ SENTIMENT_ANALYZER=package.module:Analyzer PYTHONPATH=$(pwd) python3.6 sentiment.py [follow]
+"""
+import hashlib
+import importlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+# Settings are read as modules are imported, so .env has to be loaded first
+load_dotenv('.env')
+
+import db  # noqa: E402
+import instrument  # noqa: E402
+
+# Analyzer to score texts with, as module:callable.  The callable is called without arguments and
+# returns an object whose analyze(texts) returns a score for each text.
+SENTIMENT_ANALYZER = os.environ.get('SENTIMENT_ANALYZER', '')
+# Queued tweets leased and scored at a time
+SENTIMENT_BATCH_SIZE = int(os.environ.get('SENTIMENT_BATCH_SIZE', 5000))
+# Scores of the most recently scored texts kept in memory
+SENTIMENT_CACHE_SIZE = int(os.environ.get('SENTIMENT_CACHE_SIZE', 100000))
+# SQLite file keeping every score between runs, or nothing if empty
+SENTIMENT_CACHE_PATH = os.environ.get('SENTIMENT_CACHE_PATH', 'sentiment_cache.sqlite')
+# Seconds between checks of an empty queue when following it
+SENTIMENT_POLL_SECONDS = float(os.environ.get('SENTIMENT_POLL_SECONDS', 30))
+
+# Most hashes looked up in the disk cache per query, under SQLite's limit on parameters
+DISK_LOOKUP_SIZE = 500
+
+# Leases queued tweets nobody holds, or whose lease ran out, to this collector
+CLAIM_QUERY = """
+    WITH claimed AS (
+      UPDATE sentiment_queue SET holder = $2,
+        leased_until = (now() at time zone 'utc') + $3 * interval '1 second'
+      WHERE status_id IN (
+        SELECT status_id FROM sentiment_queue
+        WHERE leased_until IS NULL OR leased_until < (now() at time zone 'utc')
+        ORDER BY queued_at
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED)
+      RETURNING status_id, created_at, queued_at)
+    SELECT claimed.status_id, claimed.created_at, claimed.queued_at,
+      coalesce(tweets.data ->> 'full_text', tweets.data ->> 'text') AS text
+    FROM claimed LEFT JOIN tweets USING (status_id, created_at);"""
+
+# Takes leased tweets off the queue and saves their scores, leaving alone tweets queued again
+# since they were leased, whose text may have changed, and tweets another collector now holds
+SAVE_SCORES_QUERY = """
+    WITH scored AS (
+      DELETE FROM sentiment_queue
+      USING unnest($1::TEXT[], $2::TIMESTAMP[], $3::DOUBLE PRECISION[])
+        AS scores (status_id, queued_at, sentiment)
+      WHERE sentiment_queue.status_id = scores.status_id
+        AND sentiment_queue.queued_at = scores.queued_at AND sentiment_queue.holder = $4
+      RETURNING sentiment_queue.status_id, sentiment_queue.created_at, scores.sentiment)
+    UPDATE tweets SET data = jsonb_set(data, '{sentiment}', to_jsonb(scored.sentiment))
+    FROM scored
+    WHERE tweets.status_id = scored.status_id AND tweets.created_at = scored.created_at
+      AND scored.sentiment IS NOT NULL;"""
+
+ScoredBatch = NamedTuple('ScoredBatch', [
+    ('claimed', int),
+    ('texts', int),
+    ('analyzed', int),
+    ('analyze_seconds', float),
+])
+
+
+def load_analyzer(spec: str=SENTIMENT_ANALYZER):
+    """ Builds the analyzer named as module:callable """
+    if ':' not in spec:
+        raise ValueError(f"SENTIMENT_ANALYZER must look like module:callable, not {spec!r}")
+    module_name, name = spec.split(':', 1)
+    return getattr(importlib.import_module(module_name), name)()
+
+
+def text_hash(text: str, spec: str=SENTIMENT_ANALYZER) -> bytes:
+    """ Cache key of a text's score, which differs between analyzers """
+    return hashlib.blake2b(f'{spec}\0{text}'.encode('utf-8'), digest_size=16).digest()
+
+
+class ScoreCache:
+    """ Scores by text hash, the most recently used SENTIMENT_CACHE_SIZE of them in memory and
+        all of them in an SQLite file if `path` is given.  Not thread-safe, since SQLite
+        connections can't be shared between threads.
+    """
+
+    def __init__(self, size: int=SENTIMENT_CACHE_SIZE, path: str=SENTIMENT_CACHE_PATH):
+        self.size = size
+        self.memory = OrderedDict()  # type: OrderedDict[bytes, float]
+        self.disk = sqlite3.connect(path) if path else None
+        if self.disk is not None:
+            self.disk.execute("""CREATE TABLE IF NOT EXISTS scores (
+                                   hash BLOB PRIMARY KEY, score REAL) WITHOUT ROWID;""")
+
+    def _remember(self, key: bytes, score: float):
+        if self.size <= 0:
+            return
+        self.memory[key] = score
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, float]:
+        """ Scores of the keys found in memory or on disk """
+        found, missing = {}, []
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+            else:
+                missing.append(key)
+        if self.disk is not None:
+            for start in range(0, len(missing), DISK_LOOKUP_SIZE):
+                chunk = missing[start:start + DISK_LOOKUP_SIZE]
+                rows = self.disk.execute(f"""SELECT hash, score FROM scores
+                                            WHERE hash IN ({', '.join('?' * len(chunk))});""",
+                                         chunk)
+                for key, score in rows:
+                    found[key] = score
+                    self._remember(key, score)
+        return found
+
+    def put_many(self, scores: Dict[bytes, float]):
+        for key, score in scores.items():
+            self._remember(key, score)
+        if self.disk is not None:
+            self.disk.executemany("INSERT OR REPLACE INTO scores (hash, score) VALUES (?, ?);",
+                                  scores.items())
+            self.disk.commit()
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+
+@db.reconnecting
+def claim_batch(batch_size: int=SENTIMENT_BATCH_SIZE) -> list:
+    """ Leases up to `batch_size` queued tweets to this collector for LEASE_SECONDS, returning
+        them with their texts.  Tweets whose lease runs out before their scores are saved go
+        back to being claimable.
+    """
+    conn = db.db_conn()
+    crs = conn.cursor()
+    try:
+        db.execute_prepared(crs, 'claim_sentiment', CLAIM_QUERY,
+                            (batch_size, db.COLLECTOR_ID, db.LEASE_SECONDS))
+        claimed = crs.fetchall()
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    return claimed
+
+
+@db.reconnecting
+def save_scores(claimed: list, scores: List[Optional[float]]):
+    """ Saves the scores of leased tweets and takes them off the queue, including tweets
+        without text, whose score is None
+    """
+    conn = db.db_conn()
+    crs = conn.cursor()
+    try:
+        db.execute_prepared(crs, 'save_sentiment', SAVE_SCORES_QUERY, (
+            [row.status_id for row in claimed], [row.queued_at for row in claimed], scores,
+            db.COLLECTOR_ID))
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+
+
+def score_batch(analyzer, cache: ScoreCache, batch_size: int=SENTIMENT_BATCH_SIZE) -> ScoredBatch:
+    """ Leases up to `batch_size` tweets off the queue, scores them and saves the scores, each in
+        a short transaction of its own so scoring doesn't hold locks.  Only texts missing from
+        the cache are sent to the analyzer, once each.
+    """
+    with instrument.timed('sentiment', 'claim'):
+        claimed = claim_batch(batch_size)
+    keys = [text_hash(row.text) if row.text else None for row in claimed]
+    scores = cache.get_many([key for key in keys if key])
+    missing = {key: row.text for key, row in zip(keys, claimed) if key and key not in scores}
+    analyze_seconds = 0.0
+    if missing:
+        start = time.perf_counter()
+        analyzed = dict(zip(missing, map(float, analyzer.analyze([*missing.values()]))))
+        analyze_seconds = time.perf_counter() - start
+        instrument.record('sentiment', 'analyze', analyze_seconds)
+        cache.put_many(analyzed)
+        scores.update(analyzed)
+    if claimed:
+        with instrument.timed('sentiment', 'save'):
+            save_scores(claimed, [scores.get(key) for key in keys])
+    texts = sum(1 for key in keys if key)
+    instrument.increment('sentiment', 'texts', texts)
+    instrument.increment('sentiment', 'analyzed', len(missing))
+    return ScoredBatch(len(claimed), texts, len(missing), analyze_seconds)
+
+
+def score_queue(analyzer, cache: ScoreCache, stopping: Optional[threading.Event]=None,
+                batch_size: int=SENTIMENT_BATCH_SIZE) -> int:
+    """ Scores queued tweets until the queue is empty, or if `stopping` is given, until it is set,
+        checking the empty queue every SENTIMENT_POLL_SECONDS.  Returns how many were scored.
+    """
+    texts, analyzed, analyze_seconds = 0, 0, 0.0
+    start = time.perf_counter()
+    while stopping is None or not stopping.is_set():
+        batch = score_batch(analyzer, cache, batch_size)
+        texts += batch.texts
+        analyzed += batch.analyzed
+        analyze_seconds += batch.analyze_seconds
+        if batch.texts:
+            elapsed = time.perf_counter() - start
+            logging.info(f"Scored {texts} texts, {texts / elapsed:,.0f} texts/s, "
+                         f"{texts - analyzed} from the cache.")
+        if batch.claimed < batch_size and (stopping is None
+                                         or stopping.wait(SENTIMENT_POLL_SECONDS)):
+            break
+    elapsed = time.perf_counter() - start
+    logging.info(f"Scored {texts} texts in {elapsed:.1f}s ({texts / max(elapsed, 1e-9):,.0f} "
+                 f"texts/s).  {analyzed} were analyzed in {analyze_seconds:.1f}s "
+                 f"({analyzed / max(analyze_seconds, 1e-9):,.0f} texts/s), the rest came from "
+                 f"the cache.")
+    return texts
+
+
+def run_worker(stopping: threading.Event):
+    """ Follows the queue until `stopping` is set, for running on a background thread """
+    cache = ScoreCache()
+    try:
+        score_queue(load_analyzer(), cache, stopping)
+    except Exception:
+        logging.exception("Sentiment scoring stopped")
+    finally:
+        cache.close()
+        db.release_conn()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(levelname)s:%(asctime)s.%(msecs)03d [%(threadName)s] - %(message)s',
+        datefmt='%Y-%m-%d,%H:%M:%S',
+        level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')))
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if not SENTIMENT_ANALYZER or command not in (None, 'follow'):
+        sys.exit(__doc__)
+    score_cache = ScoreCache()
+    try:
+        score_queue(load_analyzer(), score_cache,
+                    threading.Event() if command == 'follow' else None)
+    finally:
+        score_cache.close()
@@ -0,0 +1,24 @@
+""" Screen names of the customer support accounts in the dataset, kept apart from export.py so
+    tools can use them without its database dependencies
+"""
+
+CUSTOMER_SUPPORT_SNS = {
+    'nikesupport', 'xboxsupport', 'upshelp', 'comcastcares', 'amazonhelp', 'jetblue', 'americanair',
+    'tacobellteam', 'mcdonalds', 'kimpton', 'ihgservice', 'spotifycares', 'hiltonhelp',
+    'applesupport', 'microsofthelps', 'googleplaymusic', 'scsupport', 'pandorasupport',
+    'hoteltonightcx', 'dunkindonuts', 'jackbox', 'chipotletweets', 'askpanera', 'carlsjr', 'att',
+    'tmobilehelp', 'sprintcare', 'verizonsupport', 'boostcare', 'uscellularcares', 'alaskaair',
+    'virginamerica', 'virginatlantic', 'delta', 'british_airways', 'southwestair', 'awssupport',
+    'twittersupport', 'askplaystation', 'neweggservice', 'dropboxsupport', 'hpsupport',
+    'atviassist', 'azuresupport', 'nortonsupport', 'dellcares', 'hulu_support', 'askrobinhood',
+    'officesupport', 'arbyscares', 'pearsonsupport', 'yahoocare', 'idea_cares', 'airtel_care',
+    'coxhelp', 'kfc_uki_help', 'asurioncares', 'adobecare', 'glocare', 'sizehelpteam',
+    'airasiasupport', 'safaricom_care', 'oppocarein', 'bofa_help', 'chasesupport', 'askciti',
+    'ask_wellsfargo', 'keybank_help', 'moo', 'centurylinkhelp', 'mediatemplehelp', 'godaddyhelp',
+    'postmates_help', 'doordash_help', 'airbnbhelp', 'uber_support', 'asklyft', 'askseagate',
+    'ask_spectrum', 'askpaypal', 'asksalesforce', 'askvirginmoney', 'askdsc', 'askpapajohns',
+    'askrbc', 'askebay', 'asktigogh', 'vmucare', 'askamex', 'ask_progressive', 'mtnc_care',
+    'askvisa', 'tesco', 'sainsburys', 'walmart', 'asktarget', 'morrisons', 'aldiuk', 'argoshelpers',
+    'greggsofficial', 'marksandspencer', 'virgintrains', 'nationalrailenq', 'sw_help',
+    'londonmidland', 'gwrhelp', 'tfl', 'o2'
+}
@@ -0,0 +1,85 @@
+""" Unit tests for the tweet index and the anonymous IDs in export.py """
+import pytest
+
+import export
+
+
+def make_index(tweets) -> export.TweetIndex:
+    """ Index of (tweet ID, author ID, screen name, parent ID) tuples, with replies linked """
+    index = export.TweetIndex()
+    for tweet in tweets:
+        index.append(*tweet)
+    index.link_replies()
+    return index
+
+
+# Jane asks AmazonHelp, which answers, and she replies.  Bob replies to a tweet that wasn't
+# collected, and Carol's tweet gets no support response.
+TWEETS = [
+    (10, 1, 'Jane', None),
+    (11, 100, 'AmazonHelp', 10),
+    (12, 1, 'Jane', 11),
+    (13, 2, 'bob', 5),
+    (14, 100, 'AmazonHelp', 13),
+    (15, 3, 'carol', None),
+    (16, 100, 'AmazonHelp', 10),
+]
+
+
+def test_append_requires_ascending_ids():
+    index = export.TweetIndex()
+    index.append(2, 1, 'jane', None)
+    with pytest.raises(ValueError):
+        index.append(2, 1, 'jane', None)
+    with pytest.raises(ValueError):
+        index.append(1, 1, 'jane', None)
+
+
+def test_find():
+    index = make_index(TWEETS)
+    assert [index.find(tweet_id) for tweet_id in (10, 13, 16)] == [0, 3, 6]
+    assert [index.find(tweet_id) for tweet_id in (None, 0, 9, 17, 12.5)] == [-1] * 5
+
+
+def test_link_replies():
+    index = make_index(TWEETS)
+    assert list(index.parent_positions) == [-1, 0, 1, -1, 3, -1, 0]
+    assert list(index.replies_to(0)) == [1, 6]
+    assert list(index.replies_to(1)) == [2]
+    assert list(index.replies_to(5)) == []
+    assert list(index.user_ids) == [1, 2, 3, 100]
+    assert list(index.missing_parents) == [5]
+    assert index.screen_name_to_id == {'jane': 1, 'amazonhelp': 100, 'bob': 2, 'carol': 3}
+    assert list(index.companies) == [0, 1, 0, 0, 1, 0, 1]
+
+
+def test_iter_threads_keeps_threads_with_support_responses():
+    threads = [list(thread) for thread in export.iter_threads(make_index(TWEETS))]
+    assert threads == [[0, 1, 2, 6], [3, 4]]
+
+
+def test_support_account_alone_is_not_a_thread():
+    index = make_index([(1, 100, 'AmazonHelp', None), (2, 1, 'jane', 1)])
+    assert list(export.iter_threads(index)) == []
+
+
+def test_anonymous_ids():
+    index = make_index(TWEETS)
+    anonymizer = export.Anonymizer(index, b'salt', ['jane', 'zed', 'amy', 'zed'])
+    assert [anonymizer.tweet_id(pos) for pos in range(3)] == [1, 2, 3]
+    # Uncollected parents are numbered after the index
+    assert [anonymizer.parent_id(pos) for pos in (0, 1, 3)] == ['', 1, len(TWEETS) + 1]
+    assert anonymizer.screen_name_id('jane') == anonymizer.user_id(1) == 0
+    assert anonymizer.screen_name_id('amazonhelp') == 3
+    assert sorted(anonymizer.unseen_ids.values()) == [4, 5]
+    assert {anonymizer.screen_name_id('zed'), anonymizer.screen_name_id('amy')} == {4, 5}
+    with pytest.raises(KeyError):
+        anonymizer.screen_name_id('nobody')
+
+
+def test_unseen_order_depends_on_salt_only():
+    index = make_index(TWEETS)
+    names = [f'user{number}' for number in range(50)]
+    first = export.Anonymizer(index, b'salt', names).unseen_ids
+    assert export.Anonymizer(index, b'salt', reversed(names)).unseen_ids == first
+    assert export.Anonymizer(index, b'other', names).unseen_ids != first
@@ -0,0 +1,115 @@
+""" Unit tests for parsing raw API responses and paging in fetch.py """
+import json
+
+import pytest
+from twitter import Api, TwitterError
+
+import fetch
+import ratelimit
+
+TWEET = {'id': 2, 'created_at': 'Wed Oct 10 20:19:24 +0000 2018', 'full_text': 'hi @acme',
+         'truncated': False, 'in_reply_to_status_id': 1,
+         'user': {'id': 7, 'screen_name': 'Jane'}}
+OTHER_TWEET = {'id': 3, 'created_at': 'Wed Oct 10 20:20:00 +0000 2018', 'text': 'short',
+               'truncated': True, 'user': None}
+
+
+@pytest.fixture(scope='module')
+def api():
+    return Api()
+
+
+def test_parses_timeline_keeping_json_as_sent(api):
+    first, second = json.dumps(TWEET, indent=1), json.dumps(OTHER_TWEET)
+    tweets = fetch.parse_raw_tweets(api, f'[ {first} ,\n{second}]'.encode())
+    assert [tweet.data for tweet in tweets] == [first, second]
+    assert tweets[0] == fetch.RawTweet(2, TWEET['created_at'], TWEET['user'], 1, 'hi @acme',
+                                       False, first)
+    assert tweets[1] == fetch.RawTweet(3, OTHER_TWEET['created_at'], None, None, 'short', True,
+                                       second)
+
+
+def test_parses_search_response(api):
+    content = json.dumps({'statuses': [TWEET], 'search_metadata': {'count': 1}}).encode()
+    tweets = fetch.parse_raw_tweets(api, content, search=True)
+    assert [tweet.id for tweet in tweets] == [2]
+    assert json.loads(tweets[0].data) == TWEET
+
+
+def test_parses_empty_responses(api):
+    assert fetch.parse_raw_tweets(api, b'[]') == []
+    assert fetch.parse_raw_tweets(api, b'{"statuses": [], "search_metadata": {}}',
+                                  search=True) == []
+
+
+def test_drops_escaped_nuls_but_not_escaped_backslashes(api):
+    content = rb'[{"id": 1, "created_at": "", "text": "a\u0000b\\u0000"}]'
+    tweets = fetch.parse_raw_tweets(api, content)
+    assert tweets[0].text == r'ab\u0000'
+    assert tweets[0].data == r'{"id": 1, "created_at": "", "text": "ab\\u0000"}'
+
+
+@pytest.mark.parametrize('content', [b'[{"id": 1, "created_at": ""} {"id": 2}]',
+                                     b'[{"created_at": ""}]', b'[{"id": 1'])
+def test_malformed_responses_raise(api, content):
+    with pytest.raises(TwitterError):
+        fetch.parse_raw_tweets(api, content)
+
+
+def test_api_errors_raise(api):
+    with pytest.raises(TwitterError):
+        fetch.parse_raw_tweets(api, b'{"errors": [{"code": 88, "message": "Rate limit"}]}')
+
+
+class Pages:
+    """ fetch_page stand-in serving tweet IDs newest first, `page_size` at a time """
+
+    def __init__(self, ids, page_size: int, fail_on: int=None):
+        self.ids = sorted(ids, reverse=True)
+        self.page_size = page_size
+        self.fail_on = fail_on
+        self.calls = []
+
+    def __call__(self, screen_name, since_id=None, max_id=None):
+        self.calls.append((since_id, max_id))
+        if len(self.calls) == self.fail_on:
+            raise ratelimit.BudgetExhausted('search/tweets')
+        page = [fetch.RawTweet(status_id, '', None, None, None, False, '')
+                for status_id in self.ids
+                if (since_id is None or status_id > since_id)
+                and (max_id is None or status_id <= max_id)][:self.page_size]
+        return page, fetch.ApiRequest(screen_name, 'get_ats')
+
+
+def test_pages_until_empty_page():
+    pages = Pages(range(1, 11), page_size=4)
+    tweets, requests, resume_from = fetch.fetch_pages(pages, 'acme')
+    assert [tweet.id for tweet in tweets] == list(range(10, 0, -1))
+    assert len(requests) == 4
+    assert resume_from is None
+    assert pages.calls == [(None, None), (None, 6), (None, 2), (None, 0)]
+
+
+def test_stops_at_since_id():
+    pages = Pages(range(1, 11), page_size=3)
+    tweets, requests, resume_from = fetch.fetch_pages(pages, 'acme', since_id=4)
+    assert [tweet.id for tweet in tweets] == [10, 9, 8, 7, 6, 5]
+    assert (len(requests), resume_from) == (2, None)
+
+
+def test_returns_resume_point_after_max_pages():
+    pages = Pages(range(1, 11), page_size=3)
+    tweets, requests, resume_from = fetch.fetch_pages(pages, 'acme', max_pages=2)
+    assert [tweet.id for tweet in tweets] == [10, 9, 8, 7, 6, 5]
+    assert resume_from == 4
+
+
+def test_returns_resume_point_after_later_page_fails():
+    pages = Pages(range(1, 11), page_size=3, fail_on=2)
+    tweets, requests, resume_from = fetch.fetch_pages(pages, 'acme')
+    assert ([tweet.id for tweet in tweets], len(requests), resume_from) == ([10, 9, 8], 1, 7)
+
+
+def test_raises_when_first_page_fails():
+    with pytest.raises(ratelimit.BudgetExhausted):
+        fetch.fetch_pages(Pages(range(1, 11), page_size=3, fail_on=1), 'acme')
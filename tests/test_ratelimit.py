@@ -0,0 +1,115 @@
+""" Unit tests for the token buckets in ratelimit.py """
+import pytest
+
+import ratelimit
+
+
+class Clock:
+    """ Stands in for the time module, advancing only when slept on """
+
+    def __init__(self, now: float=1000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    monkeypatch.setattr(ratelimit, '_default_wait', 0.0)
+    monkeypatch.delenv('RATE_LIMIT_WAIT', raising=False)
+    ratelimit.reset()
+    yield clock
+    ratelimit.reset()
+
+
+def test_acquire_drains_capacity(clock):
+    bucket = ratelimit.TokenBucket(3)
+    assert [bucket.acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.available() == 0
+
+
+def test_refills_evenly_over_window(clock):
+    bucket = ratelimit.TokenBucket(900, window=900)
+    for _ in range(900):
+        bucket.acquire()
+    clock.sleep(10)
+    assert bucket.available() == 10
+
+
+def test_acquire_waits_for_refill_within_timeout(clock):
+    bucket = ratelimit.TokenBucket(1, window=60)
+    bucket.acquire()
+    assert not bucket.acquire(timeout=30)
+    assert bucket.acquire(timeout=60)
+    assert clock.now == pytest.approx(1060)
+
+
+def test_observe_follows_reported_remaining_until_reset(clock):
+    bucket = ratelimit.TokenBucket(450)
+    bucket.observe(limit=180, remaining=2, reset_at=clock.now + 60)
+    assert bucket.state() == (180, 2, clock.now + 60)
+    assert bucket.acquire() and bucket.acquire()
+    assert not bucket.acquire()
+    # Later reports for the same window never hand back calls already made
+    bucket.observe(limit=180, remaining=5, reset_at=clock.now + 60)
+    assert bucket.available() == 0
+    clock.sleep(60)
+    assert bucket.state() == (180, 180, None)
+
+
+def test_observe_ignores_past_windows(clock):
+    bucket = ratelimit.TokenBucket(10)
+    bucket.observe(limit=5, remaining=0, reset_at=clock.now - 1)
+    assert bucket.state() == (10, 10, None)
+
+
+def test_exhaust_empties_bucket_for_a_window(clock):
+    bucket = ratelimit.TokenBucket(10)
+    bucket.exhaust()
+    assert bucket.state() == (10, 0, clock.now + ratelimit.WINDOW_SECONDS)
+    clock.sleep(ratelimit.WINDOW_SECONDS)
+    assert bucket.available() == 10
+
+
+def test_acquire_raises_without_waiting_by_default(clock):
+    ratelimit.bucket('statuses/lookup').exhaust()
+    with pytest.raises(ratelimit.BudgetExhausted):
+        ratelimit.acquire('statuses/lookup')
+    assert clock.now == 1000.0
+
+
+def test_wait_for_reset_waits_out_the_window(clock):
+    ratelimit.bucket('statuses/lookup').exhaust()
+    ratelimit.wait_for_reset()
+    ratelimit.acquire('statuses/lookup')
+    assert clock.now == 1000.0 + ratelimit.WINDOW_SECONDS
+
+
+def test_rate_limit_wait_overrides_default(clock, monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_WAIT', '10')
+    ratelimit.wait_for_reset()
+    ratelimit.bucket('statuses/lookup').exhaust()
+    with pytest.raises(ratelimit.BudgetExhausted):
+        ratelimit.acquire('statuses/lookup')
+
+
+def test_bucket_capacity_from_environment(clock, monkeypatch):
+    monkeypatch.setenv('SEARCH_RATE_LIMIT', '7')
+    assert ratelimit.bucket('search/tweets').available() == 7
+    assert ratelimit.bucket('search/tweets') is ratelimit.bucket('search/tweets')
+
+
+def test_snapshot_restores_reported_buckets(clock):
+    ratelimit.bucket('search/tweets').observe(180, 17, clock.now + 120)
+    ratelimit.bucket('statuses/lookup')
+    saved = ratelimit.snapshot()
+    assert saved == [('search/tweets', 180, 17, clock.now + 120)]
+    ratelimit.reset()
+    ratelimit.restore(saved + [('unknown/endpoint', 1, 1, clock.now + 120)])
+    assert ratelimit.snapshot() == saved
@@ -0,0 +1,58 @@
+""" Unit tests for the redactions in sanitize.py """
+import re
+
+import pytest
+
+import sanitize
+
+TEXTS = [
+    'no personal info here',
+    'mail me at jane.doe@example.com please',
+    '@AcmeSupport my order is late',
+    'thanks @acme_help!',
+    'send to 1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2 now',
+    'card 4111 1111 1111 1111 declined',
+    'card 4111-1111-1111-1111',
+    'a@b',
+    'x.@y.com',
+    'me@ex.com @bob 1111 2222 3333 4444',
+    '@a@b.com and.@c',
+    'order 12345678 ref 31',
+    '',
+]
+
+
+def replace_screen_name(match: re.Match) -> str:
+    return match.group(1) + 'user'
+
+
+def sanitize_in_passes(text: str) -> str:
+    """ The four substitutions run over the whole text in turn, which Sanitizer must match """
+    text = sanitize.EMAIL_RE.sub('__email__', text)
+    text = sanitize.SN_RE.sub(replace_screen_name, text)
+    text = sanitize.BTC_RE.sub('__btc_wallet__', text)
+    return sanitize.CC_RE.sub('__credit_card__', text)
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_matches_separate_passes(text):
+    assert sanitize.Sanitizer(replace_screen_name)(text) == sanitize_in_passes(text)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('mail me at jane.doe@example.com please', 'mail me at __email__ please'),
+    ('thanks @acme_help!', 'thanks @user!'),
+    ('send to 1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2 now', 'send to __btc_wallet__ now'),
+    ('card 4111 1111 1111 1111 declined', 'card __credit_card__ declined'),
+    ('me@ex.com @bob 1111 2222 3333 4444', '__email__ @user __credit_card__'),
+    ('no personal info here', 'no personal info here'),
+])
+def test_redacts(text, expected):
+    assert sanitize.Sanitizer(replace_screen_name)(text) == expected
+
+
+def test_may_contain_email():
+    assert sanitize.may_contain_email('jane@example.com', 4)
+    assert not sanitize.may_contain_email('@jane hello.', 0)
+    assert not sanitize.may_contain_email('jane@example', 4)
+    assert sanitize.may_contain_email('@jane or jane@example.com', 0)
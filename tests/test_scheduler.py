@@ -0,0 +1,60 @@
+""" Unit tests for the collection schedule in scheduler.py """
+import pytest
+
+import scheduler
+
+
+@pytest.fixture(autouse=True)
+def bounds(monkeypatch):
+    monkeypatch.setattr(scheduler, 'SCHEDULE_TARGET_TWEETS', 100)
+    monkeypatch.setattr(scheduler, 'SCHEDULE_MIN_INTERVAL', 60.0)
+    monkeypatch.setattr(scheduler, 'SCHEDULE_MAX_INTERVAL', 3600.0)
+    monkeypatch.setattr(scheduler.time, 'time', lambda: 1000.0)
+
+
+def pop_all(schedule, now: float):
+    popped = []
+    while True:
+        screen_name = schedule.pop_due(now)
+        if screen_name is None:
+            return popped
+        popped.append(screen_name)
+
+
+def test_every_screen_name_is_due_at_start_in_order():
+    schedule = scheduler.Scheduler(['a', 'b', 'c'])
+    assert len(schedule) == 3
+    assert schedule.next_due() == 1000.0
+    assert pop_all(schedule, 1000.0) == ['a', 'b', 'c']
+    assert schedule.next_due() is None
+
+
+def test_nothing_pops_before_it_is_due():
+    schedule = scheduler.Scheduler(['a'])
+    assert schedule.pop_due(999.0) is None
+    assert schedule.pop_due(1000.0) == 'a'
+
+
+def test_intervals_follow_tweet_rate_within_bounds():
+    schedule = scheduler.Scheduler(['busy', 'steady', 'quiet', 'unknown'])
+    schedule.update({'busy': 100.0, 'steady': 0.1, 'quiet': 0.0001}, collections_per_second=0)
+    assert schedule.intervals == {'busy': 60.0, 'steady': 1000.0, 'quiet': 3600.0,
+                                  'unknown': 3600.0}
+
+
+def test_intervals_stretch_to_fit_rate_limits():
+    schedule = scheduler.Scheduler(['a', 'b'])
+    # Two collections a minute are wanted, but the rate limits only allow one
+    schedule.update({'a': 10.0, 'b': 10.0}, collections_per_second=1 / 60)
+    assert schedule.intervals == {'a': pytest.approx(120.0), 'b': pytest.approx(120.0)}
+
+
+def test_reschedule_queues_one_interval_after_collection():
+    schedule = scheduler.Scheduler(['fast', 'slow'])
+    schedule.update({'fast': 10.0, 'slow': 0.01}, collections_per_second=0)
+    pop_all(schedule, 1000.0)
+    schedule.reschedule('slow', 1000.0)
+    schedule.reschedule('fast', 1005.0)
+    assert schedule.next_due() == 1065.0
+    assert pop_all(schedule, 1065.0) == ['fast']
+    assert pop_all(schedule, 4600.0) == ['slow']
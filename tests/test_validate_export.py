@@ -0,0 +1,86 @@
+""" Unit tests for the export checks in validate_export.py """
+import csv
+import gzip
+
+import validate_export
+
+HEADER = ['tweet_id', 'author_id', 'inbound', 'created_at', 'text', 'response_tweet_id',
+          'in_response_to_tweet_id']
+ROWS = [
+    ['1', '115712', 'True', 'Tue Oct 31 22:10:47 +0000 2017', '@sprintcare help', '2', ''],
+    ['2', 'sprintcare', 'False', 'Tue Oct 31 22:11:45 +0000 2017', '@115712 hi', '', '1'],
+    ['3', '115713', 'True', 'Tue Oct 31 22:12:45 +0000 2017', '@sprintcare thanks', '', '8'],
+]
+
+
+def write_csv(path, rows, header=HEADER):
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        if header:
+            writer.writerow(header)
+        writer.writerows(rows)
+    return str(path)
+
+
+def test_valid_export(tmp_path):
+    assert not validate_export.validate_export(write_csv(tmp_path / 'twcs.csv', ROWS))
+
+
+def test_strict_reports_missing_parents(tmp_path):
+    violations = validate_export.validate_export(write_csv(tmp_path / 'twcs.csv', ROWS),
+                                                 strict=True)
+    assert dict(violations.counts) == {'responses to tweets missing from the export': 1}
+
+
+def test_reports_bad_rows_and_links(tmp_path):
+    rows = [
+        ['1', '115712', 'False', '', '', '2,9', ''],
+        ['2', 'sprintcare', 'False', '', '', '', '1'],
+        ['3', 'sprintcare', 'False', '', '', '', ''],
+        ['3', 'sprintcare', 'False', '', '', '', ''],
+        ['x', '115712', 'True', '', '', '', ''],
+        ['4', '115712', 'True'],
+    ]
+    violations = validate_export.validate_export(write_csv(tmp_path / 'twcs.csv', rows))
+    assert dict(violations.counts) == {
+        'tweets whose inbound flag disagrees with their author': 1,
+        'malformed rows': 2,
+        'duplicate tweet IDs': 1,
+        'responses missing from the export': 1,
+    }
+
+
+def test_reports_files_without_header(tmp_path):
+    violations = validate_export.validate_export(write_csv(tmp_path / 'twcs.csv', [], None))
+    assert dict(violations.counts) == {'files without a header': 1}
+
+
+def test_reports_headers_missing_columns(tmp_path):
+    path = write_csv(tmp_path / 'twcs.csv', [row[:2] for row in ROWS], HEADER[:2])
+    assert dict(validate_export.validate_export(path).counts) == {'headers missing columns': 1}
+
+
+def test_reads_shards_in_manifest_order(tmp_path):
+    write_csv(tmp_path / 'twcs-1.csv', ROWS[2:])
+    write_csv(tmp_path / 'twcs-0.csv', ROWS[:2])
+    (tmp_path / 'manifest.json').write_text(
+        '{"shards": [{"path": "twcs-0.csv"}, {"path": "twcs-1.csv"}]}')
+    rows = list(validate_export.read_rows(str(tmp_path)))
+    assert rows == [HEADER] + ROWS
+    assert not validate_export.validate_export(str(tmp_path))
+
+
+def test_reports_shards_with_another_header(tmp_path):
+    write_csv(tmp_path / 'twcs-0.csv', ROWS[:2])
+    write_csv(tmp_path / 'twcs-1.csv', ROWS[2:], list(reversed(HEADER)))
+    violations = validate_export.validate_export(str(tmp_path))
+    assert dict(violations.counts) == {'files whose header differs from the first': 1}
+
+
+def test_reports_truncated_compressed_files(tmp_path):
+    path = tmp_path / 'twcs.csv.gz'
+    with gzip.open(path, 'wt', newline='') as outfile:
+        csv.writer(outfile).writerows([HEADER] + ROWS * 100)
+    path.write_bytes(path.read_bytes()[:-20])
+    violations = validate_export.validate_export(str(path))
+    assert dict(violations.counts) == {'unreadable files': 1}
@@ -1,48 +1,310 @@
-""" Validates exported dataset. """
+""" Validates exported dataset, a CSV, Parquet or Arrow file or a directory or glob of shards.
+    Reads the export twice, keeping a few packed integers per tweet instead of the rows
+    themselves:  the first pass collects tweet IDs and checks each row on its own, and the second
+    checks that replies and parents agree about every link.
+"""
 import csv
+import glob
+import gzip
+import io
+import json
 import logging
 import os
 import sys
-from collections import namedtuple
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Iterator, List
 
-import toolz
+from export_formats import CREATED_AT_FORMAT
+from support_accounts import CUSTOMER_SUPPORT_SNS
 
+# Number of example violations logged for each kind
+MAX_EXAMPLES = 5
+
+# Columns the checks read
+HEADER_COLUMNS = ['tweet_id', 'author_id', 'inbound', 'response_tweet_id',
+                  'in_response_to_tweet_id']
+
+
+class ExportUnreadable(Exception):
+    """ Raised when the export can't be read far enough to check its rows, with the kind of
+        violation and an example
+    """
+
+    def __init__(self, kind: str, example: str):
+        super().__init__(f'{kind}: {example}')
+        self.kind = kind
+        self.example = example
+
+
+class Violations:
+    """ Counts problems found in the export and keeps a few examples of each """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.examples = defaultdict(list)
+
+    def add(self, kind: str, example: str):
+        self.counts[kind] += 1
+        if len(self.examples[kind]) < MAX_EXAMPLES:
+            self.examples[kind].append(example)
+
+    def __bool__(self) -> bool:
+        return bool(self.counts)
+
+    def log(self, level=logging.ERROR):
+        for kind, count in sorted(self.counts.items()):
+            logging.log(level, f"{count} {kind}, e.g. {'; '.join(self.examples[kind])}")
+
+
+def export_files(export_path: str) -> List[str]:
+    """ Files making up an export:  the file itself, the files matching a glob, or the shards of
+        a directory in the order of its manifest
+    """
+    if os.path.isdir(export_path):
+        manifest_path = os.path.join(export_path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest:
+                return [os.path.join(export_path, shard['path'])
+                        for shard in json.load(manifest)['shards']]
+        return sorted(glob.glob(os.path.join(export_path, 'twcs-*')))
+    if glob.has_magic(export_path):
+        return sorted(glob.glob(export_path))
+    return [export_path]
+
+
+def open_export(export_path: str):
+    """ Opens a CSV export as text, decompressing .gz and .zst files """
+    if export_path.endswith('.gz'):
+        return gzip.open(export_path, 'rt', newline='')
+    if export_path.endswith('.zst'):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(export_path, 'rb')),
+                                encoding='utf-8', newline='')
+    return open(export_path, newline='')
+
+
+def csv_value(value) -> str:
+    """ Formats a typed value the way the CSV export writes it """
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ','.join(map(str, value))
+    if isinstance(value, datetime):
+        return value.strftime(CREATED_AT_FORMAT)
+    return str(value)
 
-def validate_export(export_path: str):
-    logging.info(f'Validating export at "{export_path}"...')
-    logging.info("Reading exported dataset...")
-    with open(export_path) as infile:
-        reader = csv.reader(infile)
-        Tweet = namedtuple('Tweet', next(reader))
-        tweets = {int(line[0]): Tweet(*line) for line in reader if len(line) > 0}
 
-    logging.info(f"Read {len(tweets)} tweets.")
+def read_columnar_rows(export_path: str) -> Iterator[List[str]]:
+    """ Yields the header, then every row of a Parquet or Arrow export formatted as CSV would be,
+        one record batch at a time
+    """
+    try:
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError(f'Reading {export_path} requires the pyarrow package.')
+    try:
+        if export_path.endswith('.parquet'):
+            parquet_file = pyarrow.parquet.ParquetFile(export_path)
+            schema, batches = parquet_file.schema_arrow, parquet_file.iter_batches()
+        else:
+            reader = pyarrow.ipc.open_file(export_path)
+            schema = reader.schema
+            batches = (reader.get_batch(num) for num in range(reader.num_record_batches))
+    except pyarrow.ArrowInvalid as error:
+        raise ExportUnreadable('unreadable files', f'{export_path}: {error}')
+    yield schema.names
+    for batch in batches:
+        columns = [[*map(csv_value, column.to_pylist())] for column in batch.columns]
+        yield from map(list, zip(*columns))
 
-    all_author_ids = set(t.author_id for t in tweets.values())
-    logging.info(f"Found {len(all_author_ids)} different authors.")
 
-    orphans = [t for t in tweets.values()
-               if len(t.response_tweet_id) == 0 and len(t.in_response_to_tweet_id) == 0]
-    logging.info(f"Found {len(orphans)} orphan tweets.")
+def read_file_rows(export_path: str) -> Iterator[List[str]]:
+    """ Yields the header, then every non-empty row of one file """
+    if export_path.endswith(('.parquet', '.arrow')):
+        yield from read_columnar_rows(export_path)
+        return
+    try:
+        with open_export(export_path) as infile:
+            for row in csv.reader(infile):
+                if row:
+                    yield row
+    except (EOFError, OSError) as error:
+        # Compressed files cut short by a crashed export
+        raise ExportUnreadable('unreadable files', f'{export_path}: {error}')
 
-    first_requests = [
-        t for t in tweets.values() if t.in_response_to_tweet_id == ''
-    ]
-    logging.info(f"Found {len(first_requests)} conversation starts.")
 
-    replies = list(toolz.concat(
-        [tweets[int(tid)] for tid in t.response_tweet_id.split(',') if int(tid) in tweets]
-        for t in first_requests if len(t.response_tweet_id) != ''
-    ))
+def read_rows(export_path: str) -> Iterator[List[str]]:
+    """ Yields the header, then every non-empty row of every file of the export.  Raises
+        ExportUnreadable if a file has no header or a different one than the first.
+    """
+    paths = export_files(export_path)
+    if not paths:
+        raise FileNotFoundError(f'No export files match "{export_path}"')
+    header = None
+    for path in paths:
+        rows = read_file_rows(path)
+        file_header = next(rows, None)
+        if file_header is None:
+            raise ExportUnreadable('files without a header', path)
+        if header is None:
+            missing = [name for name in HEADER_COLUMNS if name not in file_header]
+            if missing:
+                raise ExportUnreadable('headers missing columns',
+                                       f"{path} has no {', '.join(missing)}")
+            header = file_header
+            yield header
+        elif file_header != header:
+            raise ExportUnreadable('files whose header differs from the first',
+                                   f'{path} has columns {file_header}, not {header}')
+        yield from rows
+
+
+def parse_id(value: str) -> int:
+    """ Parses an ID column, which is empty for no ID """
+    return int(value) if value else 0
+
+
+def parse_ids(value: str) -> List[int]:
+    """ Parses a comma-separated list of IDs """
+    return [*map(int, value.split(','))] if value else []
+
+
+def collect_ids(export_path: str, violations: Violations) -> array:
+    """ First pass: checks each row on its own and returns the sorted tweet IDs """
+    rows = read_rows(export_path)
+    header = next(rows)
+    id_col, author_col, inbound_col, responses_col, parent_col = map(header.index, [
+        'tweet_id', 'author_id', 'inbound', 'response_tweet_id', 'in_response_to_tweet_id'])
+    tweet_ids = array('q')
+    for line, row in enumerate(rows, 2):
+        if len(row) != len(header):
+            violations.add('malformed rows', f'line {line} has {len(row)} columns')
+            continue
+        try:
+            tweet_id = int(row[id_col])
+            parse_id(row[parent_col])
+            parse_ids(row[responses_col])
+        except ValueError:
+            violations.add('malformed rows', f'line {line} has a non-integer ID')
+            continue
+        tweet_ids.append(tweet_id)
+        inbound, author = row[inbound_col], row[author_col]
+        if inbound not in ('True', 'False'):
+            violations.add('malformed rows', f'line {line} has inbound {inbound!r}')
+        elif (inbound == 'True') == (author.lower() in CUSTOMER_SUPPORT_SNS):
+            violations.add('tweets whose inbound flag disagrees with their author',
+                           f'tweet {tweet_id} by {author} has inbound {inbound}')
+
+    tweet_ids = array('q', sorted(tweet_ids))
+    for pos in range(1, len(tweet_ids)):
+        if tweet_ids[pos] == tweet_ids[pos - 1]:
+            violations.add('duplicate tweet IDs', str(tweet_ids[pos]))
+    return tweet_ids
+
+
+def check_links(export_path: str, tweet_ids: array, violations: Violations,
+                strict: bool=False) -> Counter:
+    """ Second pass: checks every reply is listed by exactly the tweet it responds to.  Replies to
+        tweets missing from the export are expected, since uncollected parents keep IDs of their
+        own, and are only violations when `strict`.  Returns summary counts.
+    """
+    num_tweets = len(tweet_ids)
+
+    def find(tweet_id: int) -> int:
+        pos = bisect_left(tweet_ids, tweet_id)
+        return pos if tweet_id and pos < num_tweets and tweet_ids[pos] == tweet_id else -1
+
+    parents = array('q', bytes(8 * num_tweets))
+    listed_by = array('q', bytes(8 * num_tweets))
+    listings = bytearray(num_tweets)
+    stats = Counter()
+
+    rows = read_rows(export_path)
+    header = next(rows)
+    id_col, responses_col, parent_col = map(header.index, [
+        'tweet_id', 'response_tweet_id', 'in_response_to_tweet_id'])
+    for row in rows:
+        if len(row) != len(header):
+            continue
+        try:
+            tweet_id = int(row[id_col])
+            parent = parse_id(row[parent_col])
+            responses = parse_ids(row[responses_col])
+        except ValueError:
+            continue
+        pos = find(tweet_id)
+        parents[pos] = parent
+        if not parent:
+            stats['conversation starts'] += 1
+            stats['orphans'] += not responses
+        for response in responses:
+            pos = find(response)
+            if pos < 0:
+                violations.add('responses missing from the export',
+                               f'tweet {tweet_id} lists {response}')
+                continue
+            listed_by[pos] = tweet_id
+            if listings[pos] < 255:
+                listings[pos] += 1
+
+    for pos, tweet_id in enumerate(tweet_ids):
+        parent, listed = parents[pos], listings[pos]
+        if listed > 1:
+            violations.add('tweets listed as a response more than once', str(tweet_id))
+        if listed and listed_by[pos] != parent:
+            violations.add("tweets listed as responses to tweets they don't respond to",
+                           f'{tweet_id} listed by {listed_by[pos]}, responds to {parent or None}')
+        if not parent:
+            continue
+        if find(parent) < 0:
+            stats['responses to tweets missing from the export'] += 1
+            if strict:
+                violations.add('responses to tweets missing from the export',
+                               f'{tweet_id} responds to {parent}')
+        elif not listed:
+            violations.add("responses their parents don't list", f'{tweet_id} responds to {parent}')
+    return stats
+
+
+def validate_export(export_path: str, strict: bool=False) -> Violations:
+    logging.info(f'Validating export at "{export_path}"...')
+    violations = Violations()
+    start = time.perf_counter()
+    try:
+        tweet_ids = collect_ids(export_path, violations)
+    except ExportUnreadable as error:
+        violations.add(error.kind, error.example)
+        violations.log()
+        return violations
+    elapsed = time.perf_counter() - start
+    logging.info(f"Read {len(tweet_ids)} tweets in {elapsed:.1f}s, "
+                 f"{len(tweet_ids) / max(elapsed, 1e-9):,.0f} rows/s.")
+
+    start = time.perf_counter()
+    stats = check_links(export_path, tweet_ids, violations, strict)
+    elapsed = time.perf_counter() - start
+    logging.info(f"Checked links in {elapsed:.1f}s, "
+                 f"{len(tweet_ids) / max(elapsed, 1e-9):,.0f} rows/s.")
+    for name, count in sorted(stats.items()):
+        logging.info(f"Found {count} {name}.")
 
-    non_cs_replies = [t for t in replies if not t.inbound]
-    logging.info(f"Found {len(non_cs_replies)} non-inbound response tweets out of {len(replies)}.")
+    if violations:
+        violations.log()
+    else:
+        logging.info("Found no violations.")
+    return violations
 
 
 if __name__ == '__main__':
-    export_path = 'twcs.csv' if len(sys.argv) < 2 else sys.argv[1]
+    args = [arg for arg in sys.argv[1:] if arg != '--strict']
+    export_path = 'twcs.csv' if len(args) < 1 else args[0]
     logging.basicConfig(
         format='%(levelname)s:%(asctime)s.%(msecs)03d [%(threadName)s] - %(message)s',
         datefmt='%Y-%m-%d,%H:%M:%S',
         level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO')))
-    validate_export(export_path)
+    sys.exit(1 if validate_export(export_path, '--strict' in sys.argv[1:]) else 0)